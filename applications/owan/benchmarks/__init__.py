@@ -0,0 +1,7 @@
+"""
+Benchmarks of owan. They are not run by `make test`.
+
+- `benchmarks.micro`: microbenchmarks of compression, validation and storage.
+- `benchmarks.load`: load test of `/predict` with concurrent clients.
+- `benchmarks.compare`: compare two saved results to find regressions.
+"""
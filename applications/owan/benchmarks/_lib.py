@@ -0,0 +1,122 @@
+import dataclasses
+import datetime
+import json
+import math
+import pathlib
+import platform
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Sequence
+
+if sys.version_info >= (3, 8):
+    from typing import Final
+else:
+    from typing_extensions import Final
+
+
+@dataclasses.dataclass(frozen=True)
+class Stats:
+    """Summary of latencies in seconds."""
+
+    count: int
+    mean: float
+    p50: float
+    p95: float
+    p99: float
+    max: float
+
+    @classmethod
+    def of(cls, latencies: Sequence[float]) -> "Stats":
+        ordered: Final = sorted(latencies)
+        return cls(
+            count=len(ordered),
+            mean=sum(ordered) / len(ordered),
+            p50=percentile(ordered, 50),
+            p95=percentile(ordered, 95),
+            p99=percentile(ordered, 99),
+            max=ordered[-1],
+        )
+
+
+def percentile(ordered: Sequence[float], p: float) -> float:
+    """Return the `p`-th percentile of sorted `ordered` by nearest rank."""
+    rank: Final = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def measure(fn: Callable[[], Any], repeat: int, warmup: int = 1) -> Stats:
+    """Call `fn` `warmup + repeat` times and summarize the last `repeat` calls."""
+    for _ in range(warmup):
+        fn()
+
+    latencies: Final[List[float]] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return Stats.of(latencies)
+
+
+def environment() -> Dict[str, Any]:
+    """Return information to tell whether two results are comparable."""
+    try:
+        commit = (
+            subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                check=True,
+            )
+            .stdout.decode()
+            .strip()
+        )
+    except Exception:
+        commit = None
+
+    return {
+        "created_at": datetime.datetime.utcnow().isoformat() + "Z",
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+    }
+
+
+def save(
+    path: pathlib.Path, suite: str, results: Dict[str, Any], **params: Any
+) -> None:
+    """Save `results` of `suite` as JSON which `benchmarks.compare` reads."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    document: Final = {
+        "suite": suite,
+        "environment": environment(),
+        "params": params,
+        "results": {
+            name: dataclasses.asdict(value)
+            if dataclasses.is_dataclass(value)
+            else value
+            for name, value in results.items()
+        },
+    }
+    path.write_text(json.dumps(document, indent=2, sort_keys=True))
+    print(f"saved results to `{path}`.")
+
+
+def report(results: Dict[str, Any]) -> None:
+    """Print `results` as a table in milliseconds."""
+    print(
+        f"{'name':<40} {'count':>6} "
+        + " ".join(f"{key + ' ms':>9}" for key in ("p50", "p95", "p99", "max"))
+    )
+    for name, value in results.items():
+        if not isinstance(value, Stats):
+            print(f"{name:<40} {value}")
+            continue
+        print(
+            f"{name:<40} {value.count:>6} "
+            + " ".join(
+                f"{getattr(value, key) * 1000:>9.2f}"
+                for key in ("p50", "p95", "p99", "max")
+            )
+        )
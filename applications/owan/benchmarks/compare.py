@@ -0,0 +1,78 @@
+"""
+Compare two results saved by benchmarks and report regressions.
+
+Exits with 1 if a latency percentile got slower, or throughput got lower,
+by more than `--threshold`.
+
+Example usage:
+$ poetry run python -m benchmarks.compare baseline.json current.json --threshold 0.1
+"""
+import argparse
+import json
+import pathlib
+import sys
+from typing import Any, Dict, List, Optional
+
+if sys.version_info >= (3, 8):
+    from typing import Final
+else:
+    from typing_extensions import Final
+
+# Keys of results where larger is better. Others are latencies.
+_HIGHER_IS_BETTER: Final = {"requests_per_second"}
+_PERCENTILES: Final = ("p50", "p95", "p99")
+
+
+def _flatten(results: Dict[str, Any]) -> Dict[str, float]:
+    flat: Final[Dict[str, float]] = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            for key in _PERCENTILES:
+                flat[f"{name}/{key}"] = float(value[key])
+        elif isinstance(value, (int, float)) and name in _HIGHER_IS_BETTER:
+            flat[name] = float(value)
+    return flat
+
+
+def compare(
+    baseline: Dict[str, Any], current: Dict[str, Any], threshold: float
+) -> List[str]:
+    """Return descriptions of metrics which regressed more than `threshold`."""
+    before: Final = _flatten(baseline["results"])
+    after: Final = _flatten(current["results"])
+
+    regressions: Final[List[str]] = []
+    for name in sorted(before.keys() & after.keys()):
+        if before[name] == 0:
+            continue
+        change = (after[name] - before[name]) / before[name]
+        if name.rsplit("/", 1)[-1] in _HIGHER_IS_BETTER:
+            change = -change
+        marker = "REGRESSION" if change > threshold else ""
+        print(
+            f"{name:<48} {before[name]:>12.4f} {after[name]:>12.4f} {change:>+8.1%} {marker}"
+        )
+        if marker:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser: Final = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("baseline", type=pathlib.Path)
+    parser.add_argument("current", type=pathlib.Path)
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args: Final = parser.parse_args(argv)
+
+    regressions: Final = compare(
+        json.loads(args.baseline.read_text()),
+        json.loads(args.current.read_text()),
+        args.threshold,
+    )
+    if regressions:
+        print(f"{len(regressions)} metrics regressed more than {args.threshold:.0%}.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Load test of the upload -> queue -> storage pipeline.
+
+`/predict` is driven by concurrent clients against the app running in
+process. Celery runs tasks eagerly in the API process, so the measured
+latency includes the task (read payload, predict, release input).
+
+Example usage:
+$ poetry run python -m benchmarks.load --clients 8 --requests 400 --output benchmarks/results/load.json
+"""
+import argparse
+import concurrent.futures
+import os
+import pathlib
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+if sys.version_info >= (3, 8):
+    from typing import Final
+else:
+    from typing_extensions import Final
+
+from benchmarks._lib import Stats, report, save
+
+DEFAULT_IMAGE: Final = pathlib.Path("./tests/samples/valid_input_01.png")
+
+
+def _configure(directory: pathlib.Path, payload_transport: str) -> None:
+    """Point settings to in-memory broker and temporary directories."""
+    os.environ.update(
+        {
+            "REDIS_DSN": "memory://localhost",
+            "RESULT_BACKEND_DSN": "cache+memory://",
+            "STORAGE_PROVIDER": "LOCAL",
+            "LOCAL_DIRECTORY": str(directory / "storage"),
+            "INPUT_STORE_DIR_PATH": str(directory / "input_store"),
+            "PAYLOAD_TRANSPORT": payload_transport,
+            "PAYLOAD_CACHE_DIR_PATH": str(directory / "payload_cache"),
+            # Every request sends the same image.
+            "DEDUP_ENABLED": "false",
+            "ADMISSION_ENABLED": "false",
+            "WORKER_WARM_UP": "false",
+            # Eager tasks run inside enqueueing.
+            "ENQUEUE_TIMEOUT_MS": "60000",
+        }
+    )
+
+
+def run(
+    image: pathlib.Path, clients: int, requests: int, payload_transport: str
+) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory() as tmp:
+        _configure(pathlib.Path(tmp), payload_transport)
+
+        # Imported after configuring because settings are read on import.
+        import fastapi.testclient
+
+        import owan.bootstrap
+        import owan.views.api
+        import owan.wsgi
+
+        app: Final = owan.wsgi.main()
+        content: Final = image.read_bytes()
+        latencies: Final[List[float]] = []
+        errors: Final[List[int]] = []
+        lock: Final = threading.Lock()
+
+        with fastapi.testclient.TestClient(app) as client:
+            domain: Final = owan.bootstrap.shared_domain(owan.views.api.get_settings())
+            domain.task_queue._celeryapp.conf.task_always_eager = True
+
+            def request(_: int) -> None:
+                start = time.perf_counter()
+                response = client.post(
+                    "/predict", files={"file": (image.name, content, "image/png")}
+                )
+                elapsed = time.perf_counter() - start
+                with lock:
+                    if response.status_code == 200:
+                        latencies.append(elapsed)
+                    else:
+                        errors.append(response.status_code)
+
+            # Warm up connections, plugins and lazy imports.
+            request(0)
+            latencies.clear()
+
+            start = time.perf_counter()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=clients) as executor:
+                list(executor.map(request, range(requests)))
+            duration: Final = time.perf_counter() - start
+
+    results: Final[Dict[str, Any]] = {
+        "predict": Stats.of(latencies) if latencies else None,
+        "requests_per_second": len(latencies) / duration,
+        "errors": len(errors),
+    }
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser: Final = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--image", type=pathlib.Path, default=DEFAULT_IMAGE)
+    parser.add_argument("--payload-transport", choices=("PATH", "AUTO"), default="PATH")
+    parser.add_argument("--output", type=pathlib.Path, default=None)
+    args: Final = parser.parse_args(argv)
+
+    results: Final = run(
+        args.image, args.clients, args.requests, args.payload_transport
+    )
+    report(results)
+    if args.output is not None:
+        save(
+            args.output,
+            "load",
+            results,
+            clients=args.clients,
+            requests=args.requests,
+            image=str(args.image),
+            payload_transport=args.payload_transport,
+        )
+
+
+if __name__ == "__main__":
+    main()
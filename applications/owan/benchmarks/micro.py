@@ -0,0 +1,152 @@
+"""
+Microbenchmarks of hot-path steps.
+
+Example usage:
+$ poetry run python -m benchmarks.micro --repeat 20 --output benchmarks/results/micro.json
+"""
+import argparse
+import contextlib
+import pathlib
+import random
+import sys
+import tempfile
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+if sys.version_info >= (3, 8):
+    from typing import Final
+else:
+    from typing_extensions import Final
+
+from PIL import Image
+
+from benchmarks._lib import Stats, measure, report, save
+from owan.domain.compress import Compressor
+from owan.domain.io import IoHandler
+from owan.libs.storage import Storage
+
+SIZES: Final = (256, 1024, 2048, 4096)
+FORMATS: Final = ("png", "jpeg")
+STORE_SIZES: Final = (64 * 1024, 1024 * 1024, 16 * 1024 * 1024)
+
+
+def _make_image(path: pathlib.Path, size: int) -> None:
+    """Save a photo-like image whose compression cost is close to real ones."""
+    rng: Final = random.Random(size)
+    small: Final = Image.new("RGB", (64, 64))
+    small.putdata(
+        [
+            (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+            for _ in range(64 * 64)
+        ]
+    )
+    small.resize((size, size), Image.BICUBIC).save(path)
+
+
+def bench_compress(
+    directory: pathlib.Path, repeat: int, max_dimension: Optional[int]
+) -> Dict[str, Stats]:
+    compressor: Final = Compressor({".png", ".jpeg"}, 30, max_dimension)
+    results: Final[Dict[str, Stats]] = {}
+    for image_format in FORMATS:
+        for size in SIZES:
+            input_path = directory / f"input_{size}.{image_format}"
+            _make_image(input_path, size)
+            output_path = directory / "output.jpeg"
+            results[f"compress_image/{image_format}/{size}"] = measure(
+                lambda: compressor.compress_image(input_path, output_path),
+                repeat,
+            )
+    return results
+
+
+def bench_validate(directory: pathlib.Path, repeat: int) -> Dict[str, Stats]:
+    io_handler: Final = IoHandler()
+    results: Final[Dict[str, Stats]] = {}
+    for image_format in FORMATS:
+        input_path = directory / f"input_{SIZES[-1]}.{image_format}"
+        if not input_path.exists():
+            _make_image(input_path, SIZES[-1])
+        results[f"validate_image/{image_format}"] = measure(
+            lambda: io_handler.validate_image(input_path), repeat
+        )
+    return results
+
+
+@contextlib.contextmanager
+def _s3_storage(directory: pathlib.Path) -> Iterator[Optional[Storage]]:
+    try:
+        import boto3
+        import moto
+    except ImportError:
+        print("moto is not installed. skip S3 benchmarks.")
+        yield None
+        return
+
+    with moto.mock_s3():
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="owan-bench")
+        storage: Final = Storage(
+            directory / "s3_fallback",
+            "testing",
+            "testing",
+            "us-east-1",
+            "owan-bench",
+        )
+        try:
+            yield storage
+        finally:
+            storage.close()
+
+
+def bench_store(directory: pathlib.Path, repeat: int) -> Dict[str, Stats]:
+    files: Final[List[Tuple[int, pathlib.Path]]] = []
+    for size in STORE_SIZES:
+        path = directory / f"blob_{size}.bin"
+        path.write_bytes(
+            random.Random(size).getrandbits(8 * size).to_bytes(size, "little")
+        )
+        files.append((size, path))
+
+    results: Final[Dict[str, Stats]] = {}
+    local: Final = Storage(directory / "local", "", "", "", "", local_only=True)
+    for size, path in files:
+        results[f"store/local/{size}"] = measure(
+            lambda: local.store(path, f"bench/{path.name}"), repeat
+        )
+
+    with _s3_storage(directory) as maybe_s3:
+        if maybe_s3 is not None:
+            s3: Final = maybe_s3
+            for size, path in files:
+                results[f"store/s3/{size}"] = measure(
+                    lambda: s3.store(path, f"bench/{path.name}"), repeat
+                )
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser: Final = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--max-dimension", type=int, default=None)
+    parser.add_argument("--output", type=pathlib.Path, default=None)
+    args: Final = parser.parse_args(argv)
+
+    results: Final[Dict[str, Any]] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = pathlib.Path(tmp)
+        results.update(bench_compress(directory, args.repeat, args.max_dimension))
+        results.update(bench_validate(directory, args.repeat))
+        results.update(bench_store(directory, args.repeat))
+
+    report(results)
+    if args.output is not None:
+        save(
+            args.output,
+            "micro",
+            results,
+            repeat=args.repeat,
+            max_dimension=args.max_dimension,
+        )
+
+
+if __name__ == "__main__":
+    main()
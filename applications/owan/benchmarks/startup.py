@@ -0,0 +1,157 @@
+"""
+Cold start of the API and worker entry points.
+
+Each entry point is imported in a fresh interpreter. The wall time of the
+import is measured over `--repeat` runs, and one run with `-X importtime`
+is broken down by owan module, and by third-party package with the owan
+module which first imported it. `-X importtime` needs Python 3.7 or later,
+so on older Python only wall times are reported.
+
+Example usage:
+$ poetry run python -m benchmarks.startup --repeat 10 --output benchmarks/results/startup.json
+"""
+import argparse
+import collections
+import pathlib
+import subprocess
+import sys
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+if sys.version_info >= (3, 8):
+    from typing import Final
+else:
+    from typing_extensions import Final
+
+from benchmarks._lib import measure, report, save
+
+ENTRY_POINTS: Final = ("owan.wsgi", "owan.worker")
+
+
+class ImportTime(NamedTuple):
+    name: str
+    depth: int
+    self_us: int
+    cumulative_us: int
+
+
+def import_times(module: str) -> List[ImportTime]:
+    """Import `module` in a fresh interpreter and parse `-X importtime` output.
+
+    Entries are in the order Python reports them: children before parents.
+
+    """
+    completed: Final = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+    entries: Final[List[ImportTime]] = []
+    for line in completed.stderr.decode().splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            continue  # Header.
+        entries.append(
+            ImportTime(
+                name=name.strip(),
+                depth=(len(name) - len(name.lstrip()) - 1) // 2,
+                self_us=int(self_us),
+                cumulative_us=int(cumulative_us),
+            )
+        )
+    return entries
+
+
+def _root(name: str) -> str:
+    return name.split(".", 1)[0]
+
+
+def breakdown(
+    entries: List[ImportTime],
+) -> Tuple[Dict[str, ImportTime], Dict[str, Tuple[int, str]]]:
+    """Break `entries` down by owan module and by third-party package.
+
+    Return:
+        Tuple[Dict[str, ImportTime], Dict[str, Tuple[int, str]]]: Entries of
+            owan modules, and cumulative microseconds of each third-party
+            package with the nearest owan module which imported it.
+
+    """
+    owan_modules: Final[Dict[str, ImportTime]] = {}
+    packages: Final[Dict[str, Tuple[int, str]]] = {}
+    totals: Final[Dict[str, int]] = collections.Counter()
+    importers: Final[Dict[str, str]] = {}
+
+    # Reversed, a parent comes before its children, so ancestors are a stack.
+    stack: Final[List[ImportTime]] = []
+    for entry in reversed(entries):
+        while stack and stack[-1].depth >= entry.depth:
+            stack.pop()
+        root = _root(entry.name)
+        if root == "owan":
+            owan_modules[entry.name] = entry
+        elif not stack or _root(stack[-1].name) != root:
+            # Count only the outermost import of a package.
+            totals[root] += entry.cumulative_us
+            importer = next(
+                (e.name for e in reversed(stack) if _root(e.name) == "owan"), "-"
+            )
+            importers.setdefault(root, importer)
+        stack.append(entry)
+
+    for root, total in totals.items():
+        packages[root] = (total, importers[root])
+    return owan_modules, packages
+
+
+def print_breakdown(module: str, entries: List[ImportTime], top: int) -> None:
+    owan_modules, packages = breakdown(entries)
+    print(f"\n{module}")
+    print(f"{'owan module':<40} {'self ms':>9} {'cumulative ms':>14}")
+    for entry in sorted(owan_modules.values(), key=lambda e: -e.cumulative_us):
+        print(
+            f"{entry.name:<40} {entry.self_us / 1000:>9.2f} "
+            f"{entry.cumulative_us / 1000:>14.2f}"
+        )
+    print(f"{'package':<40} {'cumulative ms':>14} imported by")
+    ordered: Final = sorted(packages.items(), key=lambda item: -item[1][0])
+    for name, (total, importer) in ordered[:top]:
+        print(f"{name:<40} {total / 1000:>14.2f} {importer}")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser: Final = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("modules", nargs="*", default=list(ENTRY_POINTS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--output", type=pathlib.Path, default=None)
+    args: Final = parser.parse_args(argv)
+
+    results: Final[Dict[str, Any]] = {}
+    for module in args.modules:
+        results[f"import/{module}"] = measure(
+            lambda: subprocess.run(
+                [sys.executable, "-c", f"import {module}"], check=True
+            ),
+            args.repeat,
+        )
+    results["import/python"] = measure(
+        lambda: subprocess.run([sys.executable, "-c", "pass"], check=True),
+        args.repeat,
+    )
+
+    report(results)
+    if sys.version_info < (3, 7):
+        # Unknown `-X` options are ignored silently, so the breakdown would be empty.
+        print("\nbreakdown is unavailable: `-X importtime` needs Python 3.7 or later.")
+    else:
+        for module in args.modules:
+            print_breakdown(module, import_times(module), args.top)
+    if args.output is not None:
+        save(args.output, "startup", results, repeat=args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,10 @@ A module to initialize application for launching.
 """
 import contextlib
 import logging
+import os
 import sys
-from typing import Iterator
+import threading
+from typing import Iterator, Optional
 
 if sys.version_info >= (3, 8):
     from typing import Final
@@ -14,49 +16,186 @@ else:
 import owan.bootstrap
 import owan.domain
 import owan.settings
-import owan.tasks
 
 logger: Final = logging.getLogger("uvicorn")
 
+_shared_domain_lock: Final = threading.Lock()
+_shared_domain: Optional[owan.domain.Domain] = None
+_shared_domain_pid: Optional[int] = None
+
+
+def _storage_factory(
+    settings: owan.settings.StorageSettings, local_only: bool
+) -> owan.libs.storage.Storage:
+    return owan.libs.storage.Storage(
+        local_directory=settings.local_directory,
+        s3_access_key_id=settings.s3_access_key_id,
+        s3_secret_key=settings.s3_secret_key,
+        s3_region_name=settings.s3_region_name,
+        s3_bucket_name=settings.s3_bucket_name,
+        local_only=local_only,
+        s3_endpoint_url=settings.s3_endpoint_url,
+        s3_max_pool_connections=settings.s3_max_pool_connections,
+        s3_multipart_threshold=settings.s3_multipart_threshold,
+        s3_multipart_chunksize=settings.s3_multipart_chunksize,
+        s3_max_concurrency=settings.s3_max_concurrency,
+        s3_max_workers=settings.s3_max_workers,
+        spool_directory=settings.spool_directory,
+        spool_workers=settings.spool_workers,
+    )
+
 
 def _init_storage(settings: owan.settings.StorageSettings) -> owan.libs.storage.Storage:
 
     if settings.provider == owan.settings.StorageProvider.LOCAL:
         logger.info("storage try to initialize as local only mode.")
-        return owan.libs.storage.Storage(
-            local_directory=settings.local_directory,
-            s3_access_key_id=settings.s3_access_key_id,
-            s3_secret_key=settings.s3_secret_key,
-            s3_region_name=settings.s3_region_name,
-            s3_bucket_name=settings.s3_bucket_name,
-            local_only=True,
-        )
+        return _storage_factory(settings, local_only=True)
 
     if settings.provider == owan.settings.StorageProvider.S3:
         logger.info("storage try to initialize as S3 mode.")
-        return owan.libs.storage.Storage(
-            local_directory=settings.local_directory,
-            s3_access_key_id=settings.s3_access_key_id,
-            s3_secret_key=settings.s3_secret_key,
-            s3_region_name=settings.s3_region_name,
-            s3_bucket_name=settings.s3_bucket_name,
-            local_only=False,
-        )
+        return _storage_factory(settings, local_only=False)
 
     raise owan.settings.SettingsError()
 
 
+def _init_dedup(
+    settings: owan.settings.DedupSetting,
+) -> Optional[owan.libs.dedup.ContentIndex]:
+    if not settings.enabled:
+        return None
+
+    logger.info("dedup index is enabled.")
+    return owan.libs.dedup.ContentIndex(
+        max_entries=settings.max_entries,
+        redis_dsn=settings.redis_dns,
+        ttl=settings.ttl,
+    )
+
+
+def _init_payload(
+    settings: owan.settings.PayloadSetting, storage: owan.libs.storage.Storage
+) -> owan.domain.payload.PayloadTransport:
+    try:
+        mode: Final = owan.domain.payload.TransportMode[settings.transport]
+    except KeyError:
+        raise owan.settings.SettingsError()
+
+    logger.info(f"payload transport is `{mode.name}` mode.")
+    return owan.domain.payload.PayloadTransport(
+        storage,
+        mode=mode,
+        inline_max_bytes=settings.inline_max_bytes,
+        cache_directory=settings.cache_directory,
+        cache_max_bytes=settings.cache_max_bytes,
+    )
+
+
+def _init_derivative_cache(
+    settings: owan.settings.DerivativeCacheSetting,
+) -> Optional[owan.libs.cache.TieredCache]:
+    if settings.memory_max_bytes <= 0 and settings.directory is None:
+        return None
+
+    logger.info("derivative cache is enabled.")
+    return owan.libs.cache.TieredCache(
+        "derivative",
+        memory_max_bytes=settings.memory_max_bytes,
+        directory=settings.directory,
+        disk_max_bytes=settings.disk_max_bytes,
+    )
+
+
 def domain_factory(settings: owan.settings.Settings) -> owan.domain.Domain:
-    broker: Final = owan.tasks.Factory(broker=settings.redis.dns).broker
+    owan.domain.io.configure_pixel_budget(settings.io.max_image_pixels)
+    # Celery is imported here, so that importing views or bootstrap stays fast.
+    from owan.tasks import Factory
+
+    broker: Final = Factory(
+        broker=settings.redis.dns,
+        backend=settings.redis.result_backend_dns,
+        result_expires=settings.redis.result_expires,
+        worker_settings=settings.worker,
+        pool_limit=settings.redis.pool_limit,
+        socket_timeout=settings.redis.socket_timeout,
+    ).broker
     storage: Final = _init_storage(settings.storage)
     return owan.domain.Domain(
         broker=broker,
         input_supported_extention=settings.io.input_supported_extensions,
         output_image_compress_quality=settings.io.output_image_compress_quality,
+        output_image_max_dimension=settings.io.output_image_max_dimension,
+        output_image_format=settings.io.output_image_format,
+        max_image_pixels=settings.io.max_image_pixels,
+        derivative_cache=_init_derivative_cache(settings.derivative_cache),
         storage=storage,
+        dedup=_init_dedup(settings.dedup),
+        payload=_init_payload(settings.payload, storage),
+        input_store_shard_depth=settings.input_store.shard_depth,
+        janitor=owan.domain.janitor.Janitor(
+            settings.input_store.path,
+            ttl=settings.input_store.ttl,
+            sweep_interval=settings.input_store.sweep_interval,
+        ),
+        predict_max_batch_size=settings.worker.predict_max_batch_size,
+        predict_max_wait=settings.worker.predict_max_wait,
     )
 
 
 @contextlib.contextmanager
 def domain(settings: owan.settings.Settings) -> Iterator[owan.domain.Domain]:
-    yield owan.bootstrap.domain_factory(settings)
+    """Build a short-lived Domain which is closed on exit.
+
+    Prefer `shared_domain` on hot paths (HTTP requests, Celery tasks).
+
+    """
+    d: Final = owan.bootstrap.domain_factory(settings)
+    try:
+        yield d
+    finally:
+        d.close()
+
+
+def shared_domain(settings: owan.settings.Settings) -> owan.domain.Domain:
+    """Return the process-wide Domain, building it on first use.
+
+    The Domain is built once per process and shared by every request or task
+    handled by that process. If the process was forked after the Domain was
+    built (e.g. gunicorn `--preload` or Celery prefork), a new one is built
+    in the child because broker connections and boto3 sessions must not be
+    shared across processes.
+
+    Args:
+        settings (owan.settings.Settings): Settings used when the Domain is built.
+            They are ignored once the Domain exists.
+
+    Return:
+        owan.domain.Domain: The shared Domain.
+
+    """
+    global _shared_domain, _shared_domain_pid
+
+    pid: Final = os.getpid()
+    if _shared_domain is not None and _shared_domain_pid == pid:
+        return _shared_domain
+
+    with _shared_domain_lock:
+        if _shared_domain is None or _shared_domain_pid != pid:
+            logger.info(f"build shared domain for process `{pid}`.")
+            _shared_domain = owan.bootstrap.domain_factory(settings)
+            _shared_domain_pid = pid
+        return _shared_domain
+
+
+def shutdown() -> None:
+    """Close the process-wide Domain if it has been built."""
+    global _shared_domain, _shared_domain_pid
+
+    with _shared_domain_lock:
+        if _shared_domain is None:
+            return
+
+        if _shared_domain_pid == os.getpid():
+            logger.info("close shared domain.")
+            _shared_domain.close()
+        _shared_domain = None
+        _shared_domain_pid = None
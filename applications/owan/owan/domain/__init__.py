@@ -1,9 +1,10 @@
 import logging
 import pathlib
 import sys
+import threading
 import time
 import uuid
-from typing import Any, Set
+from typing import Any, List, Optional, Set
 
 if sys.version_info >= (3, 8):
     from typing import Final
@@ -12,6 +13,11 @@ else:
 
 from owan.domain.compress import Compressor
 from owan.domain.io import IoHandler
+from owan.domain.janitor import Janitor
+from owan.domain.payload import PayloadTransport
+from owan.libs.batching import MicroBatcher
+from owan.libs.cache import TieredCache
+from owan.libs.dedup import ContentIndex
 from owan.libs.storage import Storage
 
 logger: Final = logging.getLogger("uvicorn")
@@ -24,33 +30,133 @@ class Domain:
         input_supported_extention: Set[str],
         output_image_compress_quality: int,
         storage: Storage,
+        output_image_max_dimension: Optional[int] = None,
+        dedup: Optional[ContentIndex] = None,
+        predict_max_batch_size: int = 1,
+        predict_max_wait: float = 0.0,
+        payload: Optional[PayloadTransport] = None,
+        input_store_shard_depth: int = 0,
+        janitor: Optional[Janitor] = None,
+        derivative_cache: Optional[TieredCache] = None,
+        output_image_format: str = "jpeg",
+        max_image_pixels: Optional[int] = None,
     ) -> None:
         self.task_queue: Final = broker
-        self.task_worker: Final = TaskWorker()
-        self.io: Final = IoHandler()
+        self.task_worker: Final = TaskWorker(predict_max_batch_size, predict_max_wait)
+        self.io: Final = IoHandler(input_store_shard_depth, max_image_pixels)
         self.compressor: Final = Compressor(
-            input_supported_extention, output_image_compress_quality
+            input_supported_extention,
+            output_image_compress_quality,
+            output_image_max_dimension,
+            cache=derivative_cache,
+            image_format=output_image_format,
+            max_pixels=max_image_pixels,
         )
         self.storage: Final = storage
+        self.dedup: Final = dedup
+        self.payload: Final = payload or PayloadTransport(storage)
+        self.janitor: Final = janitor
+
+    def warm_up(self) -> None:
+        """Run dummy work so that lazy initialization is done before the first task."""
+        start: Final = time.perf_counter()
+        self.compressor.warm_up()
+        self.task_worker.warm_up()
+        logger.info(f"domain warmed up in {time.perf_counter() - start:.3f} sec.")
+
+    def close(self) -> None:
+        """Release resources held by subdomains (e.g. broker connections)."""
+        self.task_queue.close()
+        self.task_worker.close()
+        if self.janitor is not None:
+            self.janitor.close()
+        self.storage.close()
 
 
 class TaskWorker:
-    """TaskWorker subdomain class which execute tasks asked from _TaskQueue"""
+    """TaskWorker subdomain class which execute tasks asked from _TaskQueue
+
+    If `predict_max_batch_size` is larger than 1, predictions requested by
+    concurrently running tasks (`threads` or `gevent` pool) are grouped into
+    one `predict_batch` call of up to `predict_max_batch_size` images,
+    waiting at most `predict_max_wait` seconds for a batch to fill.
+
+    """
+
+    def __init__(
+        self, predict_max_batch_size: int = 1, predict_max_wait: float = 0.0
+    ) -> None:
+        self._predict_max_batch_size: Final = predict_max_batch_size
+        self._predict_max_wait: Final = predict_max_wait
+        self._predict_batcher: Optional[MicroBatcher[Optional[str], Any]] = None
+        self._predict_batcher_lock: Final = threading.Lock()
+
+    def predict(self, image_path: Optional[str] = None) -> Any:
+        """Predict an image. This goes through micro-batching if it is enabled."""
+        if self._predict_max_batch_size <= 1:
+            return self.predict_batch([image_path])[0]
+        return self._get_predict_batcher().submit(image_path).result()
+
+    def predict_batch(self, image_paths: List[Optional[str]]) -> List[Any]:
+        """Predict images in one batched inference call.
+
+        Return:
+            List[Any]: Results in the same order as `image_paths`.
+
+        """
+        logger.info(f"predict_batch from _TaskWorker. batch size: {len(image_paths)}")
+        return [None for _ in image_paths]
+
+    def warm_up(self) -> None:
+        """Load model and run a dummy inference. Call once per worker process."""
+        self.predict_batch([None])
 
-    def __init__(self) -> None:
-        pass
+    def close(self) -> None:
+        with self._predict_batcher_lock:
+            if self._predict_batcher is not None:
+                self._predict_batcher.close()
+                self._predict_batcher = None
 
-    def predict(self) -> None:
-        logger.info("predict from _TaskWorker")
+    def _get_predict_batcher(self) -> MicroBatcher[Optional[str], Any]:
+        # Built lazily so that processes which only enqueue never start a thread.
+        with self._predict_batcher_lock:
+            if self._predict_batcher is None:
+                self._predict_batcher = MicroBatcher(
+                    self.predict_batch,
+                    max_batch_size=self._predict_max_batch_size,
+                    max_wait=self._predict_max_wait,
+                )
+            return self._predict_batcher
 
-    def test_predict(self, image_path: str, storage: Storage) -> None:
+    def test_predict(self, image_path: str) -> str:
+        """Simulate prediction of `image_path` and return the key to store it as."""
         time.sleep(10)
 
+        logger.info(f"image_path: `{image_path}` is processing")
+        key: Final = f"jetson/{str(uuid.uuid4())}/{pathlib.Path(image_path).name}"
+
+        logger.info(f"test_predict image_path: {image_path} done.")
+        return key
+
+    def store(
+        self,
+        image_path: str,
+        key: str,
+        storage: Storage,
+        fallback_local: bool = True,
+    ) -> None:
+        """Store `image_path` as `key`.
+
+        Args:
+            fallback_local (bool): If False, failure of S3 is raised instead of
+                storing the image to local storage. See `Storage.store`.
+
+        Raises:
+            owan.libs.storage.Error: If the image could not be stored.
+
+        """
         try:
-            logger.info(f"image_path: `{image_path}` is processing")
-            key: Final = f"jetson/{str(uuid.uuid4())}/{pathlib.Path(image_path).name}"
-            storage.store(pathlib.Path(image_path), key)
+            storage.store(pathlib.Path(image_path), key, fallback_local=fallback_local)
         except Exception:
             logger.error(f"failed to store `{image_path}`.")
-
-        logger.info(f"test_predict image_path: {image_path} done.")
+            raise
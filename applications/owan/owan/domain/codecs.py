@@ -0,0 +1,125 @@
+"""
+Output image encoders.
+
+Each encoder describes how Pillow saves an image in one format. Encoders
+are looked up by name (e.g. per request or per client profile) or by file
+extension. Formats provided by optional Pillow plugins are available only
+when the plugin is installed:
+
+- `jpeg`: progressive, optimized JPEG.
+- `webp`: WebP (needs Pillow built with libwebp).
+- `avif`: AVIF (needs `pillow-avif-plugin`, or Pillow built with libavif).
+
+Example usage:
+>>> encoder = get_encoder("webp")
+>>> im.save(f, encoder.pillow_format, quality=60, **encoder.options)
+"""
+import dataclasses
+import importlib
+import logging
+import sys
+from typing import Any, Dict, Optional, Tuple
+
+if sys.version_info >= (3, 8):
+    from typing import Final
+else:
+    from typing_extensions import Final
+
+logger: Final = logging.getLogger("uvicorn")
+
+
+@dataclasses.dataclass(frozen=True)
+class Encoder:
+    name: str
+    extension: str
+    pillow_format: str
+    modes: Tuple[str, ...]  # Image modes saved as is. Others are converted to RGB.
+    options: Dict[str, Any] = dataclasses.field(default_factory=dict)
+    plugin: Optional[str] = None  # Module which registers the format to Pillow.
+
+    def available(self) -> bool:
+        """Return True if Pillow can save images in this format."""
+        from PIL import Image
+
+        if self.plugin is not None:
+            try:
+                importlib.import_module(self.plugin)
+            except ImportError:
+                pass
+        Image.init()
+        return self.pillow_format in Image.SAVE
+
+
+_encoders: Final[Dict[str, Encoder]] = {}
+
+
+def register_encoder(encoder: Encoder) -> None:
+    """Make `encoder` available by its name and extension."""
+    _encoders[encoder.name] = encoder
+
+
+def get_encoder(name: str) -> Encoder:
+    """Return the encoder named `name`.
+
+    Raises:
+        ValueError: If `name` is unknown or its codec is not installed.
+
+    """
+    encoder: Final = _encoders.get(name.lower())
+    if encoder is None:
+        message = f"output format `{name}` is not supported."
+        logger.error(message)
+        raise ValueError(message)
+    if not encoder.available():
+        message = f"output format `{name}` is not available. Install its codec."
+        logger.error(message)
+        raise ValueError(message)
+    return encoder
+
+
+def encoder_for_extension(extension: str) -> Encoder:
+    """Return the encoder whose output has `extension` (e.g. `.webp`).
+
+    Raises:
+        ValueError: If no encoder writes `extension`, or its codec is not installed.
+
+    """
+    for encoder in _encoders.values():
+        if encoder.extension == extension:
+            return get_encoder(encoder.name)
+
+    supported: Final = ", ".join(sorted(e.extension for e in _encoders.values()))
+    message: Final = f"output extension should be one of `{supported}`."
+    logger.error(message)
+    raise ValueError(message)
+
+
+register_encoder(
+    Encoder(
+        name="jpeg",
+        extension=".jpeg",
+        pillow_format="JPEG",
+        modes=("RGB", "L", "CMYK"),
+        # Progressive scans and optimized Huffman tables make files smaller
+        # at the same quality.
+        options={"progressive": True, "optimize": True},
+    )
+)
+register_encoder(
+    Encoder(
+        name="webp",
+        extension=".webp",
+        pillow_format="WEBP",
+        modes=("RGB", "RGBA"),
+        options={"method": 4},
+    )
+)
+register_encoder(
+    Encoder(
+        name="avif",
+        extension=".avif",
+        pillow_format="AVIF",
+        modes=("RGB", "RGBA"),
+        plugin="pillow_avif",
+    )
+)
@@ -1,61 +1,384 @@
+import concurrent.futures
+import dataclasses
+import functools
 import logging
+import os
 import pathlib
 import sys
 from io import BytesIO
-from typing import Set
-
-from PIL import Image
+from typing import IO, TYPE_CHECKING, List, Optional, Sequence, Set, Tuple
 
 if sys.version_info >= (3, 8):
     from typing import Final
 else:
     from typing_extensions import Final
 
+from owan.domain.codecs import Encoder, encoder_for_extension, get_encoder
+from owan.domain.io import open_image
+from owan.libs.cache import TieredCache
+from owan.libs.fs import atomic_write, file_digest, unique_partial_path
+from owan.libs.metrics import COMPRESS_SECONDS
+
+if TYPE_CHECKING:
+    # Pillow is imported on first use, so that importing this module is fast.
+    from PIL import Image
+
 logger: Final = logging.getLogger("uvicorn")
 
+# The lowest quality tried to fit a byte budget.
+_MIN_QUALITY: Final = 5
+
+
+@dataclasses.dataclass(frozen=True)
+class CompressionResult:
+    input_path: pathlib.Path
+    output_path: pathlib.Path
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def _compress_task(
+    compressor: "Compressor",
+    max_dimension: Optional[int],
+    paths: Tuple[pathlib.Path, pathlib.Path],
+) -> CompressionResult:
+    """Run `compress_image` and report error as a result instead of raising.
+
+    This is a module level function so that it can be pickled to worker processes.
+
+    """
+    input_path, output_path = paths
+    try:
+        compressor.compress_image(input_path, output_path, max_dimension)
+    except Exception as e:
+        logger.error(f"failed to compress `{input_path}`: {e}")
+        return CompressionResult(input_path, output_path, error=str(e))
+    return CompressionResult(input_path, output_path)
+
+
+def _reduce(im: "Image.Image", max_dimension: int) -> "Image.Image":
+    """Shrink `im` so that its longer side fits `max_dimension`.
+
+    `reduce` shrinks by an integer factor with cheap box averaging first, so
+    the final resampling of `thumbnail` works on a small image.
+
+    """
+    factor: Final = max(im.size) // max_dimension
+    reduced: Final = im.reduce(factor) if factor >= 2 else im
+    reduced.thumbnail((max_dimension, max_dimension))
+    return reduced
+
+
+def derivative_key(
+    digest: str,
+    quality: int,
+    max_dimension: Optional[int],
+    image_format: str,
+    max_bytes: Optional[int] = None,
+) -> str:
+    """Return the cache key of an image compressed with the given parameters."""
+    size: Final = "full" if max_dimension is None else str(max_dimension)
+    budget: Final = "" if max_bytes is None else f"-b{max_bytes}"
+    return f"{digest}-q{quality}{budget}-{size}.{image_format}"
+
+
+def _encode_within(
+    im: "Image.Image", encoder: Encoder, max_quality: int, max_bytes: int
+) -> bytes:
+    """Encode `im` at the highest quality up to `max_quality` which fits `max_bytes`.
+
+    Quality is binary searched, so an image is encoded about log2(quality)
+    times at most. If even the lowest quality does not fit, its output is
+    returned. The lowest quality is 5, or `max_quality` if it is lower, so
+    `max_quality` is never exceeded.
+
+    """
+
+    def encode(quality: int) -> bytes:
+        buffer = BytesIO()
+        im.save(buffer, encoder.pillow_format, quality=quality, **encoder.options)
+        return buffer.getvalue()
+
+    best: Final = encode(max_quality)
+    if len(best) <= max_bytes:
+        return best
+
+    min_quality: Final = min(max_quality, _MIN_QUALITY)
+    low = min_quality
+    high = max_quality - 1
+    fitted: Optional[bytes] = None
+    while low <= high:
+        quality = (low + high) // 2
+        data = encode(quality)
+        if len(data) <= max_bytes:
+            fitted = data
+            low = quality + 1
+        else:
+            high = quality - 1
+
+    if fitted is None:
+        logger.warning(
+            f"image does not fit {max_bytes} bytes even at quality {min_quality}."
+        )
+        return best if min_quality == max_quality else encode(min_quality)
+    return fitted
+
 
 class Compressor:
+    """Compress images into jpeg, webp or avif images.
+
+    The output format is given per call (or by extension of output path)
+    and defaults to `image_format`. Quality defaults to `compress_quality`.
+    If `max_bytes` is given, quality is lowered until output fits it.
+    See `owan.domain.codecs` for formats and their codecs.
+
+    Images with more pixels than `max_pixels` are rejected before they are
+    decoded. For JPEG, the budget applies to the size decoded at reduced
+    scale when output is shrunk by `max_dimension`. Pillow has no strip
+    decoding for other formats, so they count at full size.
+
+    With `cache`, compressed images (derivatives) are cached by content
+    digest of input, quality, byte budget, max dimension and format, so
+    compressing the same image again costs no decode or encode.
+
+    """
+
     def __init__(
-        self, input_supported_extention: Set[str], compress_quality: int
+        self,
+        input_supported_extention: Set[str],
+        compress_quality: int,
+        max_dimension: Optional[int] = None,
+        cache: Optional[TieredCache] = None,
+        image_format: str = "jpeg",
+        max_pixels: Optional[int] = None,
     ) -> None:
         self.input_supported_extention: Final = input_supported_extention
         self.compress_quality: Final = compress_quality
+        self.max_dimension: Final = max_dimension
+        self.cache: Final = cache
+        self.encoder: Final = get_encoder(image_format)
+        self.max_pixels: Final = max_pixels
 
     def compress_image(
         self,
         input_path: pathlib.Path,
         output_path: pathlib.Path,
+        max_dimension: Optional[int] = None,
+        digest: Optional[str] = None,
+        quality: Optional[int] = None,
+        max_bytes: Optional[int] = None,
     ) -> None:
-        """Compress input image and save as jpeg image.
+        """Compress input image and save in the format of `output_path`.
+
+        If the image is larger than `max_dimension`, it is shrunk while
+        keeping aspect ratio. JPEG input is decoded at reduced scale by
+        `Image.draft`, so the full resolution image is never materialized.
+
+        The image is encoded straight into a temporary file next to
+        `output_path` which is then renamed, so `output_path` never holds a
+        partially written image.
+
+        Args:
+            input_path (pathlib.Path): A path of input image.
+            output_path (pathlib.Path): A path of output image. Its extension
+                selects the format (`.jpeg`, `.webp` or `.avif`).
+            max_dimension (Optional[int]): Max length of the longer side of
+                output image. If None, `self.max_dimension` is used.
+            digest (Optional[str]): SHA-256 hex digest of input image, used
+                as cache key. If None, it is computed when cache is enabled.
+            quality (Optional[int]): Encode quality. If None,
+                `self.compress_quality` is used.
+            max_bytes (Optional[int]): Byte budget of output. If given,
+                `quality` is the highest quality tried.
+
+        Raises:
+            ValueError: If `input_path` has unsupported extention
+                        or the format of `output_path` is not available.
+            ImageTooLargeError: If the image exceeds `self.max_pixels`.
+
+        """
+        self._check_input(input_path)
+        encoder: Final = encoder_for_extension(output_path.suffix)
+
+        if self.cache is not None or max_bytes is not None:
+            data: Final = self._encode_cached(
+                input_path, encoder, max_dimension, digest, quality, max_bytes
+            )
+            atomic_write(output_path, data)
+            return
+
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        partial_path: Final = unique_partial_path(output_path)
+
+        try:
+            with partial_path.open("wb") as f, COMPRESS_SECONDS.time():
+                self._encode(input_path, f, encoder, max_dimension, quality, None)
+            os.replace(str(partial_path), str(output_path))
+        finally:
+            if partial_path.exists():
+                partial_path.unlink()
+
+    def compress_to_bytes(
+        self,
+        input_path: pathlib.Path,
+        max_dimension: Optional[int] = None,
+        digest: Optional[str] = None,
+        image_format: Optional[str] = None,
+        quality: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+    ) -> memoryview:
+        """Compress input image in memory.
+
+        The result can be passed to `Storage.store_bytes` as is, so the
+        compressed image reaches storage without a temporary file.
 
         Args:
             input_path (pathlib.Path): A path of input image.
-            output_path (pathlib.Path): A path of output image.
+            max_dimension (Optional[int]): See `compress_image`.
+            digest (Optional[str]): See `compress_image`.
+            image_format (Optional[str]): A name of output format (`jpeg`,
+                `webp` or `avif`). If None, `self.encoder` is used.
+            quality (Optional[int]): See `compress_image`.
+            max_bytes (Optional[int]): See `compress_image`.
+
+        Return:
+            memoryview: Encoded image. It refers to the encode buffer
+                without copying it.
 
         Raises:
             ValueError: If `input_path` has unsupported extention
-                        or `output_path` is not jpeg file.
+                        or `image_format` is not available.
+            ImageTooLargeError: If the image exceeds `self.max_pixels`.
 
         """
+        self._check_input(input_path)
+        encoder: Final = (
+            self.encoder if image_format is None else get_encoder(image_format)
+        )
+        if self.cache is not None:
+            return memoryview(
+                self._encode_cached(
+                    input_path, encoder, max_dimension, digest, quality, max_bytes
+                )
+            )
+
+        buffer: Final = BytesIO()
+        with COMPRESS_SECONDS.time():
+            self._encode(input_path, buffer, encoder, max_dimension, quality, max_bytes)
+        return buffer.getbuffer()
+
+    def warm_up(self) -> None:
+        """Load Pillow plugins and codecs by encoding a tiny image."""
+        from PIL import Image
+
+        Image.init()
+        Image.new("RGB", (8, 8)).save(
+            BytesIO(), self.encoder.pillow_format, quality=self.compress_quality
+        )
+
+    def _check_input(self, input_path: pathlib.Path) -> None:
         extention: Final = input_path.suffix
         if extention not in self.input_supported_extention:
-            message = f"extension `{extention}` is not supported."
+            message: Final = f"extension `{extention}` is not supported."
             logger.error(message)
             raise ValueError(message)
 
-        if output_path.suffix != ".jpeg":
-            message = "output extension should be `.jpeg`."
-            logger.error(message)
-            raise ValueError(message)
+    def _encode_cached(
+        self,
+        input_path: pathlib.Path,
+        encoder: Encoder,
+        max_dimension: Optional[int],
+        digest: Optional[str],
+        quality: Optional[int],
+        max_bytes: Optional[int],
+    ) -> bytes:
+        if max_dimension is None:
+            max_dimension = self.max_dimension
+        if quality is None:
+            quality = self.compress_quality
 
-        with input_path.open(mode="rb") as f:
-            im: Final = (
-                Image.open(f).convert("RGB") if extention == ".png" else Image.open(f)
+        key: Optional[str] = None
+        if self.cache is not None:
+            key = derivative_key(
+                digest or file_digest(input_path),
+                quality,
+                max_dimension,
+                encoder.name,
+                max_bytes,
             )
-            im_io = BytesIO()
-            im.save(im_io, "JPEG", quality=self.compress_quality)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
 
-        output_path.parent.mkdir(parents=True, exist_ok=True)
+        buffer: Final = BytesIO()
+        with COMPRESS_SECONDS.time():
+            self._encode(input_path, buffer, encoder, max_dimension, quality, max_bytes)
+        data: Final = buffer.getvalue()
+        if self.cache is not None and key is not None:
+            self.cache.put(key, data)
+        return data
+
+    def _encode(
+        self,
+        input_path: pathlib.Path,
+        output: IO[bytes],
+        encoder: Encoder,
+        max_dimension: Optional[int],
+        quality: Optional[int],
+        max_bytes: Optional[int],
+    ) -> None:
+        if max_dimension is None:
+            max_dimension = self.max_dimension
+        if quality is None:
+            quality = self.compress_quality
+
+        # JPEG is decoded with DCT scaling. Result is still >= max_dimension.
+        draft_size: Final = (
+            None if max_dimension is None else (max_dimension, max_dimension)
+        )
+        with open_image(input_path, self.max_pixels, draft_size) as im:
+            out = im if im.mode in encoder.modes else im.convert("RGB")
+            if max_dimension is not None and max(out.size) > max_dimension:
+                out = _reduce(out, max_dimension)
+            if max_bytes is None:
+                out.save(
+                    output, encoder.pillow_format, quality=quality, **encoder.options
+                )
+            else:
+                output.write(_encode_within(out, encoder, quality, max_bytes))
+
+    def compress_many(
+        self,
+        paths: Sequence[Tuple[pathlib.Path, pathlib.Path]],
+        max_workers: Optional[int] = None,
+        max_dimension: Optional[int] = None,
+    ) -> List[CompressionResult]:
+        """Compress many images in parallel with a process pool.
+
+        Each process decodes and encodes its images independently, so all
+        cores are used regardless of the GIL. A failure of one image does not
+        stop the others and is reported in its result.
+
+        Args:
+            paths (Sequence[Tuple[pathlib.Path, pathlib.Path]]): Pairs of input
+                and output paths. See `compress_image` for details.
+            max_workers (Optional[int]): Number of processes. If None, the
+                number of CPUs is used.
+            max_dimension (Optional[int]): See `compress_image`.
+
+        Return:
+            List[CompressionResult]: Results in the same order as `paths`.
+
+        """
+        task: Final = functools.partial(_compress_task, self, max_dimension)
+        workers: Final = min(max_workers or os.cpu_count() or 1, len(paths))
+        if workers <= 1:
+            return [task(p) for p in paths]
 
-        with output_path.open(mode="wb") as f:
-            f.write(im_io.getvalue())
+        # Sending several images per message keeps IPC overhead low for large batches.
+        chunksize: Final = max(1, len(paths) // (workers * 4))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(task, paths, chunksize=chunksize))
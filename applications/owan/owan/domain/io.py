@@ -1,9 +1,13 @@
-import imghdr
+import contextlib
+import dataclasses
+import hashlib
 import logging
 import pathlib
-import shutil
 import sys
-from typing import Set
+import time
+import zipfile
+from io import BytesIO
+from typing import IO, TYPE_CHECKING, Iterator, Optional, Set, Tuple
 
 from starlette.datastructures import UploadFile
 
@@ -12,12 +16,151 @@ if sys.version_info >= (3, 8):
 else:
     from typing_extensions import Final
 
+from owan.libs.metrics import UPLOAD_SECONDS, VALIDATE_SECONDS
+
+if TYPE_CHECKING:
+    # Pillow is imported on first use, so that importing this module is fast.
+    from PIL import Image
+
 logger: Final = logging.getLogger("uvicorn")
 
+DEFAULT_CHUNK_SIZE: Final = 64 * 1024
+ARCHIVE_EXTENSIONS: Final = {".zip"}
+
+# Leading bytes of image formats and the format names.
+_SIGNATURES: Final = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+)
+
+
+class UploadTooLargeError(ValueError):
+    """Raised when an upload exceeds the configured size limit."""
+
+
+class ImageTooLargeError(UploadTooLargeError):
+    """Raised when an image has more pixels than the configured budget."""
+
+
+def configure_pixel_budget(max_pixels: int) -> None:
+    """Bound pixels of images which Pillow opens in this process.
+
+    Pillow warns above `max_pixels` and raises `DecompressionBombError`
+    above twice of it, for any image opened without `open_image` too.
+
+    """
+    from PIL import Image
+
+    Image.MAX_IMAGE_PIXELS = max_pixels
+
+
+def check_pixels(
+    size: Tuple[int, int], max_pixels: Optional[int], filename: str
+) -> None:
+    """Check that an image of `size` fits the pixel budget `max_pixels`.
+
+    Raises:
+        ImageTooLargeError: If the image has more pixels than `max_pixels`.
+
+    """
+    width, height = size
+    if max_pixels is not None and width * height > max_pixels:
+        message: Final = (
+            f"image `{filename}` has {width}x{height} pixels "
+            f"which exceeds {max_pixels} pixels."
+        )
+        logger.error(message)
+        raise ImageTooLargeError(message)
+
+
+@contextlib.contextmanager
+def open_image(
+    path: pathlib.Path,
+    max_pixels: Optional[int] = None,
+    draft_size: Optional[Tuple[int, int]] = None,
+) -> Iterator["Image.Image"]:
+    """Open image at `path` and check its pixel budget before decoding it.
+
+    Pillow reads only the header on open, so pixels are counted before any
+    pixel data is decoded. With `draft_size`, JPEG is set to decode at the
+    smallest DCT scale not smaller than `draft_size`, and the budget
+    applies to the scaled size. Other formats are decoded at full size.
+
+    Raises:
+        ImageTooLargeError: If the image (after scaling) exceeds `max_pixels`.
+
+    """
+    from PIL import Image
+
+    try:
+        im: Final = Image.open(path)
+    except Image.DecompressionBombError as e:
+        logger.error(str(e))
+        raise ImageTooLargeError(str(e))
+
+    with im:
+        if draft_size is not None and im.format == "JPEG":
+            im.draft(im.mode, draft_size)
+        check_pixels(im.size, max_pixels, path.name)
+        yield im
+
+
+@dataclasses.dataclass(frozen=True)
+class ImageInfo:
+    """What the header of an image tells without decoding it."""
+
+    format: str  # Lower case name, e.g. `png` or `jpeg`.
+    width: int
+    height: int
+
+
+@dataclasses.dataclass(frozen=True)
+class SavedUpload:
+    path: pathlib.Path
+    digest: str  # SHA-256 hex digest of the content.
+    size: int
+
+
+def _sniff_format(header: bytes) -> Optional[str]:
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    for signature, image_format in _SIGNATURES:
+        if header.startswith(signature):
+            return image_format
+    return None
+
+
+def _image_info(im: "Image.Image") -> ImageInfo:
+    return ImageInfo(format=str(im.format).lower(), width=im.size[0], height=im.size[1])
+
 
 class IoHandler:
-    def __init__(self) -> None:
-        pass
+    """Save and validate uploads.
+
+    Uploads are saved under `shard_depth` levels of subdirectories named by
+    a hash of the job id (e.g. `ab/cd/`), so that no single directory of the
+    input store grows too large.
+
+    Images with more pixels than `max_pixels` are rejected from their
+    header, before they are decoded anywhere.
+
+    """
+
+    def __init__(self, shard_depth: int = 0, max_pixels: Optional[int] = None) -> None:
+        self._shard_depth: Final = shard_depth
+        self._max_pixels: Final = max_pixels
+
+    def shard_directory(self, save_dir_path: pathlib.Path, job_id: str) -> pathlib.Path:
+        """Return a subdirectory of `save_dir_path` where input of `job_id` is saved."""
+        hexdigest: Final = hashlib.sha1(job_id.encode()).hexdigest()
+        return save_dir_path.joinpath(
+            *[hexdigest[2 * i : 2 * i + 2] for i in range(self._shard_depth)]
+        )
 
     def check_extension(
         self, filepath: pathlib.Path, supported: Set[str] = {".png", ".jpg", ".jpeg"}
@@ -43,55 +186,277 @@ class IoHandler:
         save_dir_path: pathlib.Path,
         job_id: str,
         dt_string: str,
-    ) -> pathlib.Path:
-        """Save `file` under `save_dir_path`.
+        supported: Optional[Set[str]] = None,
+        max_bytes: Optional[int] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> SavedUpload:
+        """Save `file` under `save_dir_path` chunk by chunk.
 
         Args:
             file (UploadFile): A file want to save.
             save_dir_path (pathlib.Path): A path to directory where file will be saved.
             job_id (str): A job id. This will used part of filename.
             dt_string (str): A datetime info. This will used part of filename.
+            supported (Optional[Set[str]]): A set of supported extentions.
+                If None, the content is not validated.
+            max_bytes (Optional[int]): Max size of the file in bytes.
+                If None, the size is not limited.
+            chunk_size (int): A size of chunk read from `file` at once.
+
+        Return:
+            SavedUpload: A path where file is saved with its digest and size.
+
+        Raises:
+            ValueError: If `file` is invalid or unsupported image.
+            UploadTooLargeError: If `file` is larger than `max_bytes`.
+            ImageTooLargeError: If the image exceeds the pixel budget.
+
+        """
+        try:
+            return self.save_stream(
+                file.file,
+                file.filename,
+                save_dir_path,
+                job_id,
+                dt_string,
+                supported=supported,
+                max_bytes=max_bytes,
+                chunk_size=chunk_size,
+            )
+        finally:
+            file.file.close()
+
+    def save_stream(
+        self,
+        source: IO[bytes],
+        filename: str,
+        save_dir_path: pathlib.Path,
+        job_id: str,
+        dt_string: str,
+        supported: Optional[Set[str]] = None,
+        max_bytes: Optional[int] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ) -> SavedUpload:
+        """Save binary stream `source` under `save_dir_path` chunk by chunk.
+
+        When `supported` is given, the first chunk is probed before anything
+        is written so that invalid or unsupported images are rejected early.
+        This saves copying them into the input store, but not receiving them:
+        an upload of Starlette is already spooled in full before the endpoint
+        runs, so `source` is read from that spool.
+        The content digest is computed on the same pass.
+        A partially written file is removed if saving fails.
+
+        Args:
+            source (IO[bytes]): A binary stream want to save.
+            filename (str): An original name of the file.
+            save_dir_path (pathlib.Path): A path to directory where file will be saved.
+            job_id (str): A job id. This will used part of filename.
+            dt_string (str): A datetime info. This will used part of filename.
+            supported (Optional[Set[str]]): A set of supported extentions.
+                If None, the content is not validated.
+            max_bytes (Optional[int]): Max size of the file in bytes.
+                If None, the size is not limited.
+            chunk_size (int): A size of chunk read from `source` at once.
 
         Return:
-            pathlib.Path: A path where file is saved.
+            SavedUpload: A path where file is saved with its digest and size.
+
+        Raises:
+            ValueError: If `source` is invalid or unsupported image.
+            UploadTooLargeError: If `source` is larger than `max_bytes`.
+            ImageTooLargeError: If the image exceeds the pixel budget.
 
         """
-        if not save_dir_path.exists():
-            save_dir_path.mkdir(parents=True, exist_ok=True)
+        shard_dir_path: Final = self.shard_directory(save_dir_path, job_id)
+        if not shard_dir_path.exists():
+            shard_dir_path.mkdir(parents=True, exist_ok=True)
 
-        save_path: Final = save_dir_path / f"{dt_string}_{job_id}_{file.filename}"
+        save_path: Final = shard_dir_path / f"{dt_string}_{job_id}_{filename}"
+        digest: Final = hashlib.sha256()
 
+        start: Final = time.perf_counter()
+        probed = False
         try:
+            chunk = source.read(chunk_size)
+            if supported is not None:
+                probed = self.probe_header(chunk, filename, supported) is not None
+
+            size = len(chunk)
             with save_path.open("wb") as f:
-                shutil.copyfileobj(file.file, f)
+                while chunk:
+                    if max_bytes is not None and size > max_bytes:
+                        message = f"file `{filename}` exceeds {max_bytes} bytes."
+                        logger.error(message)
+                        raise UploadTooLargeError(message)
+
+                    f.write(chunk)
+                    digest.update(chunk)
+                    chunk = source.read(chunk_size)
+                    size += len(chunk)
+
+            if supported is not None and not probed:
+                self._probe_file(save_path)
+        except Exception:
+            if save_path.exists():
+                save_path.unlink()
+            raise
         finally:
-            file.file.close()
+            UPLOAD_SECONDS.observe(time.perf_counter() - start)
 
-        return save_path
+        return SavedUpload(path=save_path, digest=digest.hexdigest(), size=size)
 
-    def validate_image(
+    def is_archive(self, filepath: pathlib.Path) -> bool:
+        """Return True if `filepath` has supported archive extention."""
+        return filepath.suffix in ARCHIVE_EXTENSIONS
+
+    def iter_archive_members(
+        self, file: UploadFile, max_members: int
+    ) -> Iterator[Tuple[str, IO[bytes]]]:
+        """Iterate image members of zip archive `file`.
+
+        Directories are skipped. Each yielded stream is closed when iteration
+        moves on to the next member.
+
+        Args:
+            file (UploadFile): A zip archive.
+            max_members (int): Max number of members in the archive.
+
+        Yields:
+            Tuple[str, IO[bytes]]: A name and binary stream of the member.
+
+        Raises:
+            ValueError: If `file` is invalid zip archive or has too many members.
+
+        """
+        try:
+            if not zipfile.is_zipfile(file.file):
+                message_invalid: Final = f"file `{file.filename}` is not zip archive."
+                logger.error(message_invalid)
+                raise ValueError(message_invalid)
+
+            with zipfile.ZipFile(file.file) as archive:
+                members: Final = [m for m in archive.infolist() if not m.is_dir()]
+                if len(members) > max_members:
+                    message_too_many: Final = (
+                        f"file `{file.filename}` has more than {max_members} members."
+                    )
+                    logger.error(message_too_many)
+                    raise ValueError(message_too_many)
+
+                for member in members:
+                    with archive.open(member) as source:
+                        yield pathlib.Path(member.filename).name, source
+        finally:
+            file.file.close()
+
+    def probe(
         self, filepath: pathlib.Path, supported: Set[str] = {".png", ".jpg", ".jpeg"}
-    ) -> None:
-        """Save `file` under `save_dir_path`.
+    ) -> ImageInfo:
+        """Validate image saved at `filepath` and return what its header tells.
+
+        Only the header is read. Pixel data is not decoded.
 
         Args:
             filepath (pathlib.Path): A path to target image.
             supported (Set[str]): A set of supported extentions.
 
+        Return:
+            ImageInfo: Format and dimensions of the image.
+
         Raises:
             ValueError: If image `filepath` is invalid or unsupported.
+            ImageTooLargeError: If the image exceeds the pixel budget.
 
         """
-        image_type: Final = imghdr.what(str(filepath))
-        if image_type is None:
-            message_invalid: Final = f"file `{str(filepath.name)}` seems to be invalid."
-            logger.error(message_invalid)
-            raise ValueError(message_invalid)
-
-        extention: Final = "." + image_type
-        if extention not in supported:
-            message_unsupported: Final = (
-                f"file `{str(filepath.name)}` has unsupported data type `{image_type}`."
-            )
-            logger.error(message_unsupported)
-            raise ValueError(message_unsupported)
+        with filepath.open("rb") as f:
+            header: Final = f.read(DEFAULT_CHUNK_SIZE)
+
+        info: Final = self.probe_header(header, filepath.name, supported)
+        return info if info is not None else self._probe_file(filepath)
+
+    def probe_header(
+        self,
+        header: bytes,
+        filename: str,
+        supported: Set[str] = {".png", ".jpg", ".jpeg"},
+    ) -> Optional[ImageInfo]:
+        """Validate image from its leading bytes and return what they tell.
+
+        The format is sniffed from the signature, and dimensions are parsed
+        from the header by Pillow without decoding pixels.
+
+        Args:
+            header (bytes): Leading bytes of target image.
+            filename (str): A name of target image. This is used for messages.
+            supported (Set[str]): A set of supported extentions.
+
+        Return:
+            Optional[ImageInfo]: None if the header is not within `header`
+                (e.g. JPEG with large metadata). Use `probe` on the whole file then.
+
+        Raises:
+            ValueError: If `header` is invalid or unsupported image.
+            ImageTooLargeError: If the image exceeds the pixel budget.
+
+        """
+        with VALIDATE_SECONDS.time():
+            image_type: Final = _sniff_format(header)
+            if image_type is None:
+                message_invalid: Final = f"file `{filename}` seems to be invalid."
+                logger.error(message_invalid)
+                raise ValueError(message_invalid)
+
+            if "." + image_type not in supported:
+                message_unsupported: Final = (
+                    f"file `{filename}` has unsupported data type `{image_type}`."
+                )
+                logger.error(message_unsupported)
+                raise ValueError(message_unsupported)
+
+            from PIL import Image
+
+            try:
+                with Image.open(BytesIO(header)) as im:
+                    info: Final = _image_info(im)
+            except Image.DecompressionBombError as e:
+                logger.error(str(e))
+                raise ImageTooLargeError(str(e))
+            except Exception:
+                logger.info(f"header of `{filename}` is beyond its leading bytes.")
+                return None
+
+        check_pixels((info.width, info.height), self._max_pixels, filename)
+        return info
+
+    def validate_image(
+        self, filepath: pathlib.Path, supported: Set[str] = {".png", ".jpg", ".jpeg"}
+    ) -> None:
+        """Validate image saved at `filepath`. See `probe`."""
+        self.probe(filepath, supported)
+
+    def validate_image_header(
+        self,
+        header: bytes,
+        filename: str,
+        supported: Set[str] = {".png", ".jpg", ".jpeg"},
+    ) -> None:
+        """Validate image from its leading bytes. See `probe_header`."""
+        self.probe_header(header, filename, supported)
+
+    def _probe_file(self, filepath: pathlib.Path) -> ImageInfo:
+        from PIL import Image
+
+        try:
+            with Image.open(filepath) as im:
+                info: Final = _image_info(im)
+        except Image.DecompressionBombError as e:
+            logger.error(str(e))
+            raise ImageTooLargeError(str(e))
+        except Exception:
+            message: Final = f"file `{filepath.name}` seems to be invalid."
+            logger.error(message)
+            raise ValueError(message)
+
+        check_pixels((info.width, info.height), self._max_pixels, filepath.name)
+        return info
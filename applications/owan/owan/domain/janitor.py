@@ -0,0 +1,130 @@
+import fcntl
+import logging
+import os
+import pathlib
+import sys
+import threading
+import time
+from typing import Optional
+
+if sys.version_info >= (3, 8):
+    from typing import Final
+else:
+    from typing_extensions import Final
+
+from owan.domain.payload import Payload, local_path
+
+logger: Final = logging.getLogger("uvicorn")
+
+_LOCK_FILENAME: Final = ".janitor.lock"
+
+
+class Janitor:
+    """Remove temporary inputs saved in the input store.
+
+    An input is released as soon as its job no longer needs it, and inputs
+    left behind (e.g. by crashed processes) are swept in background once
+    they are older than `ttl` seconds. Only files under `root` are removed.
+
+    `ttl` must be longer than jobs may wait in the queue, otherwise inputs
+    of pending jobs are swept.
+
+    Example usage:
+    >>> janitor = Janitor(root, ttl=24 * 60 * 60, sweep_interval=600)
+    >>> janitor.start()
+    >>> janitor.release(payload)  # When the job is done.
+    >>> janitor.close()
+
+    """
+
+    def __init__(
+        self, root: pathlib.Path, ttl: float, sweep_interval: float = 600.0
+    ) -> None:
+        self.root: Final = root
+        self._ttl: Final = ttl
+        self._sweep_interval: Final = sweep_interval
+        self._closed: Final = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def release(self, payload: Payload) -> None:
+        """Remove the input referred by `payload` if it is in the input store.
+
+        Inline and storage payloads do not refer to the input store, so they
+        are ignored.
+
+        """
+        path: Final = local_path(payload)
+        if path is not None:
+            self.discard(path)
+
+    def discard(self, path: pathlib.Path) -> None:
+        """Remove `path` if it is in the input store."""
+        if not self._is_managed(path):
+            return
+        try:
+            path.unlink()
+            logger.info(f"removed input `{path.name}`.")
+        except FileNotFoundError:
+            pass
+
+    def sweep(self) -> int:
+        """Remove inputs older than `ttl`. Return the number of removed files.
+
+        Only one process sweeps at a time; others return 0 immediately.
+
+        """
+        if not self.root.exists():
+            return 0
+
+        with (self.root / _LOCK_FILENAME).open("a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            return self._sweep()
+
+    def start(self) -> None:
+        """Start sweeping in background. This is no-op if `sweep_interval` is 0."""
+        if self._sweep_interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="owan-janitor", daemon=True
+        )
+        self._thread.start()
+
+    def close(self) -> None:
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _sweep(self) -> int:
+        deadline: Final = time.time() - self._ttl
+        removed = 0
+        for directory, _, filenames in os.walk(str(self.root)):
+            for filename in filenames:
+                if filename == _LOCK_FILENAME:
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    if os.stat(path).st_mtime < deadline:
+                        os.unlink(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass  # Released while sweeping.
+
+        if removed:
+            logger.info(f"swept {removed} stale inputs from `{self.root}`.")
+        return removed
+
+    def _run(self) -> None:
+        while not self._closed.wait(self._sweep_interval):
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("failed to sweep input store.")
+
+    def _is_managed(self, path: pathlib.Path) -> bool:
+        root: Final = self.root.resolve()
+        resolved: Final = path.resolve()
+        return resolved != root and root in resolved.parents
@@ -0,0 +1,190 @@
+import base64
+import enum
+import logging
+import os
+import pathlib
+import sys
+import threading
+import uuid
+from typing import Any, Callable, Dict, Optional, Union
+
+if sys.version_info >= (3, 8):
+    from typing import Final
+else:
+    from typing_extensions import Final
+
+from owan.libs.fs import atomic_write, file_digest
+from owan.libs.storage import Storage
+
+logger: Final = logging.getLogger("uvicorn")
+
+# A reference to an input image which is sent through the broker.
+# A plain string is a path on a filesystem shared by API and worker.
+Payload = Union[str, Dict[str, Any]]
+
+
+class Error(Exception):
+    pass
+
+
+class TransportMode(enum.Enum):
+    PATH = enum.auto()  # Send paths. API and worker must share a filesystem.
+    AUTO = enum.auto()  # Send small images inline and others as storage keys.
+
+
+class PayloadTransport:
+    """Pack input images into broker messages and unpack them on workers.
+
+    In `PATH` mode, a payload is the path of the image, so API and worker
+    must share a filesystem. In `AUTO` mode, images up to `inline_max_bytes`
+    are embedded in the message as base64, and larger ones are uploaded once
+    to `storage` under `key_prefix` and referred to by key. Keys are derived
+    from content digests, so the same image is uploaded and fetched once.
+
+    Workers fetch referred images lazily into `cache_directory`, which works
+    as a read-through cache bounded by `cache_max_bytes`.
+
+    Example usage:
+    >>> payload = transport.pack(image_path, digest)  # API
+    >>> image_path = transport.unpack(payload)  # Worker
+
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        mode: TransportMode = TransportMode.PATH,
+        inline_max_bytes: int = 256 * 1024,
+        key_prefix: str = "inputs",
+        cache_directory: Optional[pathlib.Path] = None,
+        cache_max_bytes: int = 1024 * 1024 * 1024,
+    ) -> None:
+        self._storage: Final = storage
+        self.mode: Final = mode
+        self._inline_max_bytes: Final = inline_max_bytes
+        self._key_prefix: Final = key_prefix
+        self._cache_directory: Final = cache_directory or pathlib.Path(
+            "./tmp/payload_cache"
+        )
+        self._cache_max_bytes: Final = cache_max_bytes
+        self._cache_lock: Final = threading.Lock()
+
+    def pack(self, image_path: pathlib.Path, digest: Optional[str] = None) -> Payload:
+        """Return a payload of `image_path` which can be sent through the broker.
+
+        This may upload the image, so call it out of the event loop.
+
+        Args:
+            image_path (pathlib.Path): A path of image to send.
+            digest (Optional[str]): SHA-256 hex digest of the image. If None,
+                it is computed from the file.
+
+        Raises:
+            Error: If the image could not be uploaded.
+
+        """
+        if self.mode == TransportMode.PATH:
+            return str(image_path)
+
+        content_digest: Final = digest or file_digest(image_path)
+        name: Final = image_path.name
+        if image_path.stat().st_size <= self._inline_max_bytes:
+            return {
+                "kind": "inline",
+                "name": name,
+                "digest": content_digest,
+                "data": base64.b64encode(image_path.read_bytes()).decode("ascii"),
+            }
+
+        key: Final = f"{self._key_prefix}/{content_digest}{image_path.suffix}"
+        try:
+            # The worker may fetch the object right after the message is sent,
+            # so it must not be spooled.
+            self._storage.store(image_path, key, write_behind=False)
+        except Exception:
+            message: Final = f"Failed to upload payload `{key}`."
+            logger.error(message)
+            raise Error(message)
+        return {"kind": "storage", "name": name, "digest": content_digest, "key": key}
+
+    def unpack(self, payload: Payload) -> pathlib.Path:
+        """Return a local path of the image referred by `payload`.
+
+        Raises:
+            Error: If `payload` is unknown or the image could not be fetched.
+
+        """
+        if isinstance(payload, str):
+            return pathlib.Path(payload)
+
+        kind: Final = payload.get("kind")
+        # Not packed anymore, but may still be queued by an earlier release.
+        if kind == "path":
+            return pathlib.Path(payload["path"])
+        if kind == "inline":
+            content: Final = base64.b64decode(payload["data"])
+            return self._cached(payload, lambda path: atomic_write(path, content))
+        if kind == "storage":
+            key: Final = payload["key"]
+            return self._cached(payload, lambda path: self._storage.fetch(key, path))
+
+        message: Final = f"Unknown payload kind `{kind}`."
+        logger.error(message)
+        raise Error(message)
+
+    def _cached(
+        self, payload: Dict[str, Any], fill: Callable[[pathlib.Path], None]
+    ) -> pathlib.Path:
+        suffix: Final = pathlib.Path(payload["name"]).suffix
+        path: Final = self._cache_directory / f"{payload['digest']}{suffix}"
+        if path.exists():
+            # Refresh mtime which is used as recency on eviction.
+            os.utime(str(path))
+            return path
+
+        logger.info(f"payload cache miss: `{path.name}`.")
+        # A unique partial path keeps concurrent fills of the same image apart.
+        partial_path: Final = path.with_name(f".{uuid.uuid4().hex}{suffix}")
+        try:
+            fill(partial_path)
+            os.replace(str(partial_path), str(path))
+        except Exception:
+            message: Final = f"Failed to unpack payload `{path.name}`."
+            logger.error(message)
+            raise Error(message)
+        finally:
+            if partial_path.exists():
+                partial_path.unlink()
+
+        self._evict(keep=path)
+        return path
+
+    def _evict(self, keep: pathlib.Path) -> None:
+        """Remove least recently used images until cache fits `cache_max_bytes`."""
+        with self._cache_lock:
+            entries = []
+            for entry in os.scandir(str(self._cache_directory)):
+                if entry.is_file() and not entry.name.startswith("."):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self._cache_max_bytes:
+                    break
+                if path == str(keep):
+                    continue
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass  # Evicted by another process.
+                total -= size
+
+
+def local_path(payload: Payload) -> Optional[pathlib.Path]:
+    """Return the path if `payload` refers to a file on a shared filesystem."""
+    if isinstance(payload, str):
+        return pathlib.Path(payload)
+    if payload.get("kind") == "path":
+        return pathlib.Path(payload["path"])
+    return None
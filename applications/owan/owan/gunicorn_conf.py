@@ -0,0 +1,10 @@
+"""
+Gunicorn server hooks. Use as `gunicorn -c python:owan.gunicorn_conf ...`.
+"""
+from typing import Any
+
+import owan.libs.metrics
+
+
+def child_exit(server: Any, worker: Any) -> None:
+    owan.libs.metrics.mark_process_dead(worker.pid)
@@ -0,0 +1,127 @@
+import concurrent.futures
+import logging
+import queue
+import sys
+import threading
+import time
+from typing import Callable, Generic, List, Optional, Sequence, Tuple, TypeVar
+
+if sys.version_info >= (3, 8):
+    from typing import Final
+else:
+    from typing_extensions import Final
+
+logger: Final = logging.getLogger("uvicorn")
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class Error(Exception):
+    pass
+
+
+class MicroBatcher(Generic[T, R]):
+    """Group items submitted from many threads into batched calls of `handler`.
+
+    A batch is handed to `handler` when it has `max_batch_size` items, or
+    when `max_wait` seconds have passed since its first item arrived.
+    Larger values give higher throughput at the cost of latency.
+    Results of `handler` are fanned out to the future of each item.
+
+    Example usage:
+    >>> batcher = MicroBatcher(model.predict_batch, max_batch_size=32, max_wait=0.02)
+    >>> batcher.submit(image).result()
+    >>> batcher.close()
+
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[List[T]], Sequence[R]],
+        max_batch_size: int,
+        max_wait: float,
+    ) -> None:
+        self._handler: Final = handler
+        self._max_batch_size: Final = max_batch_size
+        self._max_wait: Final = max_wait
+        self._queue: Final[
+            "queue.Queue[Optional[Tuple[T, concurrent.futures.Future[R]]]]"
+        ] = queue.Queue()
+        self._closed = False
+        self._lock: Final = threading.Lock()
+        self._thread: Final = threading.Thread(
+            target=self._run, name="owan-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, item: T) -> "concurrent.futures.Future[R]":
+        """Submit `item` to the next batch.
+
+        Raises:
+            Error: If the batcher is closed.
+
+        """
+        future: Final["concurrent.futures.Future[R]"] = concurrent.futures.Future()
+        with self._lock:
+            if self._closed:
+                raise Error("batcher is closed.")
+            self._queue.put((item, future))
+        return future
+
+    def close(self) -> None:
+        """Process items already submitted and stop the batching thread."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self) -> Tuple[List[Tuple[T, "concurrent.futures.Future[R]"]], bool]:
+        """Block until a batch is ready. Return it and whether to stop."""
+        first: Final = self._queue.get()
+        if first is None:
+            return [], True
+
+        batch: Final = [first]
+        deadline: Final = time.monotonic() + self._max_wait
+        while len(batch) < self._max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                entry = (
+                    self._queue.get(timeout=remaining)
+                    if remaining > 0
+                    else self._queue.get_nowait()
+                )
+            except queue.Empty:
+                break
+            if entry is None:
+                return batch, True
+            batch.append(entry)
+        return batch, False
+
+    def _run(self) -> None:
+        while True:
+            batch, stop = self._collect()
+            if batch:
+                self._handle(batch)
+            if stop:
+                return
+
+    def _handle(self, batch: List[Tuple[T, "concurrent.futures.Future[R]"]]) -> None:
+        futures: Final = [future for _, future in batch]
+        try:
+            results = self._handler([item for item, _ in batch])
+            if len(results) != len(batch):
+                raise Error(
+                    f"handler returned {len(results)} results for {len(batch)} items."
+                )
+        except Exception as e:
+            logger.error(f"failed to handle batch of {len(batch)} items.")
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        for future, result in zip(futures, results):
+            future.set_result(result)
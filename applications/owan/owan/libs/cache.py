@@ -0,0 +1,257 @@
+import collections
+import logging
+import os
+import pathlib
+import sys
+import threading
+from typing import Any, Dict, Optional
+
+if sys.version_info >= (3, 8):
+    from typing import Final
+else:
+    from typing_extensions import Final
+
+from owan.libs.fs import Bytes, atomic_write
+from owan.libs.metrics import CACHE_EVICTIONS_TOTAL, CACHE_LOOKUPS_TOTAL
+
+logger: Final = logging.getLogger("uvicorn")
+
+
+class MemoryLru:
+    """In-process LRU of byte strings bounded by their total size."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self._max_bytes: Final = max_bytes
+        self._entries: Final[
+            collections.OrderedDict[str, bytes]
+        ] = collections.OrderedDict()
+        self._size = 0
+        self._lock: Final = threading.Lock()
+        self.evictions = 0
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: bytes) -> int:
+        """Add `value` and evict least recently used entries to fit.
+
+        Values larger than the whole cache are not kept.
+
+        Return:
+            int: The number of evicted entries.
+
+        """
+        if len(value) > self._max_bytes:
+            return 0
+
+        evicted = 0
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = value
+            self._size += len(value)
+            while self._size > self._max_bytes:
+                _, dropped = self._entries.popitem(last=False)
+                self._size -= len(dropped)
+                evicted += 1
+            self.evictions += evicted
+        return evicted
+
+
+class DiskLru:
+    """Files in `directory` bounded by their total size.
+
+    Recency is kept as mtime, so entries survive restarts and can be shared
+    by processes on the same host. The total size is tracked in process and
+    the directory is rescanned only when it seems to exceed `max_bytes`.
+
+    """
+
+    def __init__(self, directory: pathlib.Path, max_bytes: int) -> None:
+        self.directory: Final = directory
+        self._max_bytes: Final = max_bytes
+        self._size: Optional[int] = None
+        self._lock: Final = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        path: Final = self.directory / key
+        try:
+            value: Final = path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+        try:
+            # Refresh mtime which is used as recency on eviction.
+            os.utime(str(path))
+        except FileNotFoundError:
+            pass  # Evicted by another process.
+        return value
+
+    def put(self, key: str, value: Bytes) -> int:
+        """Write `value` atomically and evict least recently used files to fit.
+
+        Return:
+            int: The number of evicted files.
+
+        """
+        if len(value) > self._max_bytes:
+            return 0
+
+        path: Final = self.directory / key
+        atomic_write(path, value)
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(value)
+            if self._size <= self._max_bytes:
+                return 0
+            evicted = self._evict(keep=path)
+            self.evictions += evicted
+            return evicted
+
+    def _scan_size(self) -> int:
+        return sum(
+            entry.stat().st_size
+            for entry in os.scandir(str(self.directory))
+            if entry.is_file() and not entry.name.startswith(".")
+        )
+
+    def _evict(self, keep: pathlib.Path) -> int:
+        entries = []
+        for entry in os.scandir(str(self.directory)):
+            if entry.is_file() and not entry.name.startswith("."):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            if path == str(keep):
+                continue
+            try:
+                os.unlink(path)
+                evicted += 1
+            except FileNotFoundError:
+                pass  # Evicted by another process.
+            total -= size
+        self._size = total
+        return evicted
+
+
+class TieredCache:
+    """Two-tier cache of byte strings: in-process LRU over an on-disk LRU.
+
+    Lookups try memory first, then disk. Disk hits are promoted to memory.
+    Either tier can be disabled, by `memory_max_bytes=0` or `directory=None`.
+    Hits, misses and evictions are counted in Prometheus metrics labeled
+    with `name`, and per instance in `stats`.
+
+    Keys are used as file names, so they must not contain path separators.
+
+    Example usage:
+    >>> cache = TieredCache("derivative", 64 * 1024 * 1024, pathlib.Path("./cache"))
+    >>> cache.put("key", b"value")
+    >>> cache.get("key")
+
+    """
+
+    def __init__(
+        self,
+        name: str,
+        memory_max_bytes: int,
+        directory: Optional[pathlib.Path] = None,
+        disk_max_bytes: int = 1024 * 1024 * 1024,
+    ) -> None:
+        self.name: Final = name
+        self._memory_max_bytes: Final = memory_max_bytes
+        self._directory: Final = directory
+        self._disk_max_bytes: Final = disk_max_bytes
+        self._init_tiers()
+
+    def _init_tiers(self) -> None:
+        self._memory = (
+            MemoryLru(self._memory_max_bytes) if self._memory_max_bytes > 0 else None
+        )
+        self._disk = (
+            DiskLru(self._directory, self._disk_max_bytes)
+            if self._directory is not None
+            else None
+        )
+        self._counts: Dict[str, int] = collections.Counter()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Locks and the memory tier stay in each process (e.g. pool workers).
+        return {
+            "name": self.name,
+            "_memory_max_bytes": self._memory_max_bytes,
+            "_directory": self._directory,
+            "_disk_max_bytes": self._disk_max_bytes,
+        }
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._init_tiers()
+
+    def get(self, key: str) -> Optional[bytes]:
+        if self._memory is not None:
+            value = self._memory.get(key)
+            if value is not None:
+                self._count("memory_hit")
+                return value
+
+        if self._disk is not None:
+            try:
+                value = self._disk.get(key)
+            except OSError as e:
+                logger.warning(f"failed to read `{key}` from {self.name} cache: {e}")
+                value = None
+            if value is not None:
+                self._count("disk_hit")
+                if self._memory is not None:
+                    self._evicted("memory", self._memory.put(key, value))
+                return value
+
+        self._count("miss")
+        return None
+
+    def put(self, key: str, value: Bytes) -> None:
+        if self._memory is not None:
+            self._evicted("memory", self._memory.put(key, bytes(value)))
+        if self._disk is not None:
+            try:
+                self._evicted("disk", self._disk.put(key, value))
+            except OSError as e:
+                logger.warning(f"failed to write `{key}` to {self.name} cache: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        """Return hits, misses and evictions of this instance, and memory usage."""
+        return {
+            "memory_hits": self._counts["memory_hit"],
+            "disk_hits": self._counts["disk_hit"],
+            "misses": self._counts["miss"],
+            "memory_evictions": self._counts["memory_eviction"],
+            "disk_evictions": self._counts["disk_eviction"],
+            "memory_bytes": self._memory.size if self._memory is not None else 0,
+        }
+
+    def _count(self, result: str) -> None:
+        self._counts[result] += 1
+        CACHE_LOOKUPS_TOTAL.labels(self.name, result).inc()
+
+    def _evicted(self, tier: str, count: int) -> None:
+        if count:
+            self._counts[f"{tier}_eviction"] += count
+            CACHE_EVICTIONS_TOTAL.labels(self.name, tier).inc(count)
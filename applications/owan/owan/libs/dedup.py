@@ -0,0 +1,187 @@
+import collections
+import logging
+import sys
+import threading
+import time
+from typing import Optional, Tuple
+
+if sys.version_info >= (3, 8):
+    from typing import Final
+else:
+    from typing_extensions import Final
+
+logger: Final = logging.getLogger("uvicorn")
+
+# Delete KEYS[1] only if its value is ARGV[1], atomically.
+_RELEASE_SCRIPT: Final = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+class LruIndex:
+    """Bounded in-process index from content digest to job id.
+
+    Entries older than `ttl` seconds are misses, so that a job whose result
+    has expired is not returned for a new upload.
+
+    """
+
+    def __init__(self, max_entries: int, ttl: Optional[float] = None) -> None:
+        self._max_entries: Final = max_entries
+        self._ttl: Final = ttl
+        # Job id and time of insertion by digest.
+        self._entries: Final[
+            collections.OrderedDict[str, Tuple[str, float]]
+        ] = collections.OrderedDict()
+        self._lock: Final = threading.Lock()
+
+    def _lookup(self, digest: str, now: float) -> Optional[str]:
+        entry: Final = self._entries.get(digest)
+        if entry is None:
+            return None
+
+        job_id, inserted_at = entry
+        if self._ttl is not None and now - inserted_at >= self._ttl:
+            del self._entries[digest]
+            return None
+
+        self._entries.move_to_end(digest)
+        return job_id
+
+    def get(self, digest: str) -> Optional[str]:
+        now: Final = time.monotonic()
+        with self._lock:
+            return self._lookup(digest, now)
+
+    def put(self, digest: str, job_id: str) -> None:
+        now: Final = time.monotonic()
+        with self._lock:
+            self._entries[digest] = (job_id, now)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def claim(self, digest: str, job_id: str) -> str:
+        """Record `job_id` for `digest` unless another job already has it.
+
+        Return:
+            str: The job id recorded for `digest`.
+
+        """
+        now: Final = time.monotonic()
+        with self._lock:
+            existing: Final = self._lookup(digest, now)
+            if existing is not None:
+                return existing
+
+            self._entries[digest] = (job_id, now)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            return job_id
+
+    def release(self, digest: str, job_id: str) -> None:
+        """Remove the entry of `digest` if it is still owned by `job_id`."""
+        with self._lock:
+            entry: Final = self._entries.get(digest)
+            if entry is not None and entry[0] == job_id:
+                del self._entries[digest]
+
+
+class RedisIndex:
+    """Index from content digest to job id shared between processes via Redis."""
+
+    def __init__(self, dsn: str, ttl: int, prefix: str = "owan:dedup:") -> None:
+        import redis
+
+        self._client: Final = redis.Redis.from_url(dsn)
+        self._ttl: Final = ttl
+        self._prefix: Final = prefix
+        self._release: Final = self._client.register_script(_RELEASE_SCRIPT)
+
+    def claim(self, digest: str, job_id: str) -> str:
+        """Record `job_id` for `digest` unless another job already has it.
+
+        Return:
+            str: The job id recorded for `digest`.
+
+        """
+        key: Final = self._prefix + digest
+        if self._client.set(key, job_id, nx=True, ex=self._ttl):
+            return job_id
+
+        existing: Final = self._client.get(key)
+        # The entry may expire between SET and GET.
+        return str(existing.decode()) if existing is not None else job_id
+
+    def release(self, digest: str, job_id: str) -> None:
+        """Remove the entry of `digest` if it is still owned by `job_id`."""
+        self._release(keys=[self._prefix + digest], args=[job_id])
+
+
+class ContentIndex:
+    """Two-tier index which detects uploads whose content was already received.
+
+    The in-process LRU tier answers repeated uploads without a network round
+    trip. The optional Redis tier shares entries between API workers.
+    A failure of Redis is logged and the LRU tier is used alone.
+
+    Example usage:
+    >>> index = ContentIndex(max_entries=1024, redis_dsn="redis://...", ttl=3600)
+    >>> index.claim(digest, job_id)  # `job_id` if first, otherwise existing one.
+
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        redis_dsn: Optional[str] = None,
+        ttl: int = 60 * 60,
+    ) -> None:
+        self._lru: Final = LruIndex(max_entries, ttl)
+        self._redis: Final = RedisIndex(redis_dsn, ttl) if redis_dsn else None
+
+    def claim(self, digest: str, job_id: str) -> str:
+        """Record `job_id` for `digest` unless another job already has it.
+
+        Args:
+            digest (str): A content digest of the upload.
+            job_id (str): A job id of the upload.
+
+        Return:
+            str: The job id recorded for `digest`. It differs from `job_id`
+                if the same content was already received.
+
+        """
+        existing: Final = self._lru.get(digest)
+        if existing is not None:
+            return existing
+
+        if self._redis is None:
+            return self._lru.claim(digest, job_id)
+
+        try:
+            claimed: Final = self._redis.claim(digest, job_id)
+        except Exception:
+            logger.warning("failed to access dedup index on Redis.")
+            return self._lru.claim(digest, job_id)
+
+        self._lru.put(digest, claimed)
+        return claimed
+
+    def release(self, digest: str, job_id: str) -> None:
+        """Forget the claim of `job_id`, e.g. when it failed to be enqueued.
+
+        Later uploads of the same content are then enqueued as new jobs.
+
+        """
+        self._lru.release(digest, job_id)
+        if self._redis is None:
+            return
+
+        try:
+            self._redis.release(digest, job_id)
+        except Exception:
+            logger.warning("failed to access dedup index on Redis.")
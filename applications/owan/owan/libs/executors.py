@@ -0,0 +1,145 @@
+"""
+Execution model of blocking work called from async endpoints.
+
+Blocking calls never run on the event loop. They are submitted to one of two
+bounded thread pools of the process:
+
+- `run_io`: network and disk bound calls (broker, Redis, S3, file I/O).
+- `run_cpu`: CPU bound calls (image decode and encode). Pillow releases the
+  GIL while it codes, so threads scale with cores for this work.
+
+Separate pools keep slow uploads from starving CPU work and vice versa.
+Pools are built on first use in each process, so they are not shared across
+forks.
+"""
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+if sys.version_info >= (3, 8):
+    from typing import Final
+else:
+    from typing_extensions import Final
+
+from owan.libs.metrics import EVENT_LOOP_LAG_SECONDS, EXECUTOR_WAIT_SECONDS
+
+logger: Final = logging.getLogger("uvicorn")
+
+T = TypeVar("T")
+
+_lock: Final = threading.Lock()
+_sizes: Dict[str, int] = {"io": 32, "cpu": os.cpu_count() or 1}
+_executors: Dict[str, concurrent.futures.ThreadPoolExecutor] = {}
+_executors_pid: Optional[int] = None
+
+
+def configure(io_workers: int, cpu_workers: Optional[int] = None) -> None:
+    """Set sizes of pools. Pools already built are rebuilt on next use."""
+    shutdown()
+    with _lock:
+        _sizes["io"] = io_workers
+        _sizes["cpu"] = cpu_workers or os.cpu_count() or 1
+
+
+def _get_executor(kind: str) -> concurrent.futures.ThreadPoolExecutor:
+    global _executors_pid
+
+    pid: Final = os.getpid()
+    with _lock:
+        if _executors_pid != pid:
+            # Threads of the parent do not exist in a forked child.
+            _executors.clear()
+            _executors_pid = pid
+        if kind not in _executors:
+            _executors[kind] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=_sizes[kind], thread_name_prefix=f"owan-{kind}"
+            )
+        return _executors[kind]
+
+
+def _timed(kind: str, fn: Callable[[], T]) -> Callable[[], T]:
+    submitted: Final = time.perf_counter()
+
+    def f() -> T:
+        EXECUTOR_WAIT_SECONDS.labels(kind).observe(time.perf_counter() - submitted)
+        return fn()
+
+    return f
+
+
+async def _run(kind: str, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    loop: Final = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        _get_executor(kind), _timed(kind, functools.partial(fn, *args, **kwargs))
+    )
+
+
+async def run_io(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run I/O bound `fn` in the I/O pool and wait for its result."""
+    return await _run("io", fn, *args, **kwargs)
+
+
+async def run_cpu(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Run CPU bound `fn` in the CPU pool and wait for its result."""
+    return await _run("cpu", fn, *args, **kwargs)
+
+
+def shutdown() -> None:
+    """Shut down pools of this process after running calls finish."""
+    with _lock:
+        executors: Final = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait=True)
+
+
+class StallMonitor:
+    """Detect stalls of the event loop caused by blocking calls on it.
+
+    A probe is scheduled every `interval` seconds. How late it runs is the
+    lag of the loop, which is recorded as a metric and logged with a warning
+    if it exceeds `threshold` seconds.
+
+    Example usage:
+    >>> monitor = StallMonitor(threshold=0.1)
+    >>> monitor.start()  # Inside the event loop.
+    >>> monitor.stop()
+
+    """
+
+    def __init__(self, threshold: float, interval: float = 0.5) -> None:
+        self._threshold: Final = threshold
+        self._interval: Final = interval
+        self._task: "Optional[asyncio.Future[None]]" = None
+        self.stalls = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        loop: Final = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + self._interval
+            await asyncio.sleep(self._interval)
+            self.observe(max(0.0, loop.time() - expected))
+
+    def observe(self, lag: float) -> None:
+        EVENT_LOOP_LAG_SECONDS.observe(lag)
+        if lag > self._threshold:
+            self.stalls += 1
+            logger.warning(
+                f"event loop stalled for {lag * 1000:.0f} ms. "
+                "Blocking call may run on the event loop."
+            )
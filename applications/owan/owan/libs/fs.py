@@ -0,0 +1,67 @@
+import hashlib
+import os
+import pathlib
+import shutil
+import sys
+import uuid
+from typing import IO, Union
+
+if sys.version_info >= (3, 8):
+    from typing import Final
+else:
+    from typing_extensions import Final
+
+# Types accepted as in-memory content by storage.
+Bytes = Union[bytes, bytearray, memoryview]
+
+_HASH_CHUNK_SIZE: Final = 64 * 1024
+
+
+def unique_partial_path(path: pathlib.Path) -> pathlib.Path:
+    """Return a hidden temporary path next to `path` to write it to.
+
+    The path is unique, so that concurrent writers of `path` do not share a
+    partial file.
+
+    """
+    return path.with_name(f".{path.name}.{uuid.uuid4().hex}.part")
+
+
+def atomic_write(
+    path: pathlib.Path, source: Union[Bytes, IO[bytes]], fsync: bool = False
+) -> None:
+    """Write `source` to `path` so that `path` is either absent or complete.
+
+    Content is written to a temporary file next to `path` which is then
+    renamed. Buffers are written without copying.
+
+    Args:
+        path (pathlib.Path): A path to write.
+        source (Union[Bytes, IO[bytes]]): Content or binary stream to write.
+        fsync (bool): If True, flush content to disk before renaming.
+
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial_path: Final = unique_partial_path(path)
+    try:
+        with partial_path.open("wb") as f:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                f.write(source)
+            else:
+                shutil.copyfileobj(source, f)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(str(partial_path), str(path))
+    finally:
+        if partial_path.exists():
+            partial_path.unlink()
+
+
+def file_digest(path: pathlib.Path) -> str:
+    """Return SHA-256 hex digest of the content of `path`."""
+    hasher: Final = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
@@ -0,0 +1,151 @@
+"""
+Metrics of API and worker exposed in Prometheus text format.
+
+Metrics are kept per process. To aggregate metrics of gunicorn workers or
+Celery prefork children, set `PROMETHEUS_MULTIPROC_DIR` to an empty
+directory shared by the processes before they start. Each process then
+writes its metrics there and `render` merges them.
+"""
+import logging
+import os
+import sys
+from typing import Optional, Tuple
+
+if sys.version_info >= (3, 8):
+    from typing import Final
+else:
+    from typing_extensions import Final
+
+import prometheus_client
+import prometheus_client.multiprocess
+
+logger: Final = logging.getLogger("uvicorn")
+
+# Finer than default buckets at the low end, where most hot-path steps are.
+_LATENCY_BUCKETS: Final = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    float("inf"),
+)
+
+UPLOAD_SECONDS: Final = prometheus_client.Histogram(
+    "owan_upload_read_seconds",
+    "Time to read, hash and save an upload into the input store.",
+    buckets=_LATENCY_BUCKETS,
+)
+VALIDATE_SECONDS: Final = prometheus_client.Histogram(
+    "owan_validate_image_seconds",
+    "Time to validate an image.",
+    buckets=_LATENCY_BUCKETS,
+)
+COMPRESS_SECONDS: Final = prometheus_client.Histogram(
+    "owan_compress_image_seconds",
+    "Time to compress an image.",
+    buckets=_LATENCY_BUCKETS,
+)
+ENQUEUE_SECONDS: Final = prometheus_client.Histogram(
+    "owan_enqueue_seconds",
+    "Time to publish a task to the broker.",
+    ["task"],
+    buckets=_LATENCY_BUCKETS,
+)
+QUEUE_WAIT_SECONDS: Final = prometheus_client.Histogram(
+    "owan_queue_wait_seconds",
+    "Time from publishing a task until a worker starts it.",
+    ["task"],
+    buckets=_LATENCY_BUCKETS,
+)
+TASK_RUN_SECONDS: Final = prometheus_client.Histogram(
+    "owan_task_run_seconds",
+    "Time to run a task on a worker.",
+    ["task", "state"],
+    buckets=_LATENCY_BUCKETS,
+)
+STORAGE_SECONDS: Final = prometheus_client.Histogram(
+    "owan_storage_seconds",
+    "Time of a storage operation per backend.",
+    ["backend", "operation"],
+    buckets=_LATENCY_BUCKETS,
+)
+STORAGE_FALLBACK_TOTAL: Final = prometheus_client.Counter(
+    "owan_storage_fallback_total",
+    "Storage operations which fell back from S3 to local storage.",
+    ["operation"],
+)
+EXECUTOR_WAIT_SECONDS: Final = prometheus_client.Histogram(
+    "owan_executor_wait_seconds",
+    "Time a blocking call waits for a thread of the pool.",
+    ["pool"],
+    buckets=_LATENCY_BUCKETS,
+)
+EVENT_LOOP_LAG_SECONDS: Final = prometheus_client.Histogram(
+    "owan_event_loop_lag_seconds",
+    "Delay of a periodic probe on the event loop.",
+    buckets=_LATENCY_BUCKETS,
+)
+CACHE_LOOKUPS_TOTAL: Final = prometheus_client.Counter(
+    "owan_cache_lookups_total",
+    "Cache lookups by result (`memory_hit`, `disk_hit` or `miss`).",
+    ["cache", "result"],
+)
+CACHE_EVICTIONS_TOTAL: Final = prometheus_client.Counter(
+    "owan_cache_evictions_total",
+    "Cache entries evicted to stay within size limits.",
+    ["cache", "tier"],
+)
+REJECTED_TOTAL: Final = prometheus_client.Counter(
+    "owan_rejected_requests_total",
+    "Requests or files rejected by the API.",
+    ["reason"],
+)
+
+
+def _multiprocess_dir() -> Optional[str]:
+    return os.getenv("PROMETHEUS_MULTIPROC_DIR") or os.getenv(
+        "prometheus_multiproc_dir"
+    )
+
+
+def _registry() -> prometheus_client.CollectorRegistry:
+    if _multiprocess_dir() is None:
+        return prometheus_client.REGISTRY
+
+    registry: Final = prometheus_client.CollectorRegistry()
+    prometheus_client.multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def render() -> Tuple[bytes, str]:
+    """Return metrics in Prometheus text format and its content type.
+
+    In multiprocess mode, metrics of every process are merged.
+
+    """
+    return prometheus_client.generate_latest(_registry()), (
+        prometheus_client.CONTENT_TYPE_LATEST
+    )
+
+
+def start_http_server(port: int) -> None:
+    """Serve metrics on `port` from a background thread (e.g. Celery worker)."""
+    logger.info(f"serve metrics on port `{port}`.")
+    prometheus_client.start_http_server(port, registry=_registry())
+
+
+def mark_process_dead(pid: int) -> None:
+    """Remove files of the exited process `pid` in multiprocess mode."""
+    if _multiprocess_dir() is not None:
+        prometheus_client.multiprocess.mark_process_dead(pid)
@@ -0,0 +1,162 @@
+import logging
+import math
+import sys
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+if sys.version_info >= (3, 8):
+    from typing import Final
+else:
+    from typing_extensions import Final
+
+logger: Final = logging.getLogger("uvicorn")
+
+# KEYS[1]: bucket key. ARGV: rate, burst, now, cost.
+# Return: seconds to wait (as string) until `cost` tokens are available, "0" if taken.
+_TOKEN_BUCKET_SCRIPT: Final = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+
+redis.call("HSET", KEYS[1], "tokens", tokens, "updated", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class LocalTokenBucket:
+    """Token buckets per client kept in process."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self._rate: Final = rate
+        self._burst: Final = burst
+        self._buckets: Final[Dict[str, Tuple[float, float]]] = {}
+        self._lock: Final = threading.Lock()
+
+    def acquire(self, client: str, cost: int = 1) -> float:
+        """Take `cost` tokens of `client`.
+
+        Return:
+            float: 0 if tokens are taken, otherwise seconds to wait.
+
+        """
+        now: Final = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(client, (self._burst, now))
+            tokens = min(self._burst, tokens + (now - updated) * self._rate)
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / self._rate
+            self._buckets[client] = (tokens, now)
+            # Full buckets carry no state, so they are dropped to bound memory.
+            if len(self._buckets) > 4096:
+                self._prune(now)
+            return wait
+
+    def _prune(self, now: float) -> None:
+        full_after: Final = self._burst / self._rate
+        for client, (_, updated) in list(self._buckets.items()):
+            if now - updated > full_after:
+                del self._buckets[client]
+
+
+class RedisTokenBucket:
+    """Token buckets per client shared between processes via Redis.
+
+    The bucket is updated atomically by a Lua script, so every API worker
+    sees the same state.
+
+    """
+
+    def __init__(
+        self, dsn: str, rate: float, burst: int, prefix: str = "owan:ratelimit:"
+    ) -> None:
+        import redis
+
+        self._client: Final = redis.Redis.from_url(
+            dsn, socket_timeout=0.5, socket_connect_timeout=0.5
+        )
+        self._script: Final = self._client.register_script(_TOKEN_BUCKET_SCRIPT)
+        self._rate: Final = rate
+        self._burst: Final = burst
+        self._prefix: Final = prefix
+
+    def acquire(self, client: str, cost: int = 1) -> float:
+        """Take `cost` tokens of `client`.
+
+        Return:
+            float: 0 if tokens are taken, otherwise seconds to wait.
+
+        """
+        wait: Final = self._script(
+            keys=[self._prefix + client],
+            args=[self._rate, self._burst, time.time(), cost],
+        )
+        return float(wait)
+
+
+class RateLimiter:
+    """Per-client token-bucket rate limiter.
+
+    Buckets are kept in Redis when `redis_dsn` is given, so that the limit
+    applies across API workers. A failure of Redis is logged and in-process
+    buckets are used instead. A non-positive `rate` disables the limiter.
+
+    Example usage:
+    >>> limiter = RateLimiter(rate=10.0, burst=20, redis_dsn="redis://...")
+    >>> limiter.acquire(client)  # 0 if allowed, otherwise seconds to wait.
+
+    """
+
+    def __init__(
+        self, rate: float, burst: int, redis_dsn: Optional[str] = None
+    ) -> None:
+        self.enabled: Final = rate > 0
+        self._local: Final = LocalTokenBucket(rate, burst) if self.enabled else None
+        self._redis: Final = (
+            RedisTokenBucket(redis_dsn, rate, burst)
+            if self.enabled and redis_dsn
+            else None
+        )
+
+    def acquire(self, client: str, cost: int = 1) -> float:
+        """Take `cost` tokens of `client`.
+
+        Args:
+            client (str): An identifier of the client (e.g. IP address).
+            cost (int): Number of tokens to take.
+
+        Return:
+            float: 0 if the request is allowed, otherwise seconds to wait.
+
+        """
+        if self._local is None:
+            return 0.0
+
+        if self._redis is not None:
+            try:
+                return self._redis.acquire(client, cost)
+            except Exception:
+                logger.warning("failed to access rate limiter on Redis.")
+        return self._local.acquire(client, cost)
+
+
+def retry_after(wait: float) -> int:
+    """Return `wait` seconds as a value of `Retry-After` header."""
+    return max(1, math.ceil(wait))
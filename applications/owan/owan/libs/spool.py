@@ -0,0 +1,255 @@
+import fcntl
+import heapq
+import itertools
+import json
+import logging
+import pathlib
+import random
+import sys
+import threading
+import time
+import uuid
+from typing import IO, Callable, List, Optional, Set, Tuple, Union
+
+if sys.version_info >= (3, 8):
+    from typing import Final
+else:
+    from typing_extensions import Final
+
+from owan.libs.fs import Bytes, atomic_write
+
+logger: Final = logging.getLogger("uvicorn")
+
+
+class Error(Exception):
+    pass
+
+
+class SpoolQueue:
+    """Write-behind queue which spools files locally and uploads them in background.
+
+    `put` returns once the file is atomically written to `directory`. Worker
+    threads upload spooled files with `upload` and delete them on success.
+    Failed uploads are retried with exponential backoff. Files left in
+    `directory` by a previous run (or another process) are picked up on
+    start and on every rescan, and an advisory lock on each entry keeps
+    processes sharing `directory` from uploading the same file twice.
+
+    `sweep`, if given, is called from the rescan thread on start and on every
+    rescan, e.g. to upload files which were stored elsewhere while uploads
+    were failing.
+
+    Each entry consists of `<id>.json` holding the key and `<id>.data`
+    holding the content. The data file is renamed into place last, so an
+    entry is visible only when it is complete.
+
+    Example usage:
+    >>> queue = SpoolQueue(pathlib.Path("./spool"), upload=s3_storage.store)
+    >>> queue.put(pathlib.Path("./image.png"), "jetson/image.png")
+    >>> queue.close()
+
+    """
+
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        upload: Callable[[pathlib.Path, str], None],
+        workers: int = 2,
+        backoff_base: float = 1.0,
+        backoff_max: float = 300.0,
+        rescan_interval: float = 60.0,
+        stale_age: float = 60.0 * 60.0,
+        sweep: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self.directory: Final = directory
+        self._upload: Final = upload
+        self._backoff_base: Final = backoff_base
+        self._backoff_max: Final = backoff_max
+        self._rescan_interval: Final = rescan_interval
+        self._stale_age: Final = stale_age
+        self._sweep: Final = sweep
+
+        # Heap of (due time, sequence, entry id, attempt).
+        self._pending: Final[List[Tuple[float, int, str, int]]] = []
+        self._scheduled: Final[Set[str]] = set()
+        self._sequence: Final = itertools.count()
+        self._condition: Final = threading.Condition()
+        self._closed = False
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.rescan()
+
+        self._threads: Final = [
+            threading.Thread(target=self._run, name=f"owan-spool-{i}", daemon=True)
+            for i in range(workers)
+        ] + [
+            threading.Thread(
+                target=self._run_rescan, name="owan-spool-rescan", daemon=True
+            )
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, file_path: pathlib.Path, key: str) -> None:
+        """Spool `file_path` to be uploaded as `key`.
+
+        Raises:
+            Error: If the file could not be spooled.
+
+        """
+        try:
+            f = file_path.open("rb")
+        except OSError:
+            message: Final = f"Failed to open `{file_path}`."
+            logger.error(message)
+            raise Error(message)
+
+        with f:
+            self.put_stream(f, key)
+
+    def put_stream(self, source: Union[Bytes, IO[bytes]], key: str) -> None:
+        """Spool content or binary stream `source` to be uploaded as `key`.
+
+        Raises:
+            Error: If the content could not be spooled.
+
+        """
+        entry_id: Final = uuid.uuid4().hex
+        meta_path, data_path = self._paths(entry_id)
+        try:
+            atomic_write(meta_path, json.dumps({"key": key}).encode())
+            atomic_write(data_path, source, fsync=True)
+        except Exception:
+            message: Final = f"Failed to spool `{key}`."
+            logger.error(message)
+            if meta_path.exists():
+                meta_path.unlink()
+            raise Error(message)
+
+        logger.info(f"spooled `{key}`.")
+        self._schedule(entry_id, attempt=0, delay=0.0)
+
+    def rescan(self) -> None:
+        """Schedule entries in `directory` which are not scheduled yet.
+
+        Leftovers of interrupted writes or deletes older than `stale_age` are removed.
+
+        """
+        now: Final = time.time()
+        for path in self.directory.iterdir():
+            if path.suffix == ".data" and not path.name.startswith("."):
+                self._schedule(path.stem, attempt=0, delay=0.0)
+                continue
+
+            is_orphan_meta = (
+                path.suffix == ".json" and not path.with_suffix(".data").exists()
+            )
+            if not (is_orphan_meta or path.suffix == ".part"):
+                continue
+
+            try:
+                if now - path.stat().st_mtime > self._stale_age:
+                    logger.info(f"remove stale spool file `{path.name}`.")
+                    path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def pending(self) -> int:
+        """Return the number of entries waiting to be uploaded by this queue."""
+        with self._condition:
+            return len(self._scheduled)
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Stop worker threads. Remaining entries are kept for the next start."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _paths(self, entry_id: str) -> Tuple[pathlib.Path, pathlib.Path]:
+        return (
+            self.directory / f"{entry_id}.json",
+            self.directory / f"{entry_id}.data",
+        )
+
+    def _schedule(self, entry_id: str, attempt: int, delay: float) -> None:
+        with self._condition:
+            if attempt == 0 and entry_id in self._scheduled:
+                return
+            self._scheduled.add(entry_id)
+            heapq.heappush(
+                self._pending,
+                (time.monotonic() + delay, next(self._sequence), entry_id, attempt),
+            )
+            self._condition.notify()
+
+    def _backoff(self, attempt: int) -> float:
+        delay: Final = min(
+            self._backoff_base * (1 << min(attempt, 30)), self._backoff_max
+        )
+        return delay + random.uniform(0.0, self._backoff_base)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._closed:
+                    now = time.monotonic()
+                    if self._pending and self._pending[0][0] <= now:
+                        break
+                    self._condition.wait(
+                        self._pending[0][0] - now if self._pending else None
+                    )
+                if self._closed:
+                    return
+                _, _, entry_id, attempt = heapq.heappop(self._pending)
+
+            if self._drain(entry_id):
+                with self._condition:
+                    self._scheduled.discard(entry_id)
+            else:
+                self._schedule(entry_id, attempt + 1, self._backoff(attempt))
+
+    def _run_rescan(self) -> None:
+        while True:
+            if self._sweep is not None:
+                try:
+                    self._sweep()
+                except Exception:
+                    logger.exception("failed to sweep. Retry on next rescan.")
+            with self._condition:
+                self._condition.wait(self._rescan_interval)
+                if self._closed:
+                    return
+            self.rescan()
+
+    def _drain(self, entry_id: str) -> bool:
+        """Upload the entry. Return False if it should be retried."""
+        meta_path, data_path = self._paths(entry_id)
+        try:
+            meta_file = meta_path.open("r")
+        except FileNotFoundError:
+            return True
+
+        with meta_file:
+            try:
+                fcntl.flock(meta_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another process is uploading it.
+                return True
+
+            if not data_path.exists():
+                return True
+
+            key: Final = json.load(meta_file)["key"]
+            try:
+                self._upload(data_path, key)
+            except Exception:
+                logger.warning(f"failed to upload spooled `{key}`. Retry later.")
+                return False
+
+            data_path.unlink()
+            meta_path.unlink()
+
+        logger.info(f"uploaded spooled `{key}`.")
+        return True
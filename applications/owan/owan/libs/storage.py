@@ -1,24 +1,73 @@
+import concurrent.futures
+import fcntl
+import io
 import logging
+import os
 import pathlib
-import shutil
 import sys
-from typing import Optional
+import threading
+from typing import IO, Any, Dict, List, Optional, Sequence, Tuple, Union
 
 if sys.version_info >= (3, 8):
     from typing import Final
 else:
     from typing_extensions import Final
 
-import boto3.exceptions
-import boto3.session
+import owan.libs.spool
+from owan.libs.fs import Bytes, atomic_write, unique_partial_path
+from owan.libs.metrics import STORAGE_FALLBACK_TOTAL, STORAGE_SECONDS
 
 logger: Final = logging.getLogger("uvicorn")
 
+_s3_clients_lock: Final = threading.Lock()
+_s3_clients: Final[Dict[Tuple[Any, ...], Any]] = {}
+
 
 class Error(Exception):
     pass
 
 
+def _s3_client(
+    access_key_id: str,
+    secret_key: str,
+    region_name: str,
+    endpoint_url: Optional[str],
+    max_pool_connections: int,
+) -> Any:
+    """Return a S3 client shared in the process.
+
+    boto3 clients are thread-safe, so one client and its connection pool are
+    reused by every S3Storage with the same parameters. Clients are not
+    shared across forked processes.
+
+    """
+    key: Final = (
+        os.getpid(),
+        access_key_id,
+        secret_key,
+        region_name,
+        endpoint_url,
+        max_pool_connections,
+    )
+    with _s3_clients_lock:
+        if key not in _s3_clients:
+            # boto3 is imported on first use so that processes without S3 start fast.
+            import boto3.session
+            import botocore.config
+
+            _s3_clients[key] = boto3.session.Session().client(
+                "s3",
+                aws_access_key_id=access_key_id,
+                aws_secret_access_key=secret_key,
+                region_name=region_name or None,
+                endpoint_url=endpoint_url or None,
+                config=botocore.config.Config(
+                    max_pool_connections=max_pool_connections
+                ),
+            )
+        return _s3_clients[key]
+
+
 class LocalStorage:
     """Provide access to Local Strage."""
 
@@ -36,14 +85,42 @@ class LocalStorage:
     ) -> None:
         logger.info(f"try to store local: `{file_path}` to `{key}`.")
         try:
-            save_path: Final = self.directory / key
-            save_path.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(file_path, save_path)
+            with STORAGE_SECONDS.labels("local", "store").time():
+                with file_path.open("rb") as f:
+                    atomic_write(self.directory / key, f)
+        except Exception:
+            message: Final = "Falied to store local storage."
+            logger.error(message)
+            raise Error(message)
+
+    def store_stream(self, source: Union[Bytes, IO[bytes]], key: str) -> None:
+        """Store content or binary stream `source` with a single atomic write."""
+        logger.info(f"try to store local: stream to `{key}`.")
+        try:
+            with STORAGE_SECONDS.labels("local", "store").time():
+                atomic_write(self.directory / key, source)
         except Exception:
             message: Final = "Falied to store local storage."
             logger.error(message)
             raise Error(message)
 
+    def fetch(self, key: str, destination: pathlib.Path) -> None:
+        """Copy the object `key` to `destination`.
+
+        Raises:
+            Error: If the object does not exist or copy failed.
+
+        """
+        logger.info(f"try to fetch local: `{key}` to `{destination}`.")
+        try:
+            with STORAGE_SECONDS.labels("local", "fetch").time():
+                with (self.directory / key).open("rb") as f:
+                    atomic_write(destination, f)
+        except Exception:
+            message: Final = "Falied to fetch from local storage."
+            logger.error(message)
+            raise Error(message)
+
 
 class S3Storage:
     """Provide access to Amazon S3."""
@@ -54,43 +131,165 @@ class S3Storage:
         secret_key: str,
         region_name: str,
         bucket_name: str,
+        endpoint_url: Optional[str] = None,
+        max_pool_connections: int = 32,
+        multipart_threshold: int = 8 * 1024 * 1024,
+        multipart_chunksize: int = 8 * 1024 * 1024,
+        max_concurrency: int = 10,
+        max_workers: int = 16,
     ) -> None:
         self._bucket_name: Final = bucket_name
         self._region_name: Final = region_name
-        self._bucket: Final = boto3.resource(
-            "s3",
-            aws_access_key_id=access_key_id,
-            aws_secret_access_key=secret_key,
-        ).Bucket(bucket_name)
+        self._client: Final = _s3_client(
+            access_key_id,
+            secret_key,
+            region_name,
+            endpoint_url,
+            max_pool_connections,
+        )
+        import boto3.s3.transfer
+
+        self._transfer_config: Final = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max_concurrency,
+        )
+        self._max_workers: Final = max_workers
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._executor_lock: Final = threading.Lock()
 
     def store(
         self,
         file_path: pathlib.Path,
         key: str,
     ) -> None:
-        """Store (upload) file-like object to S3.
+        """Store (upload) file to S3.
+
+        Files larger than the multipart threshold are uploaded in parts
+        concurrently.
 
         Args:
-            key (Key):
-            source (IO[bytes]):
-            content_type (str):
+            file_path (pathlib.Path): A path of file to upload.
+            key (str): A key of the object.
 
         Raises:
-            NoSuchBucketError: Bucket does not exist.
-            Error:
+            Error: If upload failed.
 
         """
         logger.info(f"try to store S3: `{file_path}` to `{key}`.")
         try:
-            self._bucket.upload_file(
-                Filename=str(file_path),
-                Key=key,
-            )
+            with STORAGE_SECONDS.labels("s3", "store").time():
+                self._client.upload_file(
+                    Filename=str(file_path),
+                    Bucket=self._bucket_name,
+                    Key=key,
+                    Config=self._transfer_config,
+                )
         except Exception:
             message: Final = "Falied to store S3."
             logger.error(message)
             raise Error(message)
 
+    def store_stream(self, source: Union[Bytes, IO[bytes]], key: str) -> None:
+        """Store (upload) content or binary stream `source` to S3.
+
+        Args:
+            source (Union[Bytes, IO[bytes]]): Content or binary stream to upload.
+            key (str): A key of the object.
+
+        Raises:
+            Error: If upload failed.
+
+        """
+        logger.info(f"try to store S3: stream to `{key}`.")
+        try:
+            with STORAGE_SECONDS.labels("s3", "store").time():
+                self._client.upload_fileobj(
+                    Fileobj=(
+                        io.BytesIO(source)
+                        if isinstance(source, (bytes, bytearray, memoryview))
+                        else source
+                    ),
+                    Bucket=self._bucket_name,
+                    Key=key,
+                    Config=self._transfer_config,
+                )
+        except Exception:
+            message: Final = "Falied to store S3."
+            logger.error(message)
+            raise Error(message)
+
+    def fetch(self, key: str, destination: pathlib.Path) -> None:
+        """Fetch (download) the object `key` to `destination`.
+
+        Large objects are downloaded in parts concurrently. `destination` is
+        either absent or complete even if download failed.
+
+        Raises:
+            Error: If download failed.
+
+        """
+        logger.info(f"try to fetch S3: `{key}` to `{destination}`.")
+        partial_path: Final = unique_partial_path(destination)
+        try:
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            with STORAGE_SECONDS.labels("s3", "fetch").time():
+                self._client.download_file(
+                    Bucket=self._bucket_name,
+                    Key=key,
+                    Filename=str(partial_path),
+                    Config=self._transfer_config,
+                )
+            os.replace(str(partial_path), str(destination))
+        except Exception:
+            message: Final = "Falied to fetch from S3."
+            logger.error(message)
+            raise Error(message)
+        finally:
+            if partial_path.exists():
+                partial_path.unlink()
+
+    def store_many(
+        self, items: Sequence[Tuple[pathlib.Path, str]]
+    ) -> List[Optional[Error]]:
+        """Store (upload) files to S3 concurrently.
+
+        Args:
+            items (Sequence[Tuple[pathlib.Path, str]]): Pairs of file path and key.
+
+        Return:
+            List[Optional[Error]]: Errors in the same order as `items`.
+                None means the file is stored.
+
+        """
+        futures: Final = [
+            self._get_executor().submit(self.store, file_path, key)
+            for file_path, key in items
+        ]
+
+        errors: Final[List[Optional[Error]]] = []
+        for future in futures:
+            error = future.exception()
+            errors.append(
+                error if error is None or isinstance(error, Error) else Error(error)
+            )
+        return errors
+
+    def close(self) -> None:
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    def _get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._max_workers,
+                    thread_name_prefix="owan-s3",
+                )
+            return self._executor
+
 
 class Storage:
     def __init__(
@@ -101,6 +300,14 @@ class Storage:
         s3_region_name: str,
         s3_bucket_name: str,
         local_only: bool = False,
+        s3_endpoint_url: Optional[str] = None,
+        s3_max_pool_connections: int = 32,
+        s3_multipart_threshold: int = 8 * 1024 * 1024,
+        s3_multipart_chunksize: int = 8 * 1024 * 1024,
+        s3_max_concurrency: int = 10,
+        s3_max_workers: int = 16,
+        spool_directory: Optional[pathlib.Path] = None,
+        spool_workers: int = 2,
     ) -> None:
         self._local_only: Final = local_only
         self._local_storage: Final = LocalStorage(local_directory)
@@ -110,8 +317,78 @@ class Storage:
             s3_region_name,
             s3_bucket_name,
             self._local_only,
+            endpoint_url=s3_endpoint_url,
+            max_pool_connections=s3_max_pool_connections,
+            multipart_threshold=s3_multipart_threshold,
+            multipart_chunksize=s3_multipart_chunksize,
+            max_concurrency=s3_max_concurrency,
+            max_workers=s3_max_workers,
+        )
+        self._spool = self._init_spool(spool_directory, spool_workers)
+
+    def _init_spool(
+        self, spool_directory: Optional[pathlib.Path], spool_workers: int
+    ) -> Optional[owan.libs.spool.SpoolQueue]:
+        if spool_directory is None or self._s3_storage is None:
+            return None
+
+        logger.info(f"init storage as write-behind mode. spool: `{spool_directory}`.")
+        return owan.libs.spool.SpoolQueue(
+            spool_directory,
+            self._s3_storage.store,
+            workers=spool_workers,
+            sweep=self._upload_fallback,
         )
 
+    def _upload_fallback(self) -> None:
+        """Upload files which fell back to local storage, then delete them.
+
+        The spool calls this on every rescan, so files stored locally while S3
+        was failing are not left there. Until a file is uploaded, `fetch`
+        finds it in local storage.
+
+        """
+        directory: Final = self._local_storage.directory
+        for path in sorted(directory.rglob("*")):
+            # Hidden files are partial writes.
+            if path.name.startswith(".") or not path.is_file():
+                continue
+            try:
+                self._upload_fallback_file(path, path.relative_to(directory).as_posix())
+            except Error:
+                logger.warning("failed to upload local fallback. Retry later.")
+                return
+
+    def _upload_fallback_file(self, path: pathlib.Path, key: str) -> None:
+        try:
+            f = path.open("rb")
+        except FileNotFoundError:
+            return
+
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another process is uploading it.
+                return
+
+            inode: Final = os.fstat(f.fileno()).st_ino
+            if not self._is_same_file(path, inode):
+                return
+            self._s3_storage.store(path, key)  # type: ignore
+            # Keep a newer file which replaced `path` during the upload.
+            if self._is_same_file(path, inode):
+                path.unlink()
+
+        logger.info(f"uploaded `{key}` which fell back to local storage.")
+
+    @staticmethod
+    def _is_same_file(path: pathlib.Path, inode: int) -> bool:
+        try:
+            return path.stat().st_ino == inode
+        except FileNotFoundError:
+            return False
+
     def _init_s3_storage(
         self,
         s3_access_key_id: str,
@@ -119,6 +396,7 @@ class Storage:
         s3_region_name: str,
         s3_bucket_name: str,
         local_only: bool,
+        **kwargs: Any,
     ) -> Optional[S3Storage]:
         if local_only:
             logger.info("init storage as local only mode.")
@@ -130,6 +408,7 @@ class Storage:
                 s3_secret_key,
                 s3_region_name,
                 s3_bucket_name,
+                **kwargs,
             )
         except Exception:
             logger.error("falied to initialize S3.")
@@ -139,14 +418,149 @@ class Storage:
         self,
         file_path: pathlib.Path,
         key: str,
+        write_behind: bool = True,
+        fallback_local: bool = True,
     ) -> None:
-        """Store file-like object."""
+        """Store file-like object.
+
+        In write-behind mode, this returns once the file is spooled locally
+        and the upload to S3 happens in background. Files which fall back to
+        local storage are uploaded in background, too. Pass `write_behind=False`
+        when the object must be fetchable as soon as this returns.
+
+        Pass `fallback_local=False` to raise instead of falling back to local
+        storage when S3 failed, e.g. when the caller retries by itself.
+
+        Raises:
+            Error: If the file could not be stored.
+
+        """
         logger.info(f"store data to storage. `self._local_only`: {self._local_only}.")
+        if self._spool is not None and write_behind:
+            try:
+                with STORAGE_SECONDS.labels("spool", "store").time():
+                    self._spool.put(file_path, key)
+                return
+            except Exception:
+                logger.warning("Try to spool but failed. Try to store directly.")
+
         if self._local_only:
             self._local_storage.store(file_path, key)
         else:
             try:
                 self._s3_storage.store(file_path, key)  # type: ignore
             except Exception:
+                if not fallback_local:
+                    message: Final = "Failed to store S3."
+                    logger.warning(message)
+                    raise Error(message)
                 logger.warn("Try to store S3 but failed. Try to store local storage.")
+                STORAGE_FALLBACK_TOTAL.labels("store").inc()
                 self._local_storage.store(file_path, key)
+
+    def store_bytes(self, data: Bytes, key: str) -> None:
+        """Store in-memory content `data` without writing a temporary file.
+
+        In write-behind mode, this returns once the content is spooled locally.
+
+        """
+        self.store_stream(data, key)
+
+    def store_stream(self, source: Union[Bytes, IO[bytes]], key: str) -> None:
+        """Store content or binary stream `source`.
+
+        Falling back to local storage after a failed S3 upload needs to read
+        `source` again, so a stream must be seekable to be stored locally.
+
+        """
+        logger.info(f"store stream to storage. `self._local_only`: {self._local_only}.")
+        if self._spool is not None:
+            try:
+                with STORAGE_SECONDS.labels("spool", "store").time():
+                    self._spool.put_stream(source, key)
+                return
+            except Exception:
+                logger.warning("Try to spool but failed. Try to store directly.")
+                self._rewind(source)
+
+        if self._local_only:
+            self._local_storage.store_stream(source, key)
+        else:
+            try:
+                self._s3_storage.store_stream(source, key)  # type: ignore
+            except Exception:
+                logger.warning(
+                    "Try to store S3 but failed. Try to store local storage."
+                )
+                STORAGE_FALLBACK_TOTAL.labels("store").inc()
+                self._rewind(source)
+                self._local_storage.store_stream(source, key)
+
+    def _rewind(self, source: Union[Bytes, IO[bytes]]) -> None:
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return
+        try:
+            source.seek(0)
+        except Exception:
+            message: Final = "Failed to rewind stream to retry storing."
+            logger.error(message)
+            raise Error(message)
+
+    def store_many(self, items: Sequence[Tuple[pathlib.Path, str]]) -> None:
+        """Store files concurrently. Files failed to store S3 are stored local.
+
+        Args:
+            items (Sequence[Tuple[pathlib.Path, str]]): Pairs of file path and key.
+
+        Raises:
+            Error: If some files could not be stored even in local storage.
+
+        """
+        logger.info(f"store {len(items)} data to storage.")
+        if self._spool is not None:
+            for file_path, key in items:
+                self.store(file_path, key)
+            return
+
+        errors: Final[List[Optional[Error]]] = (
+            [Error("S3 is not available.")] * len(items)
+            if self._local_only or self._s3_storage is None
+            else self._s3_storage.store_many(items)
+        )
+
+        for (file_path, key), error in zip(items, errors):
+            if error is None:
+                continue
+            if not self._local_only:
+                logger.warning(f"Try to store S3 but failed. Store `{key}` local.")
+                STORAGE_FALLBACK_TOTAL.labels("store").inc()
+            self._local_storage.store(file_path, key)
+
+    def fetch(self, key: str, destination: pathlib.Path) -> None:
+        """Fetch the object `key` to `destination`.
+
+        Objects which fell back to local storage when they were stored are
+        fetched from local storage.
+
+        Raises:
+            Error: If the object could not be fetched from any storage.
+
+        """
+        logger.info(f"fetch data from storage. `self._local_only`: {self._local_only}.")
+        if not self._local_only and self._s3_storage is not None:
+            try:
+                self._s3_storage.fetch(key, destination)
+                return
+            except Exception:
+                logger.warning(
+                    "Try to fetch S3 but failed. Try to fetch local storage."
+                )
+                STORAGE_FALLBACK_TOTAL.labels("fetch").inc()
+        self._local_storage.fetch(key, destination)
+
+    def close(self) -> None:
+        """Release connections and threads held by storage."""
+        if self._spool is not None:
+            self._spool.close()
+        if self._s3_storage is not None:
+            self._s3_storage.close()
@@ -3,7 +3,7 @@ import enum
 import os
 import pathlib
 import sys
-from typing import Set
+from typing import Dict, Optional, Set
 
 if sys.version_info >= (3, 8):
     from typing import Final
@@ -18,17 +18,58 @@ class SettingsError(Exception):
 @dataclasses.dataclass(frozen=True)
 class RedisSetting:
     dns: str
+    result_backend_dns: str
+    result_expires: int
+    pool_limit: int  # Max broker connections kept for publishing per process.
+    socket_timeout: float  # Seconds until a broker socket operation fails.
+    enqueue_timeout: float  # Seconds until an API request gives up enqueueing.
+
+
+@dataclasses.dataclass(frozen=True)
+class WorkerSetting:
+    pool: str  # One of `prefork`, `threads`, `gevent` (needs `gevent` extra) or `solo`.
+    concurrency: Optional[int]  # None means the number of CPUs.
+    prefetch_multiplier: int
+    acks_late: bool
+    time_limit: Optional[int]
+    soft_time_limit: Optional[int]
+    prediction_queue: str
+    storage_queue: str
+    warm_up: bool
+    ready_file: Optional[pathlib.Path]  # Created when worker is ready to consume.
+    # Micro-batching of predictions. Effective with `threads` or `gevent` pool.
+    predict_max_batch_size: int
+    predict_max_wait: float  # In seconds.
+    metrics_port: Optional[int]  # Port to serve metrics. None disables it.
 
 
 @dataclasses.dataclass(frozen=True)
 class InputStoreSetting:
     path: pathlib.Path
+    shard_depth: int  # Levels of hashed subdirectories.
+    ttl: int  # Seconds to keep inputs which are not released by jobs.
+    sweep_interval: int  # Seconds between sweeps. 0 disables sweeping.
+
+
+@dataclasses.dataclass(frozen=True)
+class OutputProfile:
+    image_format: str  # `jpeg`, `webp` or `avif`.
+    quality: int
+    max_bytes: Optional[int]  # Byte budget of output. None means no budget.
 
 
 @dataclasses.dataclass(frozen=True)
 class IoSetting:
     input_supported_extensions: Set[str]
     output_image_compress_quality: int
+    output_image_max_dimension: Optional[int]
+    output_image_format: str
+    output_image_max_bytes: Optional[int]
+    output_profiles: Dict[str, OutputProfile]  # Named profiles of clients.
+    max_image_pixels: int  # Images with more pixels are rejected before decode.
+    max_upload_bytes: int
+    upload_chunk_bytes: int
+    max_batch_files: int
 
 
 class StorageProvider(enum.Enum):
@@ -44,14 +85,71 @@ class StorageSettings:
     s3_secret_key: str
     s3_region_name: str
     s3_bucket_name: str
+    s3_endpoint_url: Optional[str]
+    s3_max_pool_connections: int
+    s3_multipart_threshold: int
+    s3_multipart_chunksize: int
+    s3_max_concurrency: int
+    s3_max_workers: int
+    spool_directory: Optional[pathlib.Path]
+    spool_workers: int
+
+
+@dataclasses.dataclass(frozen=True)
+class DedupSetting:
+    enabled: bool
+    max_entries: int
+    ttl: int  # Seconds to keep entries. Keep it within `result_expires`.
+    redis_dns: Optional[str]
+
+
+@dataclasses.dataclass(frozen=True)
+class PayloadSetting:
+    transport: str  # `PATH` or `AUTO`.
+    inline_max_bytes: int
+    cache_directory: pathlib.Path
+    cache_max_bytes: int
+
+
+@dataclasses.dataclass(frozen=True)
+class DerivativeCacheSetting:
+    memory_max_bytes: int  # 0 disables the in-process tier.
+    directory: Optional[pathlib.Path]  # None disables the on-disk tier.
+    disk_max_bytes: int
+
+
+@dataclasses.dataclass(frozen=True)
+class AdmissionSetting:
+    enabled: bool
+    max_queue_depth: int  # 0 disables the check.
+    max_inflight_bytes: int  # Per API process. 0 disables the check.
+    min_free_disk_bytes: int  # Of the input store. 0 disables the check.
+    retry_after: int  # Seconds sent with 503.
+    cache_ttl: float  # Seconds to reuse queue depth and free disk.
+    rate_limit: float  # Requests per second per client address. 0 disables it.
+    rate_limit_burst: int
+    rate_limit_redis_dns: Optional[str]
+
+
+@dataclasses.dataclass(frozen=True)
+class ApiSetting:
+    io_workers: int  # Threads for blocking I/O of each API process.
+    cpu_workers: Optional[int]  # Threads for CPU bound work. None means CPU count.
+    loop_stall_threshold: float  # Seconds of event loop lag which is logged.
 
 
 @dataclasses.dataclass(frozen=True)
 class Settings:
     redis: RedisSetting
+    worker: WorkerSetting
     input_store: InputStoreSetting
     io: IoSetting
     storage: StorageSettings
+    dedup: DedupSetting
+    payload: PayloadSetting
+    derivative_cache: DerivativeCacheSetting
+    admission: AdmissionSetting
+    api: ApiSetting
 
 
 def load_storage_settings() -> StorageSettings:
@@ -66,18 +164,161 @@ def load_storage_settings() -> StorageSettings:
         s3_secret_key=os.getenv("STORAGE_S3_SECRET_KEY", ""),
         s3_region_name=(os.getenv("STORAGE_S3_REGION_NAME", "")),
         s3_bucket_name=os.getenv("STORAGE_S3_BUCKET_NAME", ""),
+        s3_endpoint_url=os.getenv("STORAGE_S3_ENDPOINT_URL") or None,
+        s3_max_pool_connections=int(os.getenv("STORAGE_S3_MAX_POOL_CONNECTIONS", "32")),
+        s3_multipart_threshold=int(
+            os.getenv("STORAGE_S3_MULTIPART_THRESHOLD", str(8 * 1024 * 1024))
+        ),
+        s3_multipart_chunksize=int(
+            os.getenv("STORAGE_S3_MULTIPART_CHUNKSIZE", str(8 * 1024 * 1024))
+        ),
+        s3_max_concurrency=int(os.getenv("STORAGE_S3_MAX_CONCURRENCY", "10")),
+        s3_max_workers=int(os.getenv("STORAGE_S3_MAX_WORKERS", "16")),
+        spool_directory=(
+            pathlib.Path(os.environ["STORAGE_SPOOL_DIRECTORY"])
+            if os.getenv("STORAGE_SPOOL_DIRECTORY")
+            else None
+        ),
+        spool_workers=int(os.getenv("STORAGE_SPOOL_WORKERS", "2")),
     )
 
 
+def _optional_int(name: str) -> Optional[int]:
+    value: Final = os.getenv(name)
+    return int(value) if value else None
+
+
+def _optional_path(name: str) -> Optional[pathlib.Path]:
+    value: Final = os.getenv(name)
+    return pathlib.Path(value) if value else None
+
+
+def _output_profiles(value: str) -> Dict[str, OutputProfile]:
+    """Parse profiles such as `thumbnail=webp:60:51200,archive=jpeg:85`.
+
+    Each profile is `<name>=<format>:<quality>[:<max bytes>]`.
+
+    Raises:
+        SettingsError: If `value` is malformed.
+
+    """
+    profiles: Final[Dict[str, OutputProfile]] = {}
+    for item in filter(None, (item.strip() for item in value.split(","))):
+        name, _, spec = item.partition("=")
+        fields = spec.split(":")
+        if not name or len(fields) not in (2, 3):
+            raise SettingsError(f"invalid output profile `{item}`.")
+        try:
+            profiles[name] = OutputProfile(
+                image_format=fields[0].lower(),
+                quality=int(fields[1]),
+                max_bytes=int(fields[2]) if len(fields) == 3 else None,
+            )
+        except ValueError:
+            raise SettingsError(f"invalid output profile `{item}`.")
+    return profiles
+
+
 def settings() -> Settings:
     return Settings(
-        redis=RedisSetting(dns=os.getenv("REDIS_DSN", "redis://redis/0")),
+        redis=RedisSetting(
+            dns=os.getenv("REDIS_DSN", "redis://redis/0"),
+            result_backend_dns=os.getenv(
+                "RESULT_BACKEND_DSN", os.getenv("REDIS_DSN", "redis://redis/0")
+            ),
+            result_expires=int(os.getenv("RESULT_EXPIRES", str(24 * 60 * 60))),
+            pool_limit=int(os.getenv("BROKER_POOL_LIMIT", "10")),
+            socket_timeout=float(os.getenv("BROKER_SOCKET_TIMEOUT_MS", "2000")) / 1000,
+            enqueue_timeout=float(os.getenv("ENQUEUE_TIMEOUT_MS", "3000")) / 1000,
+        ),
+        worker=WorkerSetting(
+            pool=os.getenv("WORKER_POOL", "prefork"),
+            concurrency=_optional_int("WORKER_CONCURRENCY"),
+            prefetch_multiplier=int(os.getenv("WORKER_PREFETCH_MULTIPLIER", "1")),
+            acks_late=os.getenv("TASK_ACKS_LATE", "true").lower() == "true",
+            time_limit=_optional_int("TASK_TIME_LIMIT"),
+            soft_time_limit=_optional_int("TASK_SOFT_TIME_LIMIT"),
+            prediction_queue=os.getenv("PREDICTION_QUEUE", "prediction"),
+            storage_queue=os.getenv("STORAGE_QUEUE", "storage"),
+            warm_up=os.getenv("WORKER_WARM_UP", "true").lower() == "true",
+            ready_file=(
+                pathlib.Path(os.environ["WORKER_READY_FILE"])
+                if os.getenv("WORKER_READY_FILE")
+                else None
+            ),
+            predict_max_batch_size=int(os.getenv("PREDICT_MAX_BATCH_SIZE", "1")),
+            predict_max_wait=float(os.getenv("PREDICT_MAX_WAIT_MS", "20")) / 1000,
+            metrics_port=_optional_int("WORKER_METRICS_PORT"),
+        ),
         input_store=InputStoreSetting(
-            path=pathlib.Path(os.getenv("INPUT_STORE_DIR_PATH", "./tmp/input_store"))
+            path=pathlib.Path(os.getenv("INPUT_STORE_DIR_PATH", "./tmp/input_store")),
+            shard_depth=int(os.getenv("INPUT_STORE_SHARD_DEPTH", "2")),
+            ttl=int(os.getenv("INPUT_STORE_TTL", str(24 * 60 * 60))),
+            sweep_interval=int(os.getenv("INPUT_STORE_SWEEP_INTERVAL", "600")),
         ),
         io=IoSetting(
             input_supported_extensions={".png", ".jpg", ".jpeg"},
-            output_image_compress_quality=30,
+            output_image_compress_quality=int(
+                os.getenv("OUTPUT_IMAGE_COMPRESS_QUALITY", "30")
+            ),
+            output_image_max_dimension=_optional_int("OUTPUT_IMAGE_MAX_DIMENSION"),
+            output_image_format=os.getenv("OUTPUT_IMAGE_FORMAT", "jpeg").lower(),
+            output_image_max_bytes=_optional_int("OUTPUT_IMAGE_MAX_BYTES"),
+            output_profiles=_output_profiles(os.getenv("OUTPUT_PROFILES", "")),
+            max_image_pixels=int(os.getenv("MAX_IMAGE_PIXELS", str(50 * 1000 * 1000))),
+            max_upload_bytes=int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024))),
+            upload_chunk_bytes=int(os.getenv("UPLOAD_CHUNK_BYTES", str(64 * 1024))),
+            max_batch_files=int(os.getenv("MAX_BATCH_FILES", "500")),
         ),
         storage=load_storage_settings(),
+        dedup=DedupSetting(
+            enabled=os.getenv("DEDUP_ENABLED", "false").lower() == "true",
+            max_entries=int(os.getenv("DEDUP_MAX_ENTRIES", "4096")),
+            ttl=int(os.getenv("DEDUP_TTL", str(60 * 60))),
+            redis_dns=os.getenv("DEDUP_REDIS_DSN", os.getenv("REDIS_DSN")),
+        ),
+        payload=PayloadSetting(
+            transport=os.getenv("PAYLOAD_TRANSPORT", "PATH").upper(),
+            inline_max_bytes=int(
+                os.getenv("PAYLOAD_INLINE_MAX_BYTES", str(256 * 1024))
+            ),
+            cache_directory=pathlib.Path(
+                os.getenv("PAYLOAD_CACHE_DIR_PATH", "./tmp/payload_cache")
+            ),
+            cache_max_bytes=int(
+                os.getenv("PAYLOAD_CACHE_MAX_BYTES", str(1024 * 1024 * 1024))
+            ),
+        ),
+        derivative_cache=DerivativeCacheSetting(
+            memory_max_bytes=int(
+                os.getenv("DERIVATIVE_CACHE_MEMORY_MAX_BYTES", str(64 * 1024 * 1024))
+            ),
+            directory=_optional_path("DERIVATIVE_CACHE_DIR_PATH"),
+            disk_max_bytes=int(
+                os.getenv("DERIVATIVE_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024))
+            ),
+        ),
+        admission=AdmissionSetting(
+            enabled=os.getenv("ADMISSION_ENABLED", "true").lower() == "true",
+            max_queue_depth=int(os.getenv("ADMISSION_MAX_QUEUE_DEPTH", "10000")),
+            max_inflight_bytes=int(
+                os.getenv("ADMISSION_MAX_INFLIGHT_BYTES", str(512 * 1024 * 1024))
+            ),
+            min_free_disk_bytes=int(
+                os.getenv("ADMISSION_MIN_FREE_DISK_BYTES", str(512 * 1024 * 1024))
+            ),
+            retry_after=int(os.getenv("ADMISSION_RETRY_AFTER", "5")),
+            cache_ttl=float(os.getenv("ADMISSION_CACHE_TTL", "1.0")),
+            rate_limit=float(os.getenv("RATE_LIMIT_PER_SECOND", "0")),
+            rate_limit_burst=int(os.getenv("RATE_LIMIT_BURST", "20")),
+            rate_limit_redis_dns=os.getenv(
+                "RATE_LIMIT_REDIS_DSN", os.getenv("REDIS_DSN")
+            ),
+        ),
+        api=ApiSetting(
+            io_workers=int(os.getenv("API_IO_WORKERS", "32")),
+            cpu_workers=_optional_int("API_CPU_WORKERS"),
+            loop_stall_threshold=float(os.getenv("LOOP_STALL_THRESHOLD_MS", "100"))
+            / 1000,
+        ),
     )
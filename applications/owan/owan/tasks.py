@@ -1,8 +1,13 @@
+import functools
 import logging
 import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
 import celery
 import celery.result
+import celery.signals
+import kombu
 
 if sys.version_info >= (3, 8):
     from typing import Final
@@ -10,36 +15,187 @@ else:
     from typing_extensions import Final
 
 import owan.bootstrap
+import owan.domain.payload
+import owan.libs.storage
 import owan.settings
+from owan.domain.payload import Payload
+from owan.libs.metrics import ENQUEUE_SECONDS
 
 logger: Final = logging.getLogger("uvicorn")
 
 
-def _predict() -> None:
-    with owan.bootstrap.domain(owan.settings.settings()) as domain:
-        domain.task_worker.predict()
+@functools.lru_cache()
+def _get_settings() -> owan.settings.Settings:
+    return owan.settings.settings()
 
 
-def _test_predict(image_path: str) -> None:
-    with owan.bootstrap.domain(owan.settings.settings()) as domain:
-        domain.task_worker.test_predict(image_path, domain.storage)
+def _predict(image: Optional[Payload] = None) -> Any:
+    domain: Final = owan.bootstrap.shared_domain(_get_settings())
+    image_path: Final = None if image is None else str(domain.payload.unpack(image))
+    return domain.task_worker.predict(image_path)
+
+
+def _test_predict(image: Payload) -> str:
+    domain: Final = owan.bootstrap.shared_domain(_get_settings())
+    key: Final = domain.task_worker.test_predict(str(domain.payload.unpack(image)))
+    # Storing is I/O bound, so it is handed to the storage queue. The payload
+    # is passed on because the storage worker may run on another host.
+    domain.task_queue.store(image, key)
+    return key
+
+
+def _store(task: celery.Task, image: Payload, key: str) -> None:
+    domain: Final = owan.bootstrap.shared_domain(_get_settings())
+    # Failure of S3 is raised so that Celery retries with backoff. The last
+    # attempt falls back to local storage, because the input is then released.
+    domain.task_worker.store(
+        str(domain.payload.unpack(image)),
+        key,
+        domain.storage,
+        fallback_local=task.request.retries >= task.max_retries,
+    )
+
+
+def _release_input(
+    task: celery.Task,
+    status: str,
+    retval: Any,
+    task_id: str,
+    args: Tuple[Any, ...],
+    kwargs: Dict[str, Any],
+    einfo: Any,
+) -> None:
+    """Remove the input of a task once it succeeded or finally failed.
+
+    Celery does not call this when the task is retried, so the input is kept
+    for the next attempt.
+
+    """
+    image: Final = args[0] if args else kwargs.get("image")
+    if image is None:
+        return
+
+    domain: Final = owan.bootstrap.shared_domain(_get_settings())
+    if domain.janitor is not None:
+        domain.janitor.release(image)
 
 
 class TaskQueue:
     """Provide method which is executable through task queue."""
 
     def __init__(self, celeryapp: celery.Celery) -> None:
-        self._predict: Final = celeryapp.task(_predict)
+        self._celeryapp: Final = celeryapp
+        self._predict: Final = celeryapp.task(_predict, after_return=_release_input)
+        # Input of `_test_predict` is released by `_store` which it enqueues.
         self._test_predict: Final = celeryapp.task(_test_predict)
+        self._store: Final = celeryapp.task(
+            _store,
+            bind=True,
+            autoretry_for=(owan.libs.storage.Error, owan.domain.payload.Error),
+            retry_backoff=True,
+            max_retries=5,
+            after_return=_release_input,
+        )
+
+    def predict(
+        self, image: Optional[Payload] = None, job_id: Optional[str] = None
+    ) -> celery.result.AsyncResult:
+        """Wrapper of Celery task. Execute prediction.
 
-    def predict(self) -> celery.result.AsyncResult:
-        """Wrapper of Celery task. Execute prediction."""
-        return self._predict.delay()
+        Args:
+            image (Optional[Payload]): A payload (or path) of image to predict.
+                See `owan.domain.payload.PayloadTransport`.
+            job_id (Optional[str]): A job id used as task id. If None, Celery
+                generates it.
 
-    def test_predict(self, image_path: str) -> celery.result.AsyncResult:
-        """Wrapper of Celery task. Execute test prediction."""
+        """
+        with ENQUEUE_SECONDS.labels("predict").time():
+            return self._predict.apply_async((image,), task_id=job_id)
+
+    def predict_batch(
+        self, jobs: List[Tuple[str, Payload]]
+    ) -> celery.result.GroupResult:
+        """Wrapper of Celery task. Execute predictions as one Celery group.
+
+        Args:
+            jobs (List[Tuple[str, Payload]]): Pairs of job id and image payload.
+                Each job id is used as task id of the prediction.
+
+        Return:
+            celery.result.GroupResult: A result whose id identifies the batch.
+
+        """
+        logger.info(f"Enqueue predict_batch with {len(jobs)} jobs.")
+        with ENQUEUE_SECONDS.labels("predict_batch").time():
+            # All tasks are published with one producer (and connection)
+            # taken from the pool instead of one per task.
+            with self._celeryapp.producer_or_acquire() as producer:
+                return celery.group(
+                    self._predict.signature((image,), task_id=job_id)
+                    for job_id, image in jobs
+                ).apply_async(producer=producer)
+
+    def test_predict(
+        self, image: Payload, job_id: Optional[str] = None
+    ) -> celery.result.AsyncResult:
+        """Wrapper of Celery task. Execute test prediction.
+
+        Args:
+            image (Payload): A payload (or path) of image to predict.
+            job_id (Optional[str]): A job id used as task id. If None, Celery
+                generates it.
+
+        """
         logger.info("Enqueue test_predict.")
-        return self._test_predict.delay(image_path)
+        with ENQUEUE_SECONDS.labels("test_predict").time():
+            return self._test_predict.apply_async((image,), task_id=job_id)
+
+    def store(self, image: Payload, key: str) -> celery.result.AsyncResult:
+        """Wrapper of Celery task. Store image. Failures are retried with backoff."""
+        logger.info("Enqueue store.")
+        with ENQUEUE_SECONDS.labels("store").time():
+            return self._store.delay(image, key)
+
+    def job(self, job_id: str) -> celery.result.AsyncResult:
+        """Return the result handle of the task whose id is `job_id`.
+
+        Unknown job ids are reported as `PENDING` by Celery.
+
+        """
+        return celery.result.AsyncResult(job_id, app=self._celeryapp)
+
+    def queue_depth(self, queue: Optional[str] = None) -> int:
+        """Return the number of messages waiting in `queue` on the broker.
+
+        Args:
+            queue (Optional[str]): A queue name. If None, the default queue.
+
+        """
+        name: Final = queue or self._celeryapp.conf.task_default_queue
+        with self._celeryapp.pool.acquire(block=True) as connection:
+            try:
+                return int(
+                    connection.default_channel.queue_declare(
+                        queue=name, passive=True
+                    ).message_count
+                )
+            except connection.channel_errors:
+                # Some transports drop empty queues.
+                return 0
+
+    def connect(self) -> None:
+        """Open a pooled broker connection ahead of the first enqueue.
+
+        Raises:
+            kombu.exceptions.OperationalError: If the broker is unreachable.
+
+        """
+        with self._celeryapp.producer_or_acquire() as producer:
+            producer.connection.ensure_connection(max_retries=1)
+
+    def close(self) -> None:
+        """Close broker connections held by the underlying Celery app."""
+        self._celeryapp.close()
 
 
 class Factory:
@@ -52,8 +208,95 @@ class Factory:
     Worker example usage:
     >>> app = Factory(broker="redis://...").worker
 
+    Task results are kept only when `backend` is given:
+    >>> broker = Factory(broker="redis://...", backend="redis://...").broker
+    >>> broker.job(job_id).state
+
+    Publishing reuses connections from a pool of `pool_limit` connections.
+    With `socket_timeout`, a publish to an unresponsive broker fails after
+    about that many seconds instead of blocking:
+    >>> broker = Factory(broker="redis://...", socket_timeout=2.0).broker
+
+    Pool, limits and queues of worker are configured by `worker_settings`.
+    Prediction tasks and storage tasks are routed to separate queues, so
+    they can be consumed by workers with different pool and concurrency:
+    >>> $ celery --app owan.worker worker -Q prediction
+    >>> $ WORKER_POOL=threads celery --app owan.worker worker -Q storage
+
     """
 
-    def __init__(self, broker: str) -> None:
-        self.worker: Final = celery.Celery(broker=broker)
+    def __init__(
+        self,
+        broker: str,
+        backend: Optional[str] = None,
+        result_expires: int = 24 * 60 * 60,
+        worker_settings: Optional[owan.settings.WorkerSetting] = None,
+        pool_limit: int = 10,
+        socket_timeout: Optional[float] = None,
+    ) -> None:
+        self.worker: Final = celery.Celery(broker=broker, backend=backend)
+        self.worker.conf.update(
+            task_track_started=True,
+            result_expires=result_expires,
+            broker_pool_limit=pool_limit,
+        )
+        if socket_timeout is not None:
+            self.worker.conf.update(_publish_conf(socket_timeout))
+        if worker_settings is not None:
+            self.worker.conf.update(_worker_conf(worker_settings))
         self.broker: Final = TaskQueue(self.worker)
+
+
+def _publish_conf(socket_timeout: float) -> Dict[str, Any]:
+    return {
+        "broker_connection_timeout": socket_timeout,
+        "broker_transport_options": {
+            "socket_timeout": socket_timeout,
+            "socket_connect_timeout": socket_timeout,
+        },
+        # Celery retries a failed publish. Retry once right away, so that a
+        # stale pooled connection is replaced, but do not wait for the broker.
+        "task_publish_retry_policy": {
+            "max_retries": 1,
+            "interval_start": 0,
+            "interval_step": 0,
+            "interval_max": 0,
+        },
+    }
+
+
+def _worker_conf(settings: owan.settings.WorkerSetting) -> Dict[str, Any]:
+    prediction_queue: Final = settings.prediction_queue
+    storage_queue: Final = settings.storage_queue
+    return {
+        "worker_pool": settings.pool,
+        "worker_concurrency": settings.concurrency,
+        "worker_prefetch_multiplier": settings.prefetch_multiplier,
+        "task_acks_late": settings.acks_late,
+        # Requeue tasks whose worker process was killed instead of losing them.
+        "task_reject_on_worker_lost": settings.acks_late,
+        "task_time_limit": settings.time_limit,
+        "task_soft_time_limit": settings.soft_time_limit,
+        "task_default_queue": prediction_queue,
+        "task_queues": (
+            kombu.Queue(prediction_queue, routing_key=prediction_queue),
+            kombu.Queue(storage_queue, routing_key=storage_queue),
+        ),
+        "task_routes": {
+            "owan.tasks._predict": {"queue": prediction_queue},
+            "owan.tasks._test_predict": {"queue": prediction_queue},
+            "owan.tasks._store": {"queue": storage_queue},
+        },
+    }
+
+
+# Header carrying the time when a task is published. Workers measure queue
+# wait from it, so clocks of API and worker hosts are assumed to be in sync.
+PUBLISHED_AT_HEADER: Final = "owan_published_at"
+
+
+def _on_before_task_publish(headers: Dict[str, Any], **kwargs: Any) -> None:
+    headers.setdefault(PUBLISHED_AT_HEADER, time.time())
+
+
+celery.signals.before_task_publish.connect(_on_before_task_publish)
@@ -0,0 +1,255 @@
+import dataclasses
+import logging
+import pathlib
+import shutil
+import sys
+import threading
+import time
+from typing import Callable, Iterable, List, Optional, Tuple
+
+if sys.version_info >= (3, 8):
+    from typing import Final
+else:
+    from typing_extensions import Final
+
+import fastapi
+from fastapi.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+import owan.bootstrap
+import owan.settings
+from owan.libs.executors import run_io
+from owan.libs.metrics import REJECTED_TOTAL
+from owan.libs.ratelimit import RateLimiter, retry_after
+
+logger: Final = logging.getLogger("uvicorn")
+
+# Endpoints which accept uploads and enqueue jobs.
+ADMISSION_PATHS: Final = ("/predict", "/predict/test", "/predict/batch")
+
+
+@dataclasses.dataclass(frozen=True)
+class Rejection:
+    status_code: int
+    reason: str  # Label of metrics.
+    detail: str
+    retry_after: int
+
+
+class AdmissionController:
+    """Decide whether an upload is admitted before its body is read.
+
+    An upload is rejected with 429 if its client exceeds the rate limit, and
+    with 503 if the prediction queue is too deep, too many upload bytes are
+    in flight in this process, or the input store is short of free disk.
+    Queue depth and free disk are cached for `cache_ttl` seconds, so they
+    cost no round trip on most requests.
+
+    Example usage:
+    >>> rejection = controller.admit(client, content_length)
+    >>> if rejection is None:
+    ...     try:
+    ...         handle_request()
+    ...     finally:
+    ...         controller.release(content_length)
+
+    """
+
+    def __init__(
+        self,
+        settings: owan.settings.AdmissionSetting,
+        input_store: pathlib.Path,
+        max_upload_bytes: int,
+        queue_depth: Callable[[], int],
+    ) -> None:
+        self._settings: Final = settings
+        self._input_store: Final = input_store
+        self._max_upload_bytes: Final = max_upload_bytes
+        self._queue_depth: Final = queue_depth
+        self._rate_limiter: Final = RateLimiter(
+            settings.rate_limit,
+            settings.rate_limit_burst,
+            redis_dsn=settings.rate_limit_redis_dns,
+        )
+        self._lock: Final = threading.Lock()
+        self._inflight_bytes = 0
+        self._cached_queue_depth: Tuple[float, int] = (-float("inf"), 0)
+        self._cached_free_disk: Tuple[float, Optional[int]] = (-float("inf"), None)
+
+    def admit(self, client: str, content_length: Optional[int]) -> Optional[Rejection]:
+        """Admit an upload, reserving its size as in-flight bytes.
+
+        This may access Redis and the broker, so call it out of the event loop.
+
+        Args:
+            client (str): An identifier of the client.
+            content_length (Optional[int]): `Content-Length` of the request.
+                None if unknown (e.g. chunked transfer).
+
+        Return:
+            Optional[Rejection]: None if admitted. Call `release` once the
+                request is handled.
+
+        """
+        wait: Final = self._rate_limiter.acquire(client)
+        if wait > 0:
+            return Rejection(429, "rate_limit", "Too many requests.", retry_after(wait))
+
+        max_queue_depth: Final = self._settings.max_queue_depth
+        if max_queue_depth > 0 and self._get_queue_depth() >= max_queue_depth:
+            return self._unavailable("queue_full", "Prediction queue is full.")
+
+        min_free_disk: Final = self._settings.min_free_disk_bytes
+        free_disk: Final = self._get_free_disk() if min_free_disk > 0 else None
+        if free_disk is not None and free_disk < min_free_disk:
+            return self._unavailable("disk_full", "Input store is short of disk space.")
+
+        size: Final = self._reserved_size(content_length)
+        with self._lock:
+            max_inflight: Final = self._settings.max_inflight_bytes
+            # An upload is always admitted when nothing is in flight, so that
+            # one larger than the limit is not rejected forever.
+            if (
+                max_inflight > 0
+                and self._inflight_bytes > 0
+                and self._inflight_bytes + size > max_inflight
+            ):
+                return self._unavailable("inflight", "Too many uploads in flight.")
+            self._inflight_bytes += size
+        return None
+
+    def release(self, content_length: Optional[int]) -> None:
+        with self._lock:
+            self._inflight_bytes -= self._reserved_size(content_length)
+
+    @property
+    def inflight_bytes(self) -> int:
+        return self._inflight_bytes
+
+    def _reserved_size(self, content_length: Optional[int]) -> int:
+        # Unknown size is reserved as the largest upload allowed.
+        if content_length is None:
+            return self._max_upload_bytes
+        return content_length
+
+    def _unavailable(self, reason: str, detail: str) -> Rejection:
+        logger.warning(f"reject upload: {detail}")
+        return Rejection(503, reason, detail, self._settings.retry_after)
+
+    def _get_queue_depth(self) -> int:
+        now: Final = time.monotonic()
+        updated, depth = self._cached_queue_depth
+        if now - updated < self._settings.cache_ttl:
+            return depth
+
+        try:
+            depth = self._queue_depth()
+        except Exception:
+            # Enqueueing fails anyway if the broker is down.
+            logger.warning("failed to get queue depth. skip the check.")
+            depth = 0
+        self._cached_queue_depth = (now, depth)
+        return depth
+
+    def _get_free_disk(self) -> Optional[int]:
+        now: Final = time.monotonic()
+        updated, free = self._cached_free_disk
+        if now - updated < self._settings.cache_ttl:
+            return free
+
+        try:
+            free = shutil.disk_usage(str(self._existing_parent(self._input_store))).free
+        except OSError:
+            logger.warning("failed to get free disk of input store. skip the check.")
+            free = None
+        self._cached_free_disk = (now, free)
+        return free
+
+    @staticmethod
+    def _existing_parent(path: pathlib.Path) -> pathlib.Path:
+        for candidate in [path, *path.parents]:
+            if candidate.exists():
+                return candidate
+        return path
+
+
+class AdmissionMiddleware:
+    """ASGI middleware which applies `AdmissionController` to upload endpoints.
+
+    Rejected requests are answered before the body is read. Clients sending
+    `Expect: 100-continue` do not upload the body at all.
+
+    Clients are rate limited by the address in `scope["client"]`. uvicorn
+    takes it from `X-Forwarded-For` only if the peer is listed in
+    `FORWARDED_ALLOW_IPS` (gunicorn `--forwarded-allow-ips`), so behind a
+    reverse proxy set it to the addresses of the proxy. Otherwise every
+    client behind the proxy shares one bucket.
+
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        controller: AdmissionController,
+        paths: Iterable[str] = ADMISSION_PATHS,
+    ) -> None:
+        self._app: Final = app
+        self._controller: Final = controller
+        self._paths: Final = frozenset(paths)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or scope["path"] not in self._paths
+        ):
+            await self._app(scope, receive, send)
+            return
+
+        client: Final = scope["client"][0] if scope.get("client") else "unknown"
+        content_length: Final = _content_length(scope["headers"])
+        rejection: Final = await run_io(self._controller.admit, client, content_length)
+        if rejection is not None:
+            REJECTED_TOTAL.labels(rejection.reason).inc()
+            response = JSONResponse(
+                {"detail": rejection.detail},
+                status_code=rejection.status_code,
+                headers={"Retry-After": str(rejection.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+
+        try:
+            await self._app(scope, receive, send)
+        finally:
+            self._controller.release(content_length)
+
+
+def _content_length(headers: List[Tuple[bytes, bytes]]) -> Optional[int]:
+    for name, value in headers:
+        if name == b"content-length":
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+def add_admission(app: fastapi.FastAPI, settings: owan.settings.Settings) -> None:
+    """Install admission control on upload endpoints of `app`."""
+    if not settings.admission.enabled:
+        logger.info("admission control is disabled.")
+        return
+
+    prediction_queue: Final = settings.worker.prediction_queue
+    controller: Final = AdmissionController(
+        settings.admission,
+        settings.input_store.path,
+        settings.io.max_upload_bytes,
+        lambda: int(
+            owan.bootstrap.shared_domain(settings).task_queue.queue_depth(
+                prediction_queue
+            )
+        ),
+    )
+    app.add_middleware(AdmissionMiddleware, controller=controller)
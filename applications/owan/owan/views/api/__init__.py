@@ -2,11 +2,7 @@ import functools
 import logging
 import pathlib
 import sys
-from io import BytesIO
-from typing import Iterator
-
-import boto3
-from PIL import Image
+from typing import List, Optional
 
 if sys.version_info >= (3, 8):
     from typing import Final
@@ -14,15 +10,24 @@ else:
     from typing_extensions import Final
 
 import fastapi
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 
 import owan.bootstrap
 import owan.domain
+import owan.libs.executors
+import owan.libs.metrics
 import owan.settings
 from owan.views.api._lib import (
+    _claim_job,
+    _enqueue,
     _generate_job_id,
     _get_datetime_now_string,
+    _job_status,
+    _output_profile,
+    _pack_payloads,
+    _predict_batch_preprocess,
     _predict_preprocess,
+    _wait_job_status,
 )
 
 logger: Final = logging.getLogger("uvicorn")
@@ -35,9 +40,47 @@ def get_settings() -> owan.settings.Settings:
 
 def _domain_factory(
     settings: owan.settings.Settings = fastapi.Depends(get_settings),
-) -> Iterator[owan.domain.Domain]:
-    with owan.bootstrap.domain(settings) as domain:
-        yield domain
+) -> owan.domain.Domain:
+    return owan.bootstrap.shared_domain(settings)
+
+
+_stall_monitor: Optional[owan.libs.executors.StallMonitor] = None
+
+
+async def startup() -> None:
+    """Build the shared Domain before the worker starts to accept requests.
+
+    Thread pools for blocking work are sized here, stale inputs in the input
+    store are swept in background, and stalls of the event loop are watched.
+
+    """
+    global _stall_monitor
+
+    settings: Final = get_settings()
+    owan.libs.executors.configure(settings.api.io_workers, settings.api.cpu_workers)
+    domain: Final = await owan.libs.executors.run_io(
+        owan.bootstrap.shared_domain, settings
+    )
+    if domain.janitor is not None:
+        domain.janitor.start()
+    try:
+        await owan.libs.executors.run_io(domain.task_queue.connect)
+    except Exception as e:
+        logger.warning(f"failed to connect to broker at startup: {e!r}")
+
+    _stall_monitor = owan.libs.executors.StallMonitor(settings.api.loop_stall_threshold)
+    _stall_monitor.start()
+
+
+async def shutdown() -> None:
+    """Tear down the shared Domain and thread pools when the worker stops."""
+    global _stall_monitor
+
+    if _stall_monitor is not None:
+        _stall_monitor.stop()
+        _stall_monitor = None
+    owan.bootstrap.shutdown()
+    owan.libs.executors.shutdown()
 
 
 async def predict(
@@ -52,9 +95,15 @@ async def predict(
 
     Endpoint for prediction request.
 
+    If the same content was already received by this endpoint, the earlier job
+    is returned with `duplicate` set instead of enqueueing a new one, unless
+    the earlier job failed.
+
     Raises:
 
     - **Bad Request (400)**: `file` has unsupported extentions or is invalid as image.
+    - **Payload Too Large (413)**: `file` exceeds the configured max upload size.
+    - **Service Unavailable (503)**: the task queue did not accept the job in time.
 
     Example Usage:
 
@@ -67,9 +116,30 @@ async def predict(
     job_id: Final = _generate_job_id()
     dt_string: Final = _get_datetime_now_string()
 
-    _predict_preprocess(file, domain, settings, job_id, dt_string)
-    domain.task_queue.predict()
-    return JSONResponse({"recieved_file": f"{file.filename}"})
+    saved: Final = await _predict_preprocess(file, domain, settings, job_id, dt_string)
+    claimed_job_id: Final = await owan.libs.executors.run_io(
+        _claim_job, domain, saved, job_id, "predict"
+    )
+    if claimed_job_id == job_id:
+        claims = [(job_id, saved)]
+        ((_, payload),) = await _pack_payloads(domain, "predict", claims)
+        await _enqueue(
+            domain,
+            settings,
+            "predict",
+            claims,
+            domain.task_queue.predict,
+            payload,
+            job_id=job_id,
+        )
+
+    return JSONResponse(
+        {
+            "recieved_file": f"{file.filename}",
+            "job_id": claimed_job_id,
+            "duplicate": claimed_job_id != job_id,
+        }
+    )
 
 
 async def test_predict(
@@ -84,18 +154,177 @@ async def test_predict(
 
     Endpoint for testing prediction request.
 
+    If the same content was already received by this endpoint, the earlier job
+    is returned with `duplicate` set instead of enqueueing a new one, unless
+    the earlier job failed.
+
     Raises:
 
     - **Bad Request (400)**: `file` has unsupported extentions or is invalid as image.
+    - **Payload Too Large (413)**: `file` exceeds the configured max upload size.
+    - **Service Unavailable (503)**: the task queue did not accept the job in time.
 
     """
     logger.info(f"test_predict is called with file: {file.filename}.")
     job_id: Final = _generate_job_id()
     dt_string: Final = _get_datetime_now_string()
 
-    image_path: Final = _predict_preprocess(file, domain, settings, job_id, dt_string)
-    domain.task_queue.test_predict(str(image_path))
-    return JSONResponse({"recieved_file": f"{file.filename}"})
+    saved: Final = await _predict_preprocess(file, domain, settings, job_id, dt_string)
+    claimed_job_id: Final = await owan.libs.executors.run_io(
+        _claim_job, domain, saved, job_id, "test_predict"
+    )
+    if claimed_job_id == job_id:
+        claims = [(job_id, saved)]
+        ((_, payload),) = await _pack_payloads(domain, "test_predict", claims)
+        await _enqueue(
+            domain,
+            settings,
+            "test_predict",
+            claims,
+            domain.task_queue.test_predict,
+            payload,
+            job_id=job_id,
+        )
+
+    return JSONResponse(
+        {
+            "recieved_file": f"{file.filename}",
+            "job_id": claimed_job_id,
+            "duplicate": claimed_job_id != job_id,
+        }
+    )
+
+
+async def predict_batch(
+    files: List[fastapi.UploadFile] = fastapi.File(
+        ...,
+        description="Image files to request, or a single `.zip` archive of them. Supported extentions are `.png, .jpeg`.",
+    ),
+    domain: owan.domain.Domain = fastapi.Depends(_domain_factory),
+    settings: owan.settings.Settings = fastapi.Depends(get_settings),
+) -> JSONResponse:
+    """
+
+    Endpoint for batch prediction request.
+
+    All accepted files are enqueued as one Celery group. Files which are
+    invalid as image are reported in `rejected` instead of failing the batch.
+    Files whose content was already received are not enqueued again and
+    refer to the earlier job with `duplicate` set. If every file is a
+    duplicate, no group is enqueued and `batch_id` is null.
+
+    Raises:
+
+    - **Bad Request (400)**: the batch has too many files, the archive is invalid, or no file is accepted.
+    - **Service Unavailable (503)**: the task queue did not accept the jobs in time.
+
+    Example Usage:
+
+    ```
+    $ curl -X 'POST' 'http://${IP}:${PORT}/predict/batch' -H 'accept: application/json' -H 'Content-Type: multipart/form-data' -F 'files=@./sample_01.png;type=image/png' -F 'files=@./sample_02.png;type=image/png'
+    ```
+
+    """
+    logger.info(f"predict_batch is called with {len(files)} files.")
+    dt_string: Final = _get_datetime_now_string()
+
+    accepted, rejected = await _predict_batch_preprocess(
+        files, domain, settings, dt_string
+    )
+    if not accepted:
+        raise fastapi.HTTPException(
+            status_code=400,
+            detail=[{"filename": f, "detail": d} for f, d in rejected],
+        )
+
+    claimed_job_ids: Final = await owan.libs.executors.run_io(
+        lambda: [
+            _claim_job(domain, saved, job_id, "predict")
+            for _, job_id, saved in accepted
+        ]
+    )
+    new_claims: Final = [
+        (job_id, saved)
+        for (_, job_id, saved), claimed in zip(accepted, claimed_job_ids)
+        if claimed == job_id
+    ]
+    new_jobs: Final = await _pack_payloads(domain, "predict", new_claims)
+    batch_id: Optional[str] = None
+    if new_jobs:
+        # Each job of the batch runs the `predict` task, as `/predict` does.
+        batch = await _enqueue(
+            domain,
+            settings,
+            "predict",
+            new_claims,
+            domain.task_queue.predict_batch,
+            new_jobs,
+        )
+        batch_id = str(batch.id)
+    return JSONResponse(
+        {
+            "batch_id": batch_id,
+            "jobs": [
+                {
+                    "filename": filename,
+                    "job_id": claimed,
+                    "duplicate": claimed != job_id,
+                }
+                for (filename, job_id, _), claimed in zip(accepted, claimed_job_ids)
+            ],
+            "rejected": [
+                {"filename": filename, "detail": detail}
+                for filename, detail in rejected
+            ],
+        }
+    )
+
+
+async def job_status(
+    job_id: str,
+    domain: owan.domain.Domain = fastapi.Depends(_domain_factory),
+) -> JSONResponse:
+    """
+
+    Endpoint for job status. `job_id` is the one returned by prediction endpoints.
+
+    Unknown job ids are reported as `PENDING`.
+
+    """
+    logger.info(f"job_status is called with job_id: {job_id}.")
+    return JSONResponse(await owan.libs.executors.run_io(_job_status, domain, job_id))
+
+
+async def wait_job(
+    job_id: str,
+    timeout: float = fastapi.Query(
+        30.0,
+        ge=0.0,
+        le=60.0,
+        description="Max seconds to wait until the job is ready.",
+    ),
+    domain: owan.domain.Domain = fastapi.Depends(_domain_factory),
+) -> JSONResponse:
+    """
+
+    Long-poll endpoint for job status.
+
+    Response is returned as soon as the job is ready, or after `timeout`
+    seconds with the current status.
+
+    """
+    logger.info(f"wait_job is called with job_id: {job_id}.")
+    return JSONResponse(await _wait_job_status(domain, job_id, timeout))
+
+
+async def metrics() -> Response:
+    """Endpoint for metrics in Prometheus text format.
+
+    Metrics of all gunicorn workers are merged if `PROMETHEUS_MULTIPROC_DIR` is set.
+
+    """
+    content, content_type = await owan.libs.executors.run_io(owan.libs.metrics.render)
+    return Response(content, media_type=content_type)
 
 
 async def health() -> JSONResponse:
@@ -105,26 +334,47 @@ async def health() -> JSONResponse:
 
 
 async def store(
+    profile: Optional[str] = fastapi.Query(
+        None, description="A name of client profile which sets output options."
+    ),
+    image_format: Optional[str] = fastapi.Query(
+        None, alias="format", description="Output format: `jpeg`, `webp` or `avif`."
+    ),
+    quality: Optional[int] = fastapi.Query(None, ge=1, le=100),
+    max_bytes: Optional[int] = fastapi.Query(
+        None, ge=1, description="Byte budget of output. Quality is lowered to fit."
+    ),
     domain: owan.domain.Domain = fastapi.Depends(_domain_factory),
     settings: owan.settings.Settings = fastapi.Depends(get_settings),
 ) -> JSONResponse:
-    """Endpoint for aws health check."""
-    logger.info("store is called.")
-    image_path: Final = pathlib.Path("./tests/samples/valid_input_01.png")
-
-    key: Final = "hogehoge/samples"
+    """Endpoint for aws health check.
 
-    with image_path.open(mode="rb") as f:
-        im: Final = Image.open(f).convert("RGB")
-        im_io = BytesIO()
-        im.save(im_io, "JPEG", optimize=True, quality=85)
+    A sample image is compressed in memory and stored without a temporary file.
+    Output options are taken from `profile`, and each given option overrides it.
 
-        bucket = boto3.resource(
-            "s3",
-            aws_access_key_id="",
-            aws_secret_access_key="",
-        ).Bucket("")
+    Raises:
 
-        bucket.upload_file(str(image_path), "hogehoge/samples", key)
+    - **Bad Request (400)**: `profile` is unknown or `format` is not available.
 
-    return JSONResponse({"aws health": "ok"})
+    """
+    logger.info("store is called.")
+    image_path: Final = pathlib.Path("./tests/samples/valid_input_01.png")
+    output: Final = _output_profile(settings, profile, image_format, quality, max_bytes)
+
+    try:
+        data: Final = await owan.libs.executors.run_cpu(
+            domain.compressor.compress_to_bytes,
+            image_path,
+            image_format=output.image_format,
+            quality=output.quality,
+            max_bytes=output.max_bytes,
+        )
+    except ValueError as e:
+        raise fastapi.HTTPException(status_code=400, detail=str(e))
+
+    key: Final = f"hogehoge/samples.{output.image_format}"
+    await owan.libs.executors.run_io(domain.storage.store_bytes, data, key)
+
+    return JSONResponse(
+        {"aws health": "ok", "format": output.image_format, "bytes": len(data)}
+    )
@@ -1,3 +1,5 @@
+from typing import Any, List
+
 from pydantic import BaseModel
 
 
@@ -7,3 +9,29 @@ class Health(BaseModel):
 
 class PredictionRequestResponse(BaseModel):
     recieved_file: str
+    job_id: str
+    duplicate: bool
+
+
+class JobStatusResponse(BaseModel):
+    job_id: str
+    status: str
+    ready: bool
+    result: Any
+
+
+class BatchPredictionJob(BaseModel):
+    filename: str
+    job_id: str
+    duplicate: bool
+
+
+class BatchPredictionRejection(BaseModel):
+    filename: str
+    detail: str
+
+
+class BatchPredictionRequestResponse(BaseModel):
+    batch_id: str
+    jobs: List[BatchPredictionJob]
+    rejected: List[BatchPredictionRejection]
@@ -1,7 +1,11 @@
+import asyncio
 import datetime
+import functools
+import logging
 import pathlib
 import sys
 import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
 
 if sys.version_info >= (3, 8):
     from typing import Final
@@ -12,6 +16,15 @@ import fastapi
 from fastapi import HTTPException
 
 import owan.domain
+import owan.domain.payload
+import owan.settings
+from owan.domain.io import SavedUpload, UploadTooLargeError
+from owan.libs.executors import run_io
+from owan.libs.metrics import REJECTED_TOTAL
+
+logger: Final = logging.getLogger("uvicorn")
+
+T = TypeVar("T")
 
 
 def _generate_job_id() -> str:
@@ -27,19 +40,74 @@ def _get_datetime_now_string() -> str:
     return now.strftime(format)
 
 
-def _predict_preprocess(
+def _job_status(domain: owan.domain.Domain, job_id: str) -> Dict[str, Any]:
+    """Return status of the job `job_id` as a serializable dict.
+
+    `result` is the task return value on success, the error message on
+    failure, and None otherwise.
+
+    """
+    import celery.states
+
+    async_result: Final = domain.task_queue.job(job_id)
+    status: Final = async_result.state
+
+    result: Any = None
+    if status == celery.states.SUCCESS:
+        result = async_result.result
+    elif status == celery.states.FAILURE:
+        result = str(async_result.result)
+
+    return {
+        "job_id": job_id,
+        "status": status,
+        "ready": status in celery.states.READY_STATES,
+        "result": result,
+    }
+
+
+async def _wait_job_status(
+    domain: owan.domain.Domain,
+    job_id: str,
+    timeout: float,
+    interval: float = 0.5,
+) -> Dict[str, Any]:
+    """Poll status of the job `job_id` until it is ready or `timeout` passes.
+
+    Polling runs on the server side so that clients need only one request.
+
+    """
+    loop: Final = asyncio.get_event_loop()
+    deadline: Final = loop.time() + timeout
+
+    while True:
+        body = await run_io(_job_status, domain, job_id)
+        remaining = deadline - loop.time()
+        if body["ready"] or remaining <= 0:
+            return body
+        await asyncio.sleep(min(interval, remaining))
+
+
+async def _predict_preprocess(
     file: fastapi.UploadFile,
     domain: owan.domain.Domain,
     settings: owan.settings.Settings,
     job_id: str,
     dt_string: str,
-) -> pathlib.Path:
+) -> SavedUpload:
     """Preprocess of prediction.
 
-    This function does following three things:
+    This function does following two things:
     (1) Validate `file`'s extention.
-    (2) Save `file` temporally.
-    (3) Check if saved `file` is valid image.
+    (2) Save `file` temporally while checking it is valid image.
+
+    Saving runs in a thread pool so that the event loop is not blocked.
+
+    Starlette has already received the whole body into a spooled temporary
+    file when this runs. An invalid image is rejected from its first chunk,
+    which saves copying it into the input store but not receiving it.
+    Requests are shed before the body is read only by the admission check
+    (`owan.views.admission`), e.g. when too many upload bytes are in flight.
 
     """
     # Validate extention.
@@ -49,20 +117,337 @@ def _predict_preprocess(
             settings.io.input_supported_extensions,
         )
     except Exception as e:
+        REJECTED_TOTAL.labels("invalid").inc()
         raise HTTPException(status_code=400, detail=getattr(e, "message", str(e)))
 
-    # Save file temporally.
+    # Save file temporally. Invalid image is rejected from the first chunk.
     try:
-        save_path = domain.io.save_upload_file(
-            file, settings.input_store.path, job_id, dt_string
+        saved: Final = await run_io(
+            domain.io.save_upload_file,
+            file,
+            settings.input_store.path,
+            job_id,
+            dt_string,
+            supported=settings.io.input_supported_extensions,
+            max_bytes=settings.io.max_upload_bytes,
+            chunk_size=settings.io.upload_chunk_bytes,
         )
+    except UploadTooLargeError as e:
+        REJECTED_TOTAL.labels("too_large").inc()
+        raise HTTPException(status_code=413, detail=str(e))
     except Exception as e:
+        REJECTED_TOTAL.labels("invalid").inc()
         raise HTTPException(status_code=400, detail=getattr(e, "message", str(e)))
 
-    # Check if saved file is valid image.
+    return saved
+
+
+def _pack_payload(
+    domain: owan.domain.Domain, saved: SavedUpload
+) -> owan.domain.payload.Payload:
+    payload: Final = domain.payload.pack(saved.path, saved.digest)
+    if owan.domain.payload.local_path(payload) is None and domain.janitor is not None:
+        domain.janitor.discard(saved.path)
+    return payload
+
+
+def _discard_claims(
+    domain: owan.domain.Domain, task: str, claims: List[Tuple[str, SavedUpload]]
+) -> None:
+    _release_claims(domain, task, claims)
+    for _, saved in claims:
+        try:
+            saved.path.unlink()
+        except FileNotFoundError:
+            pass  # Already removed after packing inline.
+
+
+async def _pack_payloads(
+    domain: owan.domain.Domain, task: str, claims: List[Tuple[str, SavedUpload]]
+) -> List[Tuple[str, owan.domain.payload.Payload]]:
+    """Pack the saved uploads to send them to workers. Upload runs in the I/O pool.
+
+    If a payload carries the content itself, the saved upload is removed
+    because workers never read it. If any upload fails, none of the jobs is
+    enqueued: their dedup claims are released and saved uploads are removed,
+    so that a retry is enqueued anew.
+
+    Args:
+        task (str): A task name which the jobs were claimed for.
+        claims (List[Tuple[str, SavedUpload]]): Job ids and uploads to pack.
+
+    Return:
+        List[Tuple[str, Payload]]: Job ids and payloads in the order of `claims`.
+
+    Raises:
+        HTTPException: 503 if an image could not be uploaded for workers.
+
+    """
+    try:
+        return [
+            (job_id, await run_io(_pack_payload, domain, saved))
+            for job_id, saved in claims
+        ]
+    except owan.domain.payload.Error as e:
+        logger.warning(f"failed to pack {len(claims)} jobs: {e!r}")
+        await run_io(_discard_claims, domain, task, claims)
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+def _dedup_key(task: str, digest: str) -> str:
+    """Return the dedup key of content `digest` sent to `task`.
+
+    Keys are namespaced by task, so that the same content sent to another
+    endpoint (e.g. `/predict/test` then `/predict`) is not a duplicate.
+
+    """
+    return f"{task}:{digest}"
+
+
+def _job_failed(domain: owan.domain.Domain, job_id: str) -> bool:
+    import celery.states
+
     try:
-        domain.io.validate_image(save_path, settings.io.input_supported_extensions)
+        return bool(domain.task_queue.job(job_id).state == celery.states.FAILURE)
     except Exception as e:
-        raise HTTPException(status_code=400, detail=getattr(e, "message", str(e)))
+        logger.warning(f"failed to get status of job `{job_id}`: {e!r}")
+        return False
+
+
+def _claim_job(
+    domain: owan.domain.Domain, saved: SavedUpload, job_id: str, task: str
+) -> str:
+    """Return the job id which owns the content of `saved` sent to `task`.
+
+    If the same content was already received, `saved` is removed and the job
+    id of the earlier upload is returned. Callers should enqueue the job only
+    if the returned id equals `job_id`. A claim of a job which ended in
+    FAILURE is dropped, so that a retry of the client runs the job again.
+
+    """
+    if domain.dedup is None:
+        return job_id
+
+    key: Final = _dedup_key(task, saved.digest)
+    claimed = domain.dedup.claim(key, job_id)
+    if claimed != job_id and _job_failed(domain, claimed):
+        logger.info(f"job `{claimed}` failed. `{saved.path.name}` is enqueued again.")
+        domain.dedup.release(key, claimed)
+        claimed = domain.dedup.claim(key, job_id)
+
+    if claimed != job_id:
+        logger.info(f"`{saved.path.name}` is duplicate of job `{claimed}`.")
+        saved.path.unlink()
+    return claimed
+
+
+def _output_profile(
+    settings: owan.settings.Settings,
+    profile: Optional[str],
+    image_format: Optional[str],
+    quality: Optional[int],
+    max_bytes: Optional[int],
+) -> owan.settings.OutputProfile:
+    """Resolve output options of a request.
+
+    Options of the client `profile` (or the configured defaults) are
+    overridden by each option given explicitly.
+
+    Raises:
+        HTTPException: 400 if `profile` is unknown.
+
+    """
+    if profile is None:
+        base = owan.settings.OutputProfile(
+            image_format=settings.io.output_image_format,
+            quality=settings.io.output_image_compress_quality,
+            max_bytes=settings.io.output_image_max_bytes,
+        )
+    elif profile in settings.io.output_profiles:
+        base = settings.io.output_profiles[profile]
+    else:
+        raise HTTPException(status_code=400, detail=f"profile `{profile}` is unknown.")
+
+    return owan.settings.OutputProfile(
+        image_format=(image_format or base.image_format).lower(),
+        quality=quality or base.quality,
+        max_bytes=max_bytes or base.max_bytes,
+    )
+
+
+def _release_claims(
+    domain: owan.domain.Domain, task: str, claims: List[Tuple[str, SavedUpload]]
+) -> None:
+    if domain.dedup is None:
+        return
+
+    for job_id, saved in claims:
+        domain.dedup.release(_dedup_key(task, saved.digest), job_id)
+
+
+async def _enqueue(
+    domain: owan.domain.Domain,
+    settings: owan.settings.Settings,
+    task: str,
+    claims: List[Tuple[str, SavedUpload]],
+    fn: Callable[..., T],
+    *args: Any,
+    **kwargs: Any,
+) -> T:
+    """Run enqueueing `fn` in the I/O pool within the enqueue timeout.
+
+    If the broker refuses the jobs, the dedup claims of the jobs are
+    released, so that a retry is enqueued anew.
+
+    If the broker does not answer in time, the request fails fast but the
+    publish keeps running on its thread and may still succeed. The claims
+    are then kept until the publish ends, and released only if it failed.
+    So a retry either refers to the job published late (`duplicate`), or is
+    enqueued anew once the publish failed. A retry which comes before the
+    late publish fails refers to a job which never runs.
+
+    Args:
+        task (str): A task name which the jobs were claimed for.
+        claims (List[Tuple[str, SavedUpload]]): Job ids and uploads enqueued by `fn`.
+
+    Raises:
+        HTTPException: 503 if the broker is unreachable or too slow.
+
+    """
+    import kombu.exceptions
+
+    publish: Final = asyncio.ensure_future(run_io(fn, *args, **kwargs))
+    try:
+        # Shielded, so that the outcome of a late publish is still observed.
+        return await asyncio.wait_for(
+            asyncio.shield(publish), settings.redis.enqueue_timeout
+        )
+    except asyncio.TimeoutError:
+        logger.warning(f"enqueueing {len(claims)} jobs timed out. it may still end.")
+        publish.add_done_callback(
+            functools.partial(_release_claims_if_failed, domain, task, claims)
+        )
+    except kombu.exceptions.OperationalError as e:
+        logger.warning(f"failed to enqueue {len(claims)} jobs: {e!r}")
+        await run_io(_release_claims, domain, task, claims)
+
+    REJECTED_TOTAL.labels("broker_unavailable").inc()
+    raise HTTPException(
+        status_code=503,
+        detail="task queue is unavailable. retry later.",
+        headers={"Retry-After": "1"},
+    )
+
+
+def _release_claims_if_failed(
+    domain: owan.domain.Domain,
+    task: str,
+    claims: List[Tuple[str, SavedUpload]],
+    publish: "asyncio.Future[Any]",
+) -> None:
+    if publish.cancelled():
+        return
+    error: Final = publish.exception()
+    if error is None:
+        logger.info(f"{len(claims)} jobs were enqueued after the timeout.")
+        return
+
+    logger.warning(f"failed to enqueue {len(claims)} jobs: {error!r}")
+    asyncio.ensure_future(run_io(_release_claims, domain, task, claims))
+
+
+def _save_archive_members(
+    file: fastapi.UploadFile,
+    domain: owan.domain.Domain,
+    settings: owan.settings.Settings,
+    dt_string: str,
+) -> Tuple[List[Tuple[str, str, SavedUpload]], List[Tuple[str, str]]]:
+    """Save image members of zip archive `file` temporally.
+
+    Return:
+        Tuple: Accepted (filename, job id, saved) and rejected (filename, detail).
+
+    """
+    accepted: Final[List[Tuple[str, str, SavedUpload]]] = []
+    rejected: Final[List[Tuple[str, str]]] = []
+
+    for filename, source in domain.io.iter_archive_members(
+        file, settings.io.max_batch_files
+    ):
+        job_id = _generate_job_id()
+        try:
+            domain.io.check_extension(
+                pathlib.Path(filename), settings.io.input_supported_extensions
+            )
+            saved = domain.io.save_stream(
+                source,
+                filename,
+                settings.input_store.path,
+                job_id,
+                dt_string,
+                supported=settings.io.input_supported_extensions,
+                max_bytes=settings.io.max_upload_bytes,
+                chunk_size=settings.io.upload_chunk_bytes,
+            )
+        except Exception as e:
+            REJECTED_TOTAL.labels("invalid").inc()
+            rejected.append((filename, getattr(e, "message", str(e))))
+        else:
+            accepted.append((filename, job_id, saved))
+
+    return accepted, rejected
+
+
+async def _predict_batch_preprocess(
+    files: List[fastapi.UploadFile],
+    domain: owan.domain.Domain,
+    settings: owan.settings.Settings,
+    dt_string: str,
+) -> Tuple[List[Tuple[str, str, SavedUpload]], List[Tuple[str, str]]]:
+    """Preprocess of batch prediction.
+
+    `files` are either image files or a single zip archive of images.
+    Image files are validated and saved concurrently. An invalid file only
+    rejects itself, not the whole batch.
+
+    Return:
+        Tuple: Accepted (filename, job id, saved) and rejected (filename, detail).
+
+    Raises:
+        HTTPException: If the batch itself is invalid.
+
+    """
+    if len(files) == 1 and domain.io.is_archive(pathlib.Path(files[0].filename)):
+        try:
+            return await run_io(
+                _save_archive_members, files[0], domain, settings, dt_string
+            )
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=getattr(e, "message", str(e)))
+
+    if len(files) > settings.io.max_batch_files:
+        raise HTTPException(
+            status_code=400,
+            detail=f"batch has more than {settings.io.max_batch_files} files.",
+        )
+
+    job_ids: Final = [_generate_job_id() for _ in files]
+    results: Final = await asyncio.gather(
+        *[
+            _predict_preprocess(file, domain, settings, job_id, dt_string)
+            for file, job_id in zip(files, job_ids)
+        ],
+        return_exceptions=True,
+    )
+
+    accepted: Final[List[Tuple[str, str, SavedUpload]]] = []
+    rejected: Final[List[Tuple[str, str]]] = []
+    for file, job_id, result in zip(files, job_ids, results):
+        if isinstance(result, HTTPException):
+            rejected.append((file.filename, str(result.detail)))
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            accepted.append((file.filename, job_id, result))
 
-    return save_path
+    return accepted, rejected
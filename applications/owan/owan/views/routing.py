@@ -11,6 +11,13 @@ def add_routes(app: fastapi.FastAPI) -> None:
         response_model=owan.views.api._converters.Health,
     )
 
+    app.add_api_route(
+        "/metrics",
+        owan.views.api.metrics,
+        methods=["GET"],
+        include_in_schema=False,
+    )
+
     app.add_api_route(
         "/predict/test",
         owan.views.api.test_predict,
@@ -22,6 +29,28 @@ def add_routes(app: fastapi.FastAPI) -> None:
         "/predict",
         owan.views.api.predict,
         methods=["POST"],
+        response_model=owan.views.api._converters.PredictionRequestResponse,
+    )
+
+    app.add_api_route(
+        "/predict/batch",
+        owan.views.api.predict_batch,
+        methods=["POST"],
+        response_model=owan.views.api._converters.BatchPredictionRequestResponse,
+    )
+
+    app.add_api_route(
+        "/jobs/{job_id}",
+        owan.views.api.job_status,
+        methods=["GET"],
+        response_model=owan.views.api._converters.JobStatusResponse,
+    )
+
+    app.add_api_route(
+        "/jobs/{job_id}/wait",
+        owan.views.api.wait_job,
+        methods=["GET"],
+        response_model=owan.views.api._converters.JobStatusResponse,
     )
 
     app.add_api_route(
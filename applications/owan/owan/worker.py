@@ -1,15 +1,125 @@
 """
 Entry point module for celery worker.
+
+The shared Domain is built and warmed up in each worker process before it
+starts to consume tasks. With `prefork` pool this happens in every child
+process, otherwise once in the main process.
+
+Metrics are served on `WORKER_METRICS_PORT` from the main process. With
+`prefork` pool, set `PROMETHEUS_MULTIPROC_DIR` so that metrics of child
+processes are included.
+
+With `gevent` pool, blocking I/O is monkey-patched before anything else is
+imported. Celery does this only when the pool is given by `-P` on the command
+line, not when it is configured by `WORKER_POOL`. Install the `gevent` extra.
 """
+import os
+
+if os.getenv("WORKER_POOL") == "gevent":
+    from gevent import monkey
+
+    if not monkey.is_module_patched("socket"):
+        monkey.patch_all()
+
+import logging
 import sys
+import threading
+import time
+from typing import Any, Dict
+
+import celery.signals
 
 if sys.version_info >= (3, 8):
     from typing import Final
 else:
     from typing_extensions import Final
 
+import owan.bootstrap
+import owan.libs.metrics
 import owan.settings
 import owan.tasks
+from owan.libs.metrics import QUEUE_WAIT_SECONDS, TASK_RUN_SECONDS
+
+logger: Final = logging.getLogger("uvicorn")
 
 settings: Final = owan.settings.settings()
-app: Final = owan.tasks.Factory(broker=settings.redis.dns).worker
+app: Final = owan.tasks.Factory(
+    broker=settings.redis.dns,
+    backend=settings.redis.result_backend_dns,
+    result_expires=settings.redis.result_expires,
+    worker_settings=settings.worker,
+).worker
+
+# Start time of running tasks by task id.
+_task_started_at: Final[Dict[str, float]] = {}
+_task_started_at_lock: Final = threading.Lock()
+
+
+def _prepare_domain() -> None:
+    domain: Final = owan.bootstrap.shared_domain(settings)
+    if settings.worker.warm_up:
+        domain.warm_up()
+
+
+def _task_label(task: Any) -> str:
+    # `owan.tasks._predict` -> `predict`
+    return str(task.name).rsplit(".", 1)[-1].lstrip("_")
+
+
+def _on_worker_init(**kwargs: Any) -> None:
+    if settings.worker.metrics_port is not None:
+        owan.libs.metrics.start_http_server(settings.worker.metrics_port)
+    # Child processes of prefork pool prepare their own Domain.
+    if settings.worker.pool != "prefork":
+        _prepare_domain()
+
+
+def _on_worker_process_init(**kwargs: Any) -> None:
+    _prepare_domain()
+
+
+def _on_worker_process_shutdown(**kwargs: Any) -> None:
+    owan.bootstrap.shutdown()
+    owan.libs.metrics.mark_process_dead(os.getpid())
+
+
+def _on_task_prerun(task_id: str, task: Any, **kwargs: Any) -> None:
+    published_at: Final = getattr(task.request, owan.tasks.PUBLISHED_AT_HEADER, None)
+    if published_at is not None:
+        QUEUE_WAIT_SECONDS.labels(_task_label(task)).observe(
+            max(0.0, time.time() - float(published_at))
+        )
+    with _task_started_at_lock:
+        _task_started_at[task_id] = time.perf_counter()
+
+
+def _on_task_postrun(task_id: str, task: Any, state: str, **kwargs: Any) -> None:
+    with _task_started_at_lock:
+        started_at: Final = _task_started_at.pop(task_id, None)
+    if started_at is not None:
+        TASK_RUN_SECONDS.labels(_task_label(task), str(state)).observe(
+            time.perf_counter() - started_at
+        )
+
+
+def _on_worker_ready(**kwargs: Any) -> None:
+    """Create ready file which readiness probes can check."""
+    if settings.worker.ready_file is not None:
+        settings.worker.ready_file.parent.mkdir(parents=True, exist_ok=True)
+        settings.worker.ready_file.touch()
+        logger.info(f"worker is ready. `{settings.worker.ready_file}` is created.")
+
+
+def _on_worker_shutdown(**kwargs: Any) -> None:
+    if settings.worker.ready_file is not None and settings.worker.ready_file.exists():
+        settings.worker.ready_file.unlink()
+    owan.bootstrap.shutdown()
+
+
+celery.signals.worker_init.connect(_on_worker_init)
+celery.signals.worker_process_init.connect(_on_worker_process_init)
+celery.signals.worker_process_shutdown.connect(_on_worker_process_shutdown)
+celery.signals.worker_ready.connect(_on_worker_ready)
+celery.signals.worker_shutdown.connect(_on_worker_shutdown)
+celery.signals.task_prerun.connect(_on_task_prerun)
+celery.signals.task_postrun.connect(_on_task_postrun)
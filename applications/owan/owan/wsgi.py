@@ -7,11 +7,16 @@ if sys.version_info >= (3, 8):
 else:
     from typing_extensions import Final
 
+import owan.views.admission
+import owan.views.api
 import owan.views.routing
 
 
 def main() -> fastapi.FastAPI:
     app: Final = fastapi.FastAPI()
     owan.views.routing.add_routes(app)
+    owan.views.admission.add_admission(app, owan.views.api.get_settings())
+    app.add_event_handler("startup", owan.views.api.startup)
+    app.add_event_handler("shutdown", owan.views.api.shutdown)
 
     return app
@@ -2,11 +2,15 @@ import pathlib
 
 import pytest
 
+import owan.settings
+
 input_path = pathlib.Path("./tests/samples/valid_input_01.png")
 output_path = pathlib.Path("./tests/tmp/output.jpeg")
 invalid_input_path = pathlib.Path("./tests/samples/invalid_input_01.png")
 unsupported_input_path = pathlib.Path("./tests/samples/unsupported_input_01.png")
 input_store_path = pathlib.Path("./tests/tmp/input_store")
+payload_cache_path = pathlib.Path("./tests/tmp/payload_cache")
+storage_path = pathlib.Path("./tests/tmp/storage")
 
 
 @pytest.fixture
@@ -55,3 +59,99 @@ def binary_image_factory():
         return image_path.open("rb")
 
     return f
+
+
+@pytest.fixture
+def settings_factory(input_store_path_factory):
+    def f(storage_directory=storage_path, payload_transport="PATH"):
+        return owan.settings.Settings(
+            redis=owan.settings.RedisSetting(
+                dns="memory://localhost",
+                result_backend_dns="cache+memory://",
+                result_expires=60,
+                pool_limit=2,
+                socket_timeout=1.0,
+                enqueue_timeout=1.0,
+            ),
+            worker=owan.settings.WorkerSetting(
+                pool="solo",
+                concurrency=1,
+                prefetch_multiplier=1,
+                acks_late=True,
+                time_limit=None,
+                soft_time_limit=None,
+                prediction_queue="prediction",
+                storage_queue="storage",
+                warm_up=True,
+                ready_file=None,
+                predict_max_batch_size=1,
+                predict_max_wait=0.0,
+                metrics_port=None,
+            ),
+            input_store=owan.settings.InputStoreSetting(
+                path=input_store_path_factory(),
+                shard_depth=2,
+                ttl=60,
+                sweep_interval=0,
+            ),
+            io=owan.settings.IoSetting(
+                input_supported_extensions={".png", ".jpg", ".jpeg"},
+                output_image_compress_quality=30,
+                output_image_max_dimension=None,
+                output_image_format="jpeg",
+                output_image_max_bytes=None,
+                max_image_pixels=16 * 1024 * 1024,
+                output_profiles={
+                    "thumbnail": owan.settings.OutputProfile(
+                        image_format="webp", quality=60, max_bytes=4096
+                    )
+                },
+                max_upload_bytes=20 * 1024 * 1024,
+                upload_chunk_bytes=64 * 1024,
+                max_batch_files=500,
+            ),
+            storage=owan.settings.StorageSettings(
+                provider=owan.settings.StorageProvider.LOCAL,
+                local_directory=storage_directory,
+                s3_access_key_id="",
+                s3_secret_key="",
+                s3_region_name="",
+                s3_bucket_name="",
+                s3_endpoint_url=None,
+                s3_max_pool_connections=4,
+                s3_multipart_threshold=8 * 1024 * 1024,
+                s3_multipart_chunksize=8 * 1024 * 1024,
+                s3_max_concurrency=2,
+                s3_max_workers=2,
+                spool_directory=None,
+                spool_workers=1,
+            ),
+            dedup=owan.settings.DedupSetting(
+                enabled=True, max_entries=16, ttl=60, redis_dns=None
+            ),
+            payload=owan.settings.PayloadSetting(
+                transport=payload_transport,
+                inline_max_bytes=1024,
+                cache_directory=payload_cache_path,
+                cache_max_bytes=1024 * 1024,
+            ),
+            derivative_cache=owan.settings.DerivativeCacheSetting(
+                memory_max_bytes=1024 * 1024, directory=None, disk_max_bytes=0
+            ),
+            admission=owan.settings.AdmissionSetting(
+                enabled=True,
+                max_queue_depth=100,
+                max_inflight_bytes=64 * 1024 * 1024,
+                min_free_disk_bytes=0,
+                retry_after=5,
+                cache_ttl=0.0,
+                rate_limit=0.0,
+                rate_limit_burst=1,
+                rate_limit_redis_dns=None,
+            ),
+            api=owan.settings.ApiSetting(
+                io_workers=4, cpu_workers=2, loop_stall_threshold=0.1
+            ),
+        )
+
+    return f
@@ -0,0 +1,28 @@
+import pytest
+
+from owan.domain.codecs import Encoder, encoder_for_extension, get_encoder
+
+
+def test_get_encoder():
+    encoder = get_encoder("JPEG")
+
+    assert encoder.extension == ".jpeg"
+    assert encoder.options["progressive"]
+
+
+def test_encoder_for_extension():
+    assert encoder_for_extension(".webp").name == "webp"
+    with pytest.raises(ValueError):
+        encoder_for_extension(".png")
+
+
+def test_unavailable_encoder():
+    encoder = Encoder(
+        name="dummy",
+        extension=".dummy",
+        pillow_format="DUMMY",
+        modes=("RGB",),
+        plugin="owan_dummy_plugin",
+    )
+
+    assert not encoder.available()
@@ -2,8 +2,11 @@ import shutil
 import unittest
 
 import pytest
+from PIL import Image
 
 from owan.domain.compress import Compressor
+from owan.domain.io import ImageTooLargeError
+from owan.libs.cache import TieredCache
 
 
 class TestCompressor:
@@ -34,6 +37,125 @@ class TestCompressor:
         assert excepted_path.exists()
         shutil.rmtree(excepted_path.parent)
 
+    def test_compress_image_max_dimension(
+        self, compressor_factory, image_path_factory, output_image_path_factory
+    ):
+        compressor = compressor_factory({".png", ".jpeg"}, 30)
+
+        output_path = output_image_path_factory()
+        compressor.compress_image(image_path_factory(), output_path, max_dimension=64)
+
+        with Image.open(output_path) as im:
+            assert max(im.size) == 64
+        shutil.rmtree(output_path.parent)
+
+    def test_compress_image_max_dimension_jpeg_draft(
+        self, compressor_factory, output_image_path_factory
+    ):
+        compressor = compressor_factory({".jpeg"}, 30)
+
+        output_path = output_image_path_factory()
+        input_path = output_path.with_name("input.jpeg")
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        Image.new("RGB", (1600, 1200), "white").save(input_path)
+
+        compressor.compress_image(input_path, output_path, max_dimension=300)
+
+        with Image.open(output_path) as im:
+            assert im.size == (300, 225)
+        shutil.rmtree(output_path.parent)
+
+    def test_compress_to_bytes(self, compressor_factory, image_path_factory):
+        compressor = compressor_factory({".png", ".jpeg"}, 30)
+
+        data = compressor.compress_to_bytes(image_path_factory())
+
+        assert bytes(data[:2]) == b"\xff\xd8"
+
+    def test_compress_image_cached(
+        self, image_path_factory, output_image_path_factory, monkeypatch
+    ):
+        cache = TieredCache("test", memory_max_bytes=1024 * 1024)
+        compressor = Compressor({".png", ".jpeg"}, 30, cache=cache)
+
+        output_path = output_image_path_factory()
+        compressor.compress_image(image_path_factory(), output_path, digest="digest")
+        first = output_path.read_bytes()
+        output_path.unlink()
+
+        # The second request is answered from cache without encoding.
+        monkeypatch.setattr(compressor, "_encode", unittest.mock.MagicMock())
+        compressor.compress_image(image_path_factory(), output_path, digest="digest")
+        data = compressor.compress_to_bytes(image_path_factory(), digest="digest")
+
+        assert output_path.read_bytes() == first == bytes(data)
+        compressor._encode.assert_not_called()
+        assert cache.stats()["misses"] == 1
+        assert cache.stats()["memory_hits"] == 2
+        shutil.rmtree(output_path.parent)
+
+    def test_compress_image_cache_key(self, image_path_factory):
+        cache = TieredCache("test", memory_max_bytes=1024 * 1024)
+        compressor = Compressor({".png", ".jpeg"}, 30, cache=cache)
+
+        compressor.compress_to_bytes(image_path_factory())
+        compressor.compress_to_bytes(image_path_factory(), max_dimension=64)
+        compressor.compress_to_bytes(image_path_factory(), max_dimension=64)
+
+        assert cache.stats()["misses"] == 2
+        assert cache.stats()["memory_hits"] == 1
+
+    def test_compress_image_webp(self, image_path_factory, output_image_path_factory):
+        compressor = Compressor({".png", ".jpeg"}, 30)
+
+        output_path = output_image_path_factory().with_suffix(".webp")
+        compressor.compress_image(image_path_factory(), output_path)
+
+        with Image.open(output_path) as im:
+            assert im.format == "WEBP"
+        shutil.rmtree(output_path.parent)
+
+    def test_compress_to_bytes_max_bytes(self, image_path_factory):
+        compressor = Compressor({".png", ".jpeg"}, 95)
+        unbounded = compressor.compress_to_bytes(image_path_factory())
+        max_bytes = len(unbounded) // 2
+
+        data = compressor.compress_to_bytes(
+            image_path_factory(), image_format="jpeg", max_bytes=max_bytes
+        )
+
+        assert len(data) <= max_bytes
+        assert bytes(data[:2]) == b"\xff\xd8"
+
+    def test_compress_to_bytes_max_bytes_below_min_quality(self, image_path_factory):
+        compressor = Compressor({".png", ".jpeg"}, 95)
+        # Quality is lower than the floor of the search and the budget is unmet.
+        expected = compressor.compress_to_bytes(
+            image_path_factory(), image_format="jpeg", quality=3
+        )
+
+        data = compressor.compress_to_bytes(
+            image_path_factory(), image_format="jpeg", quality=3, max_bytes=100
+        )
+
+        assert bytes(data) == bytes(expected)
+
+    def test_compress_to_bytes_unavailable_format(self, image_path_factory):
+        compressor = Compressor({".png", ".jpeg"}, 30)
+
+        with pytest.raises(ValueError):
+            compressor.compress_to_bytes(image_path_factory(), image_format="gif")
+
+    def test_compress_image_pixel_budget(
+        self, image_path_factory, output_image_path_factory
+    ):
+        compressor = Compressor({".png", ".jpeg"}, 30, max_pixels=16)
+
+        output_path = output_image_path_factory()
+        with pytest.raises(ImageTooLargeError):
+            compressor.compress_image(image_path_factory(), output_path)
+        assert not output_path.exists()
+
     def test_compress_image_invalid_extention(
         self, compressor_factory, image_path_factory, output_image_path_factory
     ):
@@ -55,3 +177,29 @@ class TestCompressor:
         assert not output_path.exists()
         with pytest.raises(ValueError):
             compressor.compress_image(input_path, output_path)
+
+    def test_compress_many(
+        self,
+        compressor_factory,
+        image_path_factory,
+        invalid_image_path_factory,
+        output_image_path_factory,
+    ):
+        compressor = compressor_factory({".png", ".jpeg"}, 30)
+
+        output_dir = output_image_path_factory().parent
+        paths = [
+            (image_path_factory(), output_dir / "output_0.jpeg"),
+            (invalid_image_path_factory(), output_dir / "output_1.jpeg"),
+            (image_path_factory(), output_dir / "output_2.jpeg"),
+        ]
+        results = compressor.compress_many(paths, max_workers=2)
+
+        assert [result.ok for result in results] == [True, False, True]
+        assert [result.output_path.exists() for result in results] == [
+            True,
+            False,
+            True,
+        ]
+        assert not list(output_dir.glob("*.part"))
+        shutil.rmtree(output_dir)
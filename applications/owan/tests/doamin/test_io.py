@@ -2,15 +2,17 @@ import shutil
 from unittest.mock import MagicMock, PropertyMock
 
 import pytest
+from PIL import Image
 
 from owan.domain import IoHandler
+from owan.domain.io import ImageTooLargeError, UploadTooLargeError, open_image
 
 
 class TestIoHandler:
     @pytest.fixture
     def io_handler_factory(self):
-        def f():
-            return IoHandler()
+        def f(shard_depth=0, max_pixels=None):
+            return IoHandler(shard_depth, max_pixels)
 
         return f
 
@@ -37,12 +39,130 @@ class TestIoHandler:
         assert excepted_path.exists()
         shutil.rmtree(input_store_path)
 
+    def test_save_stream_sharded(
+        self, io_handler_factory, input_store_path_factory, binary_image_factory
+    ):
+        io_handler = io_handler_factory(shard_depth=2)
+        input_store_path = input_store_path_factory()
+
+        saved = io_handler.save_stream(
+            binary_image_factory(), "test_image.png", input_store_path, "job-id", "dt"
+        )
+
+        assert saved.path.parent == io_handler.shard_directory(
+            input_store_path, "job-id"
+        )
+        assert len(saved.path.relative_to(input_store_path).parts) == 3
+        shutil.rmtree(input_store_path)
+
+    def test_save_upload_file_invalid(
+        self, io_handler_factory, input_store_path_factory, invalid_image_path_factory
+    ):
+        io_handler = io_handler_factory()
+        input_store_path = input_store_path_factory()
+
+        filename = "test_image.png"
+        mock_upload_file = MagicMock()
+        type(mock_upload_file).file = PropertyMock(
+            return_value=invalid_image_path_factory().open("rb")
+        )
+        type(mock_upload_file).filename = PropertyMock(return_value=filename)
+        with pytest.raises(ValueError):
+            io_handler.save_upload_file(
+                mock_upload_file,
+                input_store_path,
+                "job-id",
+                "dt-string",
+                supported={".png"},
+            )
+
+        assert not (input_store_path / f"dt-string_job-id_{filename}").exists()
+        shutil.rmtree(input_store_path)
+
+    def test_save_upload_file_too_large(
+        self, io_handler_factory, input_store_path_factory, binary_image_factory
+    ):
+        io_handler = io_handler_factory()
+        input_store_path = input_store_path_factory()
+
+        filename = "test_image.png"
+        mock_upload_file = MagicMock()
+        type(mock_upload_file).file = PropertyMock(return_value=binary_image_factory())
+        type(mock_upload_file).filename = PropertyMock(return_value=filename)
+        with pytest.raises(UploadTooLargeError):
+            io_handler.save_upload_file(
+                mock_upload_file,
+                input_store_path,
+                "job-id",
+                "dt-string",
+                supported={".png"},
+                max_bytes=16,
+                chunk_size=8,
+            )
+
+        assert not (input_store_path / f"dt-string_job-id_{filename}").exists()
+        shutil.rmtree(input_store_path)
+
     def test_validate_image(self, io_handler_factory, image_path_factory):
         io_handler = io_handler_factory()
 
         image_path = image_path_factory()
         assert io_handler.validate_image(image_path) is None
 
+    def test_probe(self, io_handler_factory, image_path_factory, tmp_path):
+        io_handler = io_handler_factory()
+        with Image.open(image_path_factory()) as im:
+            expected_size = im.size
+
+        info = io_handler.probe(image_path_factory())
+        assert info.format == "png"
+        assert (info.width, info.height) == expected_size
+
+        jpeg_path = tmp_path / "input.jpeg"
+        Image.new("RGB", (40, 30)).save(jpeg_path)
+        info = io_handler.probe(jpeg_path, {".jpeg"})
+        assert (info.format, info.width, info.height) == ("jpeg", 40, 30)
+
+    def test_save_stream_probe_beyond_first_chunk(
+        self, io_handler_factory, input_store_path_factory, tmp_path
+    ):
+        # The saved file is probed, so its pixels are checked against the budget.
+        io_handler = io_handler_factory(max_pixels=40 * 30 - 1)
+        input_store_path = input_store_path_factory()
+        jpeg_path = tmp_path / "input.jpeg"
+        # A large ICC profile pushes the frame header out of the first chunk.
+        Image.new("RGB", (40, 30)).save(jpeg_path, icc_profile=bytes(128 * 1024))
+
+        with jpeg_path.open("rb") as source, pytest.raises(ImageTooLargeError):
+            io_handler.save_stream(
+                source,
+                jpeg_path.name,
+                input_store_path,
+                "job-id",
+                "dt",
+                supported={".jpeg"},
+            )
+
+        assert not list(input_store_path.glob("**/*_input.jpeg"))
+        shutil.rmtree(input_store_path)
+
+    def test_validate_image_pixel_budget(self, io_handler_factory, image_path_factory):
+        io_handler = io_handler_factory(max_pixels=16)
+
+        with pytest.raises(ImageTooLargeError):
+            io_handler.validate_image(image_path_factory())
+
+    def test_open_image_jpeg_draft(self, tmp_path):
+        image_path = tmp_path / "input.jpeg"
+        Image.new("RGB", (1600, 1200), "white").save(image_path)
+
+        with pytest.raises(ImageTooLargeError):
+            with open_image(image_path, max_pixels=200 * 200):
+                pass
+        # Decoded at 1/8 scale, the image fits the budget.
+        with open_image(image_path, max_pixels=200 * 200, draft_size=(200, 150)) as im:
+            assert im.size == (200, 150)
+
     def test_validate_image_invalid(
         self, io_handler_factory, invalid_image_path_factory
     ):
@@ -0,0 +1,52 @@
+import os
+import time
+
+from owan.domain.janitor import Janitor
+
+
+class TestJanitor:
+    def test_release(self, tmp_path):
+        janitor = Janitor(tmp_path / "input_store", ttl=60)
+        inside = tmp_path / "input_store" / "ab" / "input.png"
+        outside = tmp_path / "outside.png"
+        inside.parent.mkdir(parents=True)
+        inside.write_bytes(b"content")
+        outside.write_bytes(b"content")
+
+        janitor.release(str(inside))
+        janitor.release(str(outside))
+        janitor.release({"kind": "inline"})
+        janitor.release(str(inside))
+        assert not inside.exists()
+
+        inside.write_bytes(b"content")
+        janitor.release({"kind": "path", "path": str(inside)})
+        assert not inside.exists()
+        assert outside.exists()
+
+    def test_sweep(self, tmp_path):
+        janitor = Janitor(tmp_path, ttl=60)
+        stale = tmp_path / "ab" / "cd" / "stale.png"
+        fresh = tmp_path / "ab" / "cd" / "fresh.png"
+        stale.parent.mkdir(parents=True)
+        stale.write_bytes(b"content")
+        fresh.write_bytes(b"content")
+        past = time.time() - 120
+        os.utime(str(stale), (past, past))
+
+        assert janitor.sweep() == 1
+        assert not stale.exists()
+        assert fresh.exists()
+
+    def test_sweep_in_background(self, tmp_path):
+        janitor = Janitor(tmp_path, ttl=0, sweep_interval=0.01)
+        path = tmp_path / "input.png"
+        path.write_bytes(b"content")
+
+        janitor.start()
+        deadline = time.monotonic() + 5.0
+        while path.exists() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        janitor.close()
+
+        assert not path.exists()
@@ -0,0 +1,93 @@
+import shutil
+import unittest.mock
+
+import pytest
+
+from owan.domain.payload import Error, PayloadTransport, TransportMode, local_path
+from owan.libs.storage import Storage
+
+
+@pytest.fixture
+def transport_factory(tmp_path):
+    def f(mode=TransportMode.AUTO, inline_max_bytes=1024, cache_max_bytes=1 << 30):
+        storage = Storage(tmp_path / "storage", "", "", "", "", local_only=True)
+        return PayloadTransport(
+            storage,
+            mode=mode,
+            inline_max_bytes=inline_max_bytes,
+            cache_directory=tmp_path / "cache",
+            cache_max_bytes=cache_max_bytes,
+        )
+
+    return f
+
+
+class TestPayloadTransport:
+    def test_path(self, transport_factory, image_path_factory):
+        transport = transport_factory(mode=TransportMode.PATH)
+        payload = transport.pack(image_path_factory())
+
+        assert payload == str(image_path_factory())
+        assert transport.unpack(payload) == image_path_factory()
+
+    def test_local_path(self, transport_factory, image_path_factory):
+        # Path payloads of kind `path` were packed by an earlier release.
+        path_payload = {"kind": "path", "path": str(image_path_factory())}
+        inline_payload = transport_factory(inline_max_bytes=1 << 30).pack(
+            image_path_factory()
+        )
+
+        assert transport_factory().unpack(path_payload) == image_path_factory()
+        assert local_path(path_payload) == image_path_factory()
+        assert local_path(str(image_path_factory())) == image_path_factory()
+        assert local_path(inline_payload) is None
+
+    def test_inline(self, transport_factory, image_path_factory):
+        transport = transport_factory(inline_max_bytes=1 << 30)
+        payload = transport.pack(image_path_factory())
+
+        assert payload["kind"] == "inline"
+        path = transport.unpack(payload)
+        assert path.read_bytes() == image_path_factory().read_bytes()
+
+    def test_storage(self, transport_factory, image_path_factory):
+        transport = transport_factory(inline_max_bytes=0)
+        payload = transport.pack(image_path_factory())
+
+        assert payload["kind"] == "storage"
+        assert payload["key"].startswith(f"inputs/{payload['digest']}")
+        path = transport.unpack(payload)
+        assert path.read_bytes() == image_path_factory().read_bytes()
+
+    def test_storage_cache_hit(self, transport_factory, image_path_factory):
+        transport = transport_factory(inline_max_bytes=0)
+        payload = transport.pack(image_path_factory())
+        transport.unpack(payload)
+
+        with unittest.mock.patch.object(Storage, "fetch") as fetch:
+            transport.unpack(payload)
+        fetch.assert_not_called()
+
+    def test_cache_eviction(self, transport_factory, image_path_factory, tmp_path):
+        size = image_path_factory().stat().st_size
+        transport = transport_factory(inline_max_bytes=0, cache_max_bytes=size)
+        paths = []
+        for i in range(3):
+            image_path = tmp_path / f"input_{i}.png"
+            shutil.copy2(image_path_factory(), image_path)
+            # Make content unique so that each file has its own digest.
+            with image_path.open("ab") as f:
+                f.write(bytes([i]))
+            paths.append(transport.unpack(transport.pack(image_path)))
+
+        assert [path.exists() for path in paths] == [False, False, True]
+
+    def test_unpack_missing(self, transport_factory):
+        transport = transport_factory()
+
+        with pytest.raises(Error):
+            transport.unpack(
+                {"kind": "storage", "name": "x.png", "digest": "x", "key": "none"}
+            )
+        with pytest.raises(Error):
+            transport.unpack({"kind": "unknown"})
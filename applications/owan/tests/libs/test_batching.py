@@ -0,0 +1,53 @@
+import concurrent.futures
+import threading
+
+import pytest
+
+from owan.libs.batching import Error, MicroBatcher
+
+
+class TestMicroBatcher:
+    def test_submit(self):
+        batches = []
+
+        def handler(items):
+            batches.append(list(items))
+            return [item * 2 for item in items]
+
+        batcher = MicroBatcher(handler, max_batch_size=4, max_wait=1.0)
+        barrier = threading.Barrier(8)
+
+        def submit(item):
+            barrier.wait()
+            return batcher.submit(item).result(timeout=5.0)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(submit, range(8)))
+        batcher.close()
+
+        assert results == [item * 2 for item in range(8)]
+        assert all(len(batch) <= 4 for batch in batches)
+        assert len(batches) < 8
+
+    def test_flush_after_max_wait(self):
+        batcher = MicroBatcher(lambda items: items, max_batch_size=32, max_wait=0.01)
+
+        assert batcher.submit("item").result(timeout=5.0) == "item"
+        batcher.close()
+
+    def test_handler_error(self):
+        def handler(items):
+            raise RuntimeError()
+
+        batcher = MicroBatcher(handler, max_batch_size=2, max_wait=0.01)
+
+        with pytest.raises(RuntimeError):
+            batcher.submit("item").result(timeout=5.0)
+        batcher.close()
+
+    def test_submit_after_close(self):
+        batcher = MicroBatcher(lambda items: items, max_batch_size=2, max_wait=0.01)
+        batcher.close()
+
+        with pytest.raises(Error):
+            batcher.submit("item")
@@ -0,0 +1,70 @@
+import pickle
+import shutil
+
+from owan.libs.cache import DiskLru, MemoryLru, TieredCache
+
+
+class TestMemoryLru:
+    def test_evict_least_recently_used(self):
+        lru = MemoryLru(max_bytes=8)
+        lru.put("a", b"1234")
+        lru.put("b", b"1234")
+        assert lru.get("a") == b"1234"
+
+        assert lru.put("c", b"1234") == 1
+        assert lru.get("a") == b"1234"
+        assert lru.get("b") is None
+        assert lru.size == 8
+
+    def test_value_larger_than_cache(self):
+        lru = MemoryLru(max_bytes=4)
+
+        assert lru.put("a", b"12345") == 0
+        assert lru.get("a") is None
+
+
+class TestDiskLru:
+    def test_evict_least_recently_used(self, tmp_path):
+        lru = DiskLru(tmp_path / "cache", max_bytes=8)
+        lru.put("a", b"1234")
+        lru.put("b", b"1234")
+
+        assert lru.put("c", b"1234") == 1
+        assert lru.get("c") == b"1234"
+        assert len(list((tmp_path / "cache").iterdir())) == 2
+
+
+class TestTieredCache:
+    def test_get_from_disk(self, tmp_path):
+        directory = tmp_path / "cache"
+        TieredCache("test", 1024, directory).put("key", b"value")
+
+        # A new process finds the entry on disk and promotes it to memory.
+        cache = TieredCache("test", 1024, directory)
+        assert cache.get("key") == b"value"
+        assert cache.get("key") == b"value"
+        assert cache.get("unknown") is None
+
+        stats = cache.stats()
+        assert stats["disk_hits"] == 1
+        assert stats["memory_hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["memory_bytes"] == len(b"value")
+        shutil.rmtree(directory)
+
+    def test_memory_only(self):
+        cache = TieredCache("test", memory_max_bytes=4)
+        cache.put("a", b"1234")
+        cache.put("b", b"1234")
+
+        assert cache.get("a") is None
+        assert cache.get("b") == b"1234"
+        assert cache.stats()["memory_evictions"] == 1
+
+    def test_pickle(self, tmp_path):
+        cache = TieredCache("test", 1024, tmp_path)
+        cache.put("key", b"value")
+
+        copied = pickle.loads(pickle.dumps(cache))
+        assert copied.get("key") == b"value"
+        assert copied.stats()["disk_hits"] == 1
@@ -0,0 +1,64 @@
+import unittest.mock
+
+from owan.libs.dedup import ContentIndex, LruIndex
+
+
+class TestLruIndex:
+    def test_claim(self):
+        index = LruIndex(max_entries=2)
+        assert index.claim("digest-0", "job-0") == "job-0"
+        assert index.claim("digest-0", "job-1") == "job-0"
+
+    def test_evict_least_recently_used(self):
+        index = LruIndex(max_entries=2)
+        index.put("digest-0", "job-0")
+        index.put("digest-1", "job-1")
+        assert index.get("digest-0") == "job-0"
+        index.put("digest-2", "job-2")
+
+        assert index.get("digest-0") == "job-0"
+        assert index.get("digest-1") is None
+
+    def test_release(self):
+        index = LruIndex(max_entries=2)
+        index.put("digest", "job-0")
+        index.release("digest", "job-1")
+        assert index.get("digest") == "job-0"
+
+        index.release("digest", "job-0")
+        assert index.get("digest") is None
+
+    def test_expire(self):
+        index = LruIndex(max_entries=2, ttl=60)
+        with unittest.mock.patch("time.monotonic", return_value=1000.0):
+            assert index.claim("digest", "job-0") == "job-0"
+        with unittest.mock.patch("time.monotonic", return_value=1059.0):
+            assert index.claim("digest", "job-1") == "job-0"
+        with unittest.mock.patch("time.monotonic", return_value=1060.0):
+            assert index.get("digest") is None
+            assert index.claim("digest", "job-1") == "job-1"
+
+
+class TestContentIndex:
+    def test_claim_local_only(self):
+        index = ContentIndex(max_entries=16)
+        assert index.claim("digest", "job-0") == "job-0"
+        assert index.claim("digest", "job-1") == "job-0"
+
+    def test_claim_from_redis(self):
+        index = ContentIndex(max_entries=16, redis_dsn="redis://localhost/0")
+        index._redis._client = unittest.mock.MagicMock()
+        index._redis._client.set.return_value = None
+        index._redis._client.get.return_value = b"job-0"
+
+        assert index.claim("digest", "job-1") == "job-0"
+        # Second lookup is answered by the LRU tier.
+        assert index.claim("digest", "job-2") == "job-0"
+        index._redis._client.get.assert_called_once()
+
+    def test_claim_redis_failure(self):
+        index = ContentIndex(max_entries=16, redis_dsn="redis://localhost/0")
+        index._redis._client = unittest.mock.MagicMock()
+        index._redis._client.set.side_effect = ConnectionError()
+
+        assert index.claim("digest", "job-0") == "job-0"
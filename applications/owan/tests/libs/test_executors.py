@@ -0,0 +1,81 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import owan.libs.executors
+from owan.libs.executors import StallMonitor
+
+
+def _run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class TestExecutors:
+    def teardown_method(self):
+        owan.libs.executors.configure(io_workers=32)
+
+    def test_run_io(self):
+        result = _run(owan.libs.executors.run_io(lambda a, b=0: a + b, 1, b=2))
+
+        assert result == 3
+
+    def test_run_cpu(self):
+        thread_name = _run(
+            owan.libs.executors.run_cpu(lambda: threading.current_thread().name)
+        )
+
+        assert thread_name.startswith("owan-cpu")
+
+    def test_pool_is_bounded(self):
+        owan.libs.executors.configure(io_workers=2)
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        def work():
+            with lock:
+                active.append(None)
+                peak.append(len(active))
+            time.sleep(0.05)
+            with lock:
+                active.pop()
+
+        async def main():
+            await asyncio.gather(*[owan.libs.executors.run_io(work) for _ in range(6)])
+
+        _run(main())
+
+        assert max(peak) == 2
+
+    def test_error_is_raised(self):
+        def fail():
+            raise RuntimeError("error")
+
+        with pytest.raises(RuntimeError):
+            _run(owan.libs.executors.run_io(fail))
+
+
+class TestStallMonitor:
+    def test_observe(self):
+        monitor = StallMonitor(threshold=0.1)
+
+        monitor.observe(0.01)
+        monitor.observe(0.5)
+
+        assert monitor.stalls == 1
+
+    def test_detect_blocking_call(self):
+        monitor = StallMonitor(threshold=0.05, interval=0.01)
+
+        async def main():
+            monitor.start()
+            await asyncio.sleep(0.02)
+            time.sleep(0.2)  # Block the event loop.
+            await asyncio.sleep(0.05)
+            monitor.stop()
+
+        _run(main())
+
+        assert monitor.stalls >= 1
@@ -0,0 +1,23 @@
+import prometheus_client
+
+import owan.libs.metrics
+from owan.libs.storage import Storage
+
+
+def test_render():
+    owan.libs.metrics.UPLOAD_SECONDS.observe(0.01)
+
+    content, content_type = owan.libs.metrics.render()
+    assert content_type.startswith("text/plain")
+    assert b"owan_upload_read_seconds_count" in content
+
+
+def test_storage_is_measured_per_backend(tmp_path):
+    def sample(name, labels):
+        return prometheus_client.REGISTRY.get_sample_value(name, labels) or 0.0
+
+    labels = {"backend": "local", "operation": "store"}
+    before = sample("owan_storage_seconds_count", labels)
+    Storage(tmp_path, "", "", "", "", local_only=True).store_bytes(b"content", "x")
+
+    assert sample("owan_storage_seconds_count", labels) == before + 1
@@ -0,0 +1,31 @@
+from owan.libs.ratelimit import LocalTokenBucket, RateLimiter, retry_after
+
+
+class TestLocalTokenBucket:
+    def test_acquire(self):
+        bucket = LocalTokenBucket(rate=1.0, burst=2)
+
+        assert bucket.acquire("a") == 0
+        assert bucket.acquire("a") == 0
+        assert bucket.acquire("a") > 0
+        # Buckets are kept per client.
+        assert bucket.acquire("b") == 0
+
+
+class TestRateLimiter:
+    def test_disabled(self):
+        limiter = RateLimiter(rate=0, burst=1)
+
+        assert not limiter.enabled
+        assert all(limiter.acquire("a") == 0 for _ in range(10))
+
+    def test_fallback_to_local(self):
+        limiter = RateLimiter(rate=1.0, burst=1, redis_dsn="redis://localhost:1/0")
+
+        assert limiter.acquire("a") == 0
+        assert limiter.acquire("a") > 0
+
+
+def test_retry_after():
+    assert retry_after(0.01) == 1
+    assert retry_after(2.5) == 3
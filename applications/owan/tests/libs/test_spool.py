@@ -0,0 +1,60 @@
+import shutil
+import time
+import unittest.mock
+
+import pytest
+
+from owan.libs.spool import SpoolQueue
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestSpoolQueue:
+    @pytest.fixture
+    def spool_directory(self, input_store_path_factory):
+        directory = input_store_path_factory().parent / "spool"
+        yield directory
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def test_put(self, spool_directory, image_path_factory):
+        upload = unittest.mock.MagicMock()
+        queue = SpoolQueue(spool_directory, upload)
+
+        queue.put(image_path_factory(), "samples/valid.png")
+
+        assert wait_until(lambda: not list(spool_directory.iterdir()))
+        queue.close()
+        (data_path, key), _ = upload.call_args
+        assert key == "samples/valid.png"
+
+    def test_retry(self, spool_directory, image_path_factory):
+        upload = unittest.mock.MagicMock(side_effect=[ConnectionError(), None])
+        queue = SpoolQueue(spool_directory, upload, backoff_base=0.01)
+
+        queue.put(image_path_factory(), "samples/valid.png")
+
+        assert wait_until(lambda: upload.call_count == 2)
+        assert wait_until(lambda: not list(spool_directory.iterdir()))
+        queue.close()
+
+    def test_resume(self, spool_directory, image_path_factory):
+        failing_upload = unittest.mock.MagicMock(side_effect=ConnectionError())
+        queue = SpoolQueue(spool_directory, failing_upload, backoff_base=10.0)
+        queue.put(image_path_factory(), "samples/valid.png")
+        assert wait_until(lambda: failing_upload.call_count == 1)
+        queue.close()
+        assert len(list(spool_directory.glob("*.data"))) == 1
+
+        upload = unittest.mock.MagicMock()
+        resumed_queue = SpoolQueue(spool_directory, upload)
+
+        assert wait_until(lambda: not list(spool_directory.iterdir()))
+        resumed_queue.close()
+        upload.assert_called_once()
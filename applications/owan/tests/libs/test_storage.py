@@ -0,0 +1,229 @@
+import io
+import pathlib
+import shutil
+import time
+
+import boto3
+import pytest
+
+from owan.libs.storage import Error, LocalStorage, S3Storage, Storage
+
+bucket_name = "owan-test"
+
+
+@pytest.fixture
+def s3_bucket():
+    # Only tests which talk to S3 need moto.
+    moto = pytest.importorskip("moto")
+    with moto.mock_s3():
+        client = boto3.client(
+            "s3",
+            region_name="us-east-1",
+            aws_access_key_id="testing",
+            aws_secret_access_key="testing",
+        )
+        client.create_bucket(Bucket=bucket_name)
+        yield client
+
+
+@pytest.fixture
+def s3_storage_factory():
+    storages = []
+
+    def f(bucket_name=bucket_name, **kwargs):
+        storage = S3Storage("testing", "testing", "us-east-1", bucket_name, **kwargs)
+        storages.append(storage)
+        return storage
+
+    yield f
+    for storage in storages:
+        storage.close()
+
+
+class TestS3Storage:
+    def test_store(self, s3_bucket, s3_storage_factory, image_path_factory):
+        storage = s3_storage_factory()
+        storage.store(image_path_factory(), "samples/valid.png")
+
+        body = s3_bucket.get_object(Bucket=bucket_name, Key="samples/valid.png")
+        assert body["ContentLength"] == image_path_factory().stat().st_size
+
+    def test_store_multipart(
+        self, s3_bucket, s3_storage_factory, output_image_path_factory
+    ):
+        storage = s3_storage_factory(
+            multipart_threshold=5 * 1024 * 1024, multipart_chunksize=5 * 1024 * 1024
+        )
+        file_path = output_image_path_factory().with_name("large.bin")
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        file_path.write_bytes(b"\0" * (11 * 1024 * 1024))
+
+        storage.store(file_path, "samples/large.bin")
+
+        head = s3_bucket.head_object(Bucket=bucket_name, Key="samples/large.bin")
+        # ETag of multipart object ends with the number of parts.
+        assert head["ETag"].endswith('-3"')
+        shutil.rmtree(file_path.parent)
+
+    def test_store_stream(self, s3_bucket, s3_storage_factory):
+        storage = s3_storage_factory()
+        storage.store_stream(memoryview(b"content"), "samples/bytes.bin")
+        storage.store_stream(io.BytesIO(b"content"), "samples/stream.bin")
+
+        for key in ("samples/bytes.bin", "samples/stream.bin"):
+            body = s3_bucket.get_object(Bucket=bucket_name, Key=key)["Body"]
+            assert body.read() == b"content"
+
+    def test_fetch(self, s3_bucket, s3_storage_factory, tmp_path):
+        storage = s3_storage_factory()
+        s3_bucket.put_object(Bucket=bucket_name, Key="samples/x.bin", Body=b"content")
+
+        storage.fetch("samples/x.bin", tmp_path / "x.bin")
+        assert (tmp_path / "x.bin").read_bytes() == b"content"
+        with pytest.raises(Error):
+            storage.fetch("samples/missing.bin", tmp_path / "missing.bin")
+        assert not (tmp_path / "missing.bin").exists()
+
+    def test_store_many(self, s3_bucket, s3_storage_factory, image_path_factory):
+        storage = s3_storage_factory()
+        items = [(image_path_factory(), f"samples/{i}.png") for i in range(8)]
+        items.append((pathlib.Path("./tests/samples/missing.png"), "samples/x.png"))
+
+        errors = storage.store_many(items)
+
+        assert errors[:-1] == [None] * 8
+        assert errors[-1] is not None
+        listed = s3_bucket.list_objects_v2(Bucket=bucket_name, Prefix="samples/")
+        assert listed["KeyCount"] == 8
+
+    def test_client_is_shared(self, s3_bucket, s3_storage_factory):
+        assert s3_storage_factory()._client is s3_storage_factory()._client
+
+
+class TestLocalStorage:
+    def test_store_stream(self):
+        local_directory = pathlib.Path("./tests/tmp/storage")
+        storage = LocalStorage(local_directory)
+
+        storage.store_stream(b"content", "samples/bytes.bin")
+
+        assert (local_directory / "samples/bytes.bin").read_bytes() == b"content"
+        assert not list((local_directory / "samples").glob("*.part"))
+        shutil.rmtree(local_directory)
+
+    def test_store_stream_concurrent_writers(self):
+        local_directory = pathlib.Path("./tests/tmp/storage")
+        storage = LocalStorage(local_directory)
+        chunks = [b"first ", b"writer"]
+
+        class Stream(io.RawIOBase):
+            def read(self, size=-1):
+                if len(chunks) == 2:
+                    # Another writer of the same key runs while this one writes.
+                    storage.store_stream(b"second writer", "samples/same.bin")
+                return chunks.pop(0) if chunks else b""
+
+        storage.store_stream(Stream(), "samples/same.bin")
+
+        assert (local_directory / "samples/same.bin").read_bytes() == b"first writer"
+        assert not list((local_directory / "samples").glob("*.part"))
+        shutil.rmtree(local_directory)
+
+
+class TestStorage:
+    def test_store_bytes_fallback_local(self, s3_bucket):
+        local_directory = pathlib.Path("./tests/tmp/storage")
+        storage = Storage(
+            local_directory=local_directory,
+            s3_access_key_id="testing",
+            s3_secret_key="testing",
+            s3_region_name="us-east-1",
+            s3_bucket_name="missing-bucket",
+        )
+
+        storage.store_bytes(b"content", "samples/bytes.bin")
+
+        assert (local_directory / "samples/bytes.bin").read_bytes() == b"content"
+        storage.close()
+        shutil.rmtree(local_directory)
+
+    def test_store_without_fallback_local(self, s3_bucket, image_path_factory):
+        local_directory = pathlib.Path("./tests/tmp/storage")
+        storage = Storage(
+            local_directory=local_directory,
+            s3_access_key_id="testing",
+            s3_secret_key="testing",
+            s3_region_name="us-east-1",
+            s3_bucket_name="missing-bucket",
+        )
+
+        with pytest.raises(Error):
+            storage.store(
+                image_path_factory(), "samples/valid.png", fallback_local=False
+            )
+
+        assert not (local_directory / "samples/valid.png").exists()
+        storage.close()
+        shutil.rmtree(local_directory)
+
+    def test_store_many_fallback_local(self, s3_bucket, image_path_factory):
+        local_directory = pathlib.Path("./tests/tmp/storage")
+        storage = Storage(
+            local_directory=local_directory,
+            s3_access_key_id="testing",
+            s3_secret_key="testing",
+            s3_region_name="us-east-1",
+            s3_bucket_name="missing-bucket",
+        )
+
+        storage.store_many([(image_path_factory(), "samples/valid.png")])
+
+        assert (local_directory / "samples/valid.png").exists()
+        storage.close()
+        shutil.rmtree(local_directory)
+
+    def test_store_write_behind(self, s3_bucket, image_path_factory):
+        spool_directory = pathlib.Path("./tests/tmp/spool")
+        storage = Storage(
+            local_directory=pathlib.Path("./tests/tmp/storage"),
+            s3_access_key_id="testing",
+            s3_secret_key="testing",
+            s3_region_name="us-east-1",
+            s3_bucket_name=bucket_name,
+            spool_directory=spool_directory,
+        )
+
+        storage.store(image_path_factory(), "samples/valid.png")
+
+        deadline = time.monotonic() + 5.0
+        while list(spool_directory.iterdir()) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        storage.close()
+        s3_bucket.head_object(Bucket=bucket_name, Key="samples/valid.png")
+        shutil.rmtree(spool_directory)
+
+    def test_write_behind_uploads_local_fallback(self, s3_bucket):
+        local_directory = pathlib.Path("./tests/tmp/storage")
+        fallback_path = local_directory / "samples/fallback.bin"
+        fallback_path.parent.mkdir(parents=True, exist_ok=True)
+        fallback_path.write_bytes(b"content")
+
+        spool_directory = pathlib.Path("./tests/tmp/spool")
+        storage = Storage(
+            local_directory=local_directory,
+            s3_access_key_id="testing",
+            s3_secret_key="testing",
+            s3_region_name="us-east-1",
+            s3_bucket_name=bucket_name,
+            spool_directory=spool_directory,
+        )
+
+        deadline = time.monotonic() + 5.0
+        while fallback_path.exists() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        storage.close()
+        body = s3_bucket.get_object(Bucket=bucket_name, Key="samples/fallback.bin")
+        assert body["Body"].read() == b"content"
+        assert not fallback_path.exists()
+        shutil.rmtree(spool_directory)
+        shutil.rmtree(local_directory)
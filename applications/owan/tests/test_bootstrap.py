@@ -0,0 +1,21 @@
+import owan.bootstrap
+
+
+def test_shared_domain_is_built_once(settings_factory):
+    settings = settings_factory()
+    try:
+        domain = owan.bootstrap.shared_domain(settings)
+        assert owan.bootstrap.shared_domain(settings) is domain
+    finally:
+        owan.bootstrap.shutdown()
+
+
+def test_shutdown_releases_shared_domain(settings_factory):
+    settings = settings_factory()
+    domain = owan.bootstrap.shared_domain(settings)
+    owan.bootstrap.shutdown()
+
+    try:
+        assert owan.bootstrap.shared_domain(settings) is not domain
+    finally:
+        owan.bootstrap.shutdown()
@@ -0,0 +1,47 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Wall time is flaky on shared runners, so the budget check runs only if set.
+BUDGET_SECONDS = os.getenv("STARTUP_BUDGET_SECONDS")
+
+_PROBE = """
+import importlib, json, sys, time
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+print(json.dumps({"seconds": time.perf_counter() - start, "modules": list(sys.modules)}))
+"""
+
+
+def _import(module):
+    completed = subprocess.run(
+        [sys.executable, "-c", _PROBE, module],
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return json.loads(completed.stdout.decode())
+
+
+@pytest.mark.parametrize(
+    "module, deferred",
+    [
+        ("owan.wsgi", {"boto3", "botocore", "PIL", "celery", "kombu", "redis"}),
+        ("owan.worker", {"boto3", "botocore", "PIL", "redis"}),
+    ],
+)
+def test_heavy_dependencies_are_imported_lazily(module, deferred):
+    result = _import(module)
+
+    loaded = {name.split(".", 1)[0] for name in result["modules"]}
+    assert loaded & deferred == set()
+
+
+@pytest.mark.skipif(BUDGET_SECONDS is None, reason="STARTUP_BUDGET_SECONDS is not set")
+@pytest.mark.parametrize("module", ["owan.wsgi", "owan.worker"])
+def test_import_time_within_budget(module):
+    seconds = min(_import(module)["seconds"] for _ in range(3))
+
+    assert seconds < float(BUDGET_SECONDS)
@@ -1,11 +1,106 @@
+import shutil
+
+import owan.bootstrap
+import owan.libs.storage
 import owan.tasks
 
 
 def test_enqueueable(image_path_factory):
     factory = owan.tasks.Factory(broker="memory://localhost")
     async_result = factory.broker.test_predict(str(image_path_factory()))
-    # Because currently we have no plan to get return value from Celery,
-    # we don't set any backend. So there is no way to get the task
-    # complete status from Celery. As a result, we just check existence
-    # of task_id here.
+    # No backend is set here, so there is no way to get the task complete
+    # status from Celery. As a result, we just check existence of task_id here.
     assert async_result.task_id
+
+
+def test_job_id_is_task_id(image_path_factory):
+    factory = owan.tasks.Factory(broker="memory://localhost", backend="cache+memory://")
+    async_result = factory.broker.test_predict(
+        str(image_path_factory()), job_id="job-id"
+    )
+    assert async_result.task_id == "job-id"
+    assert factory.broker.job("job-id").state == "PENDING"
+
+
+def test_enqueueable_batch(image_path_factory):
+    factory = owan.tasks.Factory(broker="memory://localhost")
+    jobs = [("job-id-0", str(image_path_factory())), ("job-id-1", "dummy.png")]
+    group_result = factory.broker.predict_batch(jobs)
+    assert group_result.id
+    assert [result.id for result in group_result.results] == ["job-id-0", "job-id-1"]
+
+
+def test_publish_is_bounded_by_socket_timeout():
+    factory = owan.tasks.Factory(
+        broker="memory://localhost", pool_limit=4, socket_timeout=1.5
+    )
+    conf = factory.worker.conf
+
+    assert conf.broker_pool_limit == 4
+    assert conf.broker_transport_options["socket_timeout"] == 1.5
+    assert conf.task_publish_retry_policy["max_retries"] == 1
+    factory.broker.connect()
+    factory.broker.close()
+
+
+def test_storage_task_is_routed_to_storage_queue(settings_factory):
+    settings = settings_factory()
+    factory = owan.tasks.Factory(
+        broker="memory://localhost", worker_settings=settings.worker
+    )
+    router = factory.worker.amqp.router
+
+    assert router.route({}, "owan.tasks._store")["queue"].name == "storage"
+    assert router.route({}, "owan.tasks._predict")["queue"].name == "prediction"
+    assert factory.worker.conf.worker_prefetch_multiplier == 1
+    assert factory.worker.conf.task_acks_late
+
+
+def test_enqueueable_payload(settings_factory, image_path_factory):
+    settings = settings_factory(payload_transport="AUTO")
+    with owan.bootstrap.domain(settings) as domain:
+        payload = domain.payload.pack(image_path_factory())
+        async_result = domain.task_queue.predict(payload, job_id="job-id")
+
+    assert payload["kind"] == "storage"
+    assert async_result.task_id == "job-id"
+
+
+def test_input_is_released_after_task(
+    settings_factory, image_path_factory, monkeypatch
+):
+    settings = settings_factory()
+    monkeypatch.setattr(owan.tasks, "_get_settings", lambda: settings)
+    image_path = settings.input_store.path / "ab" / "input.png"
+    image_path.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copy2(image_path_factory(), image_path)
+
+    try:
+        domain = owan.bootstrap.shared_domain(settings)
+        domain.task_queue._predict.apply((str(image_path),))
+        assert not image_path.exists()
+    finally:
+        owan.bootstrap.shutdown()
+        shutil.rmtree(settings.input_store.path)
+
+
+def test_store_is_retried_before_falling_back_local(
+    settings_factory, image_path_factory, monkeypatch
+):
+    settings = settings_factory()
+    monkeypatch.setattr(owan.tasks, "_get_settings", lambda: settings)
+    fallbacks = []
+
+    def store(image_path, key, storage, fallback_local=True):
+        fallbacks.append(fallback_local)
+        if not fallback_local:
+            raise owan.libs.storage.Error()
+
+    try:
+        domain = owan.bootstrap.shared_domain(settings)
+        monkeypatch.setattr(domain.task_worker, "store", store)
+        domain.task_queue._store.apply((str(image_path_factory()), "key"))
+    finally:
+        owan.bootstrap.shutdown()
+
+    assert fallbacks == [False] * domain.task_queue._store.max_retries + [True]
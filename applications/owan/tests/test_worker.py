@@ -0,0 +1,51 @@
+import dataclasses
+import pathlib
+import time
+import unittest.mock
+
+import prometheus_client
+
+import owan.bootstrap
+import owan.tasks
+import owan.worker
+
+
+def test_worker_process_init_builds_warm_domain(settings_factory, monkeypatch):
+    settings = settings_factory()
+    monkeypatch.setattr(owan.worker, "settings", settings)
+    try:
+        owan.worker._on_worker_process_init()
+        assert owan.bootstrap._shared_domain is not None
+    finally:
+        owan.bootstrap.shutdown()
+
+
+def test_worker_ready_file(settings_factory, monkeypatch):
+    settings = settings_factory()
+    ready_file = pathlib.Path("./tests/tmp/worker/ready")
+    worker_settings = dataclasses.replace(settings.worker, ready_file=ready_file)
+    monkeypatch.setattr(
+        owan.worker, "settings", dataclasses.replace(settings, worker=worker_settings)
+    )
+
+    owan.worker._on_worker_ready()
+    assert ready_file.exists()
+    owan.worker._on_worker_shutdown()
+    assert not ready_file.exists()
+
+
+def test_task_run_is_measured(monkeypatch):
+    task = unittest.mock.MagicMock()
+    task.name = "owan.tasks._predict"
+    setattr(task.request, owan.tasks.PUBLISHED_AT_HEADER, time.time())
+    labels = {"task": "predict", "state": "SUCCESS"}
+
+    def sample(name, labels):
+        return prometheus_client.REGISTRY.get_sample_value(name, labels) or 0.0
+
+    before = sample("owan_task_run_seconds_count", labels)
+    owan.worker._on_task_prerun(task_id="task-id", task=task)
+    owan.worker._on_task_postrun(task_id="task-id", task=task, state="SUCCESS")
+
+    assert sample("owan_task_run_seconds_count", labels) == before + 1
+    assert sample("owan_queue_wait_seconds_count", {"task": "predict"}) >= 1
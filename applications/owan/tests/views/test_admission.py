@@ -0,0 +1,104 @@
+import dataclasses
+import http
+
+import fastapi
+import fastapi.testclient
+import pytest
+from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
+
+from owan.views.admission import AdmissionController, AdmissionMiddleware
+
+
+@pytest.fixture
+def controller_factory(settings_factory, input_store_path_factory):
+    def f(queue_depth=0, max_upload_bytes=1024, **kwargs):
+        settings = dataclasses.replace(settings_factory().admission, **kwargs)
+        return AdmissionController(
+            settings, input_store_path_factory(), max_upload_bytes, lambda: queue_depth
+        )
+
+    return f
+
+
+@pytest.fixture
+def client_factory():
+    def f(controller, trusted_hosts=None):
+        app = fastapi.FastAPI()
+
+        @app.post("/predict")
+        async def predict(request: fastapi.Request) -> dict:
+            return {"size": len(await request.body())}
+
+        @app.get("/health")
+        async def health() -> dict:
+            return {"health": "ok"}
+
+        app.add_middleware(AdmissionMiddleware, controller=controller)
+        if trusted_hosts is not None:
+            # As uvicorn does for peers in `FORWARDED_ALLOW_IPS`.
+            return fastapi.testclient.TestClient(
+                ProxyHeadersMiddleware(app, trusted_hosts=trusted_hosts)
+            )
+        return fastapi.testclient.TestClient(app)
+
+    return f
+
+
+def test_admit(client_factory, controller_factory):
+    controller = controller_factory()
+    response = client_factory(controller).post("/predict", data=b"content")
+
+    assert response.status_code == http.HTTPStatus.OK
+    assert response.json()["size"] == len(b"content")
+    assert controller.inflight_bytes == 0
+
+
+def test_reject_queue_depth(client_factory, controller_factory):
+    client = client_factory(controller_factory(queue_depth=100, max_queue_depth=100))
+
+    response = client.post("/predict", data=b"content")
+    assert response.status_code == http.HTTPStatus.SERVICE_UNAVAILABLE
+    assert response.headers["Retry-After"] == "5"
+    assert client.get("/health").status_code == http.HTTPStatus.OK
+
+
+def test_reject_free_disk(client_factory, controller_factory):
+    client = client_factory(controller_factory(min_free_disk_bytes=1 << 62))
+
+    response = client.post("/predict", data=b"content")
+    assert response.status_code == http.HTTPStatus.SERVICE_UNAVAILABLE
+
+
+def test_reject_inflight_bytes(controller_factory):
+    controller = controller_factory(max_inflight_bytes=100)
+
+    assert controller.admit("client", 80) is None
+    rejection = controller.admit("client", 80)
+    assert rejection is not None and rejection.status_code == 503
+    # Unknown size is reserved as the largest upload.
+    controller.release(80)
+    assert controller.admit("client", None) is None
+    assert controller.inflight_bytes == 1024
+
+
+def test_reject_rate_limit(client_factory, controller_factory):
+    client = client_factory(controller_factory(rate_limit=0.1, rate_limit_burst=1))
+
+    assert client.post("/predict", data=b"content").status_code == http.HTTPStatus.OK
+    response = client.post("/predict", data=b"content")
+    assert response.status_code == http.HTTPStatus.TOO_MANY_REQUESTS
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_rate_limit_per_forwarded_client(client_factory, controller_factory):
+    controller = controller_factory(rate_limit=0.1, rate_limit_burst=1)
+    # The peer of the test client is `testclient`, i.e. the reverse proxy.
+    client = client_factory(controller, trusted_hosts="testclient")
+
+    def post(forwarded_for):
+        headers = {"X-Forwarded-For": forwarded_for}
+        return client.post("/predict", data=b"content", headers=headers).status_code
+
+    assert post("192.0.2.1") == http.HTTPStatus.OK
+    assert post("192.0.2.2") == http.HTTPStatus.OK
+    assert post("192.0.2.1") == http.HTTPStatus.TOO_MANY_REQUESTS
@@ -1,13 +1,25 @@
+import asyncio
+import dataclasses
 import http
+import io
+import shutil
+import time
 import unittest.mock
+import zipfile
 from unittest.mock import MagicMock
 
 import fastapi
 import fastapi.testclient
+import kombu.exceptions
 import pytest
 
+import owan.domain
+import owan.domain.payload
 import owan.views.api
 import owan.views.routing
+from owan.domain.io import SavedUpload
+from owan.libs.dedup import ContentIndex
+from owan.views.api._lib import _claim_job, _dedup_key, _enqueue
 
 
 def mock_domain_factory_factory(mock_domain=unittest.mock.MagicMock()):
@@ -20,6 +32,8 @@ def mock_domain_factory_factory(mock_domain=unittest.mock.MagicMock()):
 @pytest.fixture
 def dummy_client():
     def f(mock_domain=unittest.mock.MagicMock()):
+        if not isinstance(mock_domain.dedup, ContentIndex):
+            mock_domain.dedup = None
         app = fastapi.FastAPI()
         app.dependency_overrides[
             owan.views.api._domain_factory
@@ -34,24 +48,311 @@ def test_predict(dummy_client, binary_image_factory, image_path_factory):
     mock_domain = unittest.mock.MagicMock()
     client = dummy_client(mock_domain)
     files = {"file": binary_image_factory()}
-    expected = {"recieved_file": str(image_path_factory().name)}
+    expected = str(image_path_factory().name)
 
     response = client.post("/predict", files=files)
     assert response.status_code == http.HTTPStatus.OK
-    assert response.json() == expected
+    assert response.json()["recieved_file"] == expected
     mock_domain.task_queue.predict.assert_called_once()
+    assert (
+        mock_domain.task_queue.predict.call_args[1]["job_id"]
+        == response.json()["job_id"]
+    )
+
+
+def test_predict_pixel_budget(dummy_client, binary_image_factory):
+    mock_domain = unittest.mock.MagicMock()
+    mock_domain.io = owan.domain.IoHandler(max_pixels=16)
+    client = dummy_client(mock_domain)
+
+    response = client.post("/predict", files={"file": binary_image_factory()})
+    assert response.status_code == http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+    mock_domain.task_queue.predict.assert_not_called()
 
 
 def test_test_predict(dummy_client, binary_image_factory, image_path_factory):
     mock_domain = unittest.mock.MagicMock()
     client = dummy_client(mock_domain)
     files = {"file": binary_image_factory()}
-    expected_response = {"recieved_file": str(image_path_factory().name)}
+    expected = str(image_path_factory().name)
 
     response = client.post("/predict/test", files=files)
     assert response.status_code == http.HTTPStatus.OK
-    assert response.json() == expected_response
+    assert response.json()["recieved_file"] == expected
+    mock_domain.task_queue.test_predict.assert_called_once()
+    assert (
+        mock_domain.task_queue.test_predict.call_args[1]["job_id"]
+        == response.json()["job_id"]
+    )
+
+
+def test_test_predict_duplicate(
+    dummy_client, settings_factory, binary_image_factory, image_path_factory
+):
+    settings = settings_factory()
+    mock_domain = unittest.mock.MagicMock()
+    mock_domain.io = owan.domain.IoHandler()
+    mock_domain.dedup = ContentIndex(max_entries=16)
+    client = dummy_client(mock_domain)
+    client.app.dependency_overrides[owan.views.api.get_settings] = lambda: settings
+
+    first = client.post("/predict/test", files={"file": binary_image_factory()})
+    second = client.post("/predict/test", files={"file": binary_image_factory()})
+    assert first.status_code == second.status_code == http.HTTPStatus.OK
+    assert not first.json()["duplicate"]
+    assert second.json()["duplicate"]
+    assert second.json()["job_id"] == first.json()["job_id"]
     mock_domain.task_queue.test_predict.assert_called_once()
+    assert len(list(settings.input_store.path.iterdir())) == 1
+    shutil.rmtree(settings.input_store.path)
+
+
+def test_predict_duplicate_is_per_endpoint(
+    dummy_client, settings_factory, binary_image_factory
+):
+    settings = settings_factory()
+    mock_domain = unittest.mock.MagicMock()
+    mock_domain.io = owan.domain.IoHandler()
+    mock_domain.dedup = ContentIndex(max_entries=16)
+    client = dummy_client(mock_domain)
+    client.app.dependency_overrides[owan.views.api.get_settings] = lambda: settings
+
+    first = client.post("/predict/test", files={"file": binary_image_factory()})
+    second = client.post("/predict", files={"file": binary_image_factory()})
+    assert first.status_code == second.status_code == http.HTTPStatus.OK
+    assert not second.json()["duplicate"]
+    assert second.json()["job_id"] != first.json()["job_id"]
+    mock_domain.task_queue.test_predict.assert_called_once()
+    mock_domain.task_queue.predict.assert_called_once()
+    shutil.rmtree(settings.input_store.path)
+
+
+def test_predict_duplicate_of_failed_job(
+    dummy_client, settings_factory, binary_image_factory
+):
+    settings = settings_factory()
+    mock_domain = unittest.mock.MagicMock()
+    mock_domain.io = owan.domain.IoHandler()
+    mock_domain.dedup = ContentIndex(max_entries=16)
+    mock_domain.task_queue.job.return_value.state = "FAILURE"
+    client = dummy_client(mock_domain)
+    client.app.dependency_overrides[owan.views.api.get_settings] = lambda: settings
+
+    first = client.post("/predict", files={"file": binary_image_factory()})
+    second = client.post("/predict", files={"file": binary_image_factory()})
+    assert first.status_code == second.status_code == http.HTTPStatus.OK
+    assert not second.json()["duplicate"]
+    assert second.json()["job_id"] != first.json()["job_id"]
+    assert mock_domain.task_queue.predict.call_count == 2
+    shutil.rmtree(settings.input_store.path)
+
+
+def test_test_predict_broker_unavailable(
+    dummy_client, settings_factory, binary_image_factory
+):
+    settings = settings_factory()
+    mock_domain = unittest.mock.MagicMock()
+    mock_domain.io = owan.domain.IoHandler()
+    mock_domain.dedup = ContentIndex(max_entries=16)
+    mock_domain.task_queue.test_predict.side_effect = (
+        kombu.exceptions.OperationalError()
+    )
+    client = dummy_client(mock_domain)
+    client.app.dependency_overrides[owan.views.api.get_settings] = lambda: settings
+
+    first = client.post("/predict/test", files={"file": binary_image_factory()})
+    assert first.status_code == http.HTTPStatus.SERVICE_UNAVAILABLE
+    assert first.headers["Retry-After"]
+
+    # The claim of the failed job is released, so a retry is enqueued anew.
+    mock_domain.task_queue.test_predict.side_effect = None
+    second = client.post("/predict/test", files={"file": binary_image_factory()})
+    assert second.status_code == http.HTTPStatus.OK
+    assert not second.json()["duplicate"]
+    shutil.rmtree(settings.input_store.path)
+
+
+@pytest.mark.parametrize("fails", [False, True])
+def test_enqueue_timeout(settings_factory, image_path_factory, fails):
+    settings = settings_factory()
+    settings = dataclasses.replace(
+        settings, redis=dataclasses.replace(settings.redis, enqueue_timeout=0.05)
+    )
+    mock_domain = unittest.mock.MagicMock()
+    mock_domain.dedup = ContentIndex(max_entries=16)
+    saved = SavedUpload(image_path_factory(), "digest", 0)
+    claims = [("job-id", saved)]
+    _claim_job(mock_domain, saved, "job-id", "predict")
+
+    def slow_publish():
+        time.sleep(0.2)
+        if fails:
+            raise kombu.exceptions.OperationalError()
+
+    async def main():
+        with pytest.raises(fastapi.HTTPException) as e:
+            await _enqueue(mock_domain, settings, "predict", claims, slow_publish)
+        assert e.value.status_code == http.HTTPStatus.SERVICE_UNAVAILABLE
+        await asyncio.sleep(0.4)  # Until the late publish ends.
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+    # The claim is kept if the late publish succeeded, and released otherwise.
+    claimed = mock_domain.dedup.claim(_dedup_key("predict", "digest"), "retry-id")
+    assert claimed == ("retry-id" if fails else "job-id")
+
+
+def test_predict_upload_failure(dummy_client, settings_factory, binary_image_factory):
+    settings = settings_factory()
+    mock_domain = unittest.mock.MagicMock()
+    mock_domain.io = owan.domain.IoHandler()
+    mock_domain.dedup = ContentIndex(max_entries=16)
+    mock_domain.payload.pack.side_effect = owan.domain.payload.Error("upload failed")
+    client = dummy_client(mock_domain)
+    client.app.dependency_overrides[owan.views.api.get_settings] = lambda: settings
+
+    first = client.post("/predict", files={"file": binary_image_factory()})
+    assert first.status_code == http.HTTPStatus.SERVICE_UNAVAILABLE
+    assert list(settings.input_store.path.iterdir()) == []
+    mock_domain.task_queue.predict.assert_not_called()
+
+    # The claim of the failed job is released, so a retry is enqueued anew.
+    mock_domain.payload.pack.side_effect = None
+    second = client.post("/predict", files={"file": binary_image_factory()})
+    assert second.status_code == http.HTTPStatus.OK
+    assert not second.json()["duplicate"]
+    mock_domain.task_queue.predict.assert_called_once()
+    shutil.rmtree(settings.input_store.path)
+
+
+def test_predict_batch(dummy_client, binary_image_factory, image_path_factory):
+    mock_domain = unittest.mock.MagicMock()
+    mock_domain.io.is_archive.return_value = False
+    mock_domain.task_queue.predict_batch.return_value.id = "batch-id"
+    client = dummy_client(mock_domain)
+    files = [
+        ("files", ("a.png", binary_image_factory())),
+        ("files", ("b.png", binary_image_factory())),
+    ]
+
+    response = client.post("/predict/batch", files=files)
+    assert response.status_code == http.HTTPStatus.OK
+    body = response.json()
+    assert body["batch_id"] == "batch-id"
+    assert [job["filename"] for job in body["jobs"]] == ["a.png", "b.png"]
+    assert body["rejected"] == []
+    mock_domain.task_queue.predict_batch.assert_called_once()
+
+
+def test_predict_batch_all_duplicates(
+    dummy_client, settings_factory, binary_image_factory
+):
+    settings = settings_factory()
+    mock_domain = unittest.mock.MagicMock()
+    mock_domain.io = owan.domain.IoHandler()
+    mock_domain.dedup = ContentIndex(max_entries=16)
+    mock_domain.task_queue.predict_batch.return_value.id = "batch-id"
+    client = dummy_client(mock_domain)
+    client.app.dependency_overrides[owan.views.api.get_settings] = lambda: settings
+
+    files = [("files", ("a.png", binary_image_factory()))]
+    first = client.post("/predict/batch", files=files).json()
+    files = [("files", ("a.png", binary_image_factory()))]
+    second = client.post("/predict/batch", files=files).json()
+
+    assert first["batch_id"] == "batch-id"
+    # Nothing is enqueued, so there is no batch to refer to.
+    assert second["batch_id"] is None
+    assert second["jobs"][0]["duplicate"]
+    assert second["jobs"][0]["job_id"] == first["jobs"][0]["job_id"]
+    mock_domain.task_queue.predict_batch.assert_called_once()
+    shutil.rmtree(settings.input_store.path)
+
+
+def test_predict_batch_archive(
+    dummy_client,
+    settings_factory,
+    image_path_factory,
+    invalid_image_path_factory,
+):
+    settings = settings_factory()
+    mock_domain = unittest.mock.MagicMock()
+    mock_domain.io = owan.domain.IoHandler()
+    mock_domain.task_queue.predict_batch.return_value.id = "batch-id"
+    client = dummy_client(mock_domain)
+    client.app.dependency_overrides[owan.views.api.get_settings] = lambda: settings
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as f:
+        f.write(image_path_factory(), "frames/valid.png")
+        f.write(invalid_image_path_factory(), "frames/invalid.png")
+    archive.seek(0)
+
+    response = client.post("/predict/batch", files={"files": ("frames.zip", archive)})
+    assert response.status_code == http.HTTPStatus.OK
+    body = response.json()
+    assert [job["filename"] for job in body["jobs"]] == ["valid.png"]
+    assert [r["filename"] for r in body["rejected"]] == ["invalid.png"]
+    (jobs,), _ = mock_domain.task_queue.predict_batch.call_args
+    assert jobs[0][0] == body["jobs"][0]["job_id"]
+    shutil.rmtree(settings.input_store.path)
+
+
+def test_job_status(dummy_client):
+    mock_domain = unittest.mock.MagicMock()
+    mock_domain.task_queue.job.return_value.state = "SUCCESS"
+    mock_domain.task_queue.job.return_value.result = "jetson/key.png"
+    client = dummy_client(mock_domain)
+
+    response = client.get("/jobs/job-id")
+    assert response.status_code == http.HTTPStatus.OK
+    assert response.json() == {
+        "job_id": "job-id",
+        "status": "SUCCESS",
+        "ready": True,
+        "result": "jetson/key.png",
+    }
+    mock_domain.task_queue.job.assert_called_once_with("job-id")
+
+
+def test_wait_job_timeout(dummy_client):
+    mock_domain = unittest.mock.MagicMock()
+    mock_domain.task_queue.job.return_value.state = "PENDING"
+    client = dummy_client(mock_domain)
+
+    response = client.get("/jobs/job-id/wait", params={"timeout": 0.1})
+    assert response.status_code == http.HTTPStatus.OK
+    assert response.json()["status"] == "PENDING"
+    assert not response.json()["ready"]
+
+
+def test_store(dummy_client):
+    mock_domain = unittest.mock.MagicMock()
+    client = dummy_client(mock_domain)
+
+    response = client.get("/store")
+    assert response.status_code == http.HTTPStatus.OK
+    mock_domain.storage.store_bytes.assert_called_once_with(
+        mock_domain.compressor.compress_to_bytes.return_value, "hogehoge/samples.jpeg"
+    )
+
+
+def test_store_profile(dummy_client, settings_factory):
+    mock_domain = unittest.mock.MagicMock()
+    client = dummy_client(mock_domain)
+    settings = settings_factory()
+    client.app.dependency_overrides[owan.views.api.get_settings] = lambda: settings
+
+    response = client.get("/store", params={"profile": "thumbnail", "quality": 40})
+    assert response.status_code == http.HTTPStatus.OK
+    assert response.json()["format"] == "webp"
+    mock_domain.compressor.compress_to_bytes.assert_called_once_with(
+        unittest.mock.ANY, image_format="webp", quality=40, max_bytes=4096
+    )
+    assert mock_domain.storage.store_bytes.call_args[0][1] == "hogehoge/samples.webp"
+
+    response = client.get("/store", params={"profile": "unknown"})
+    assert response.status_code == http.HTTPStatus.BAD_REQUEST
 
 
 def test_health(dummy_client):
@@ -61,3 +362,10 @@ def test_health(dummy_client):
     response = client.get("/health")
     assert response.status_code == http.HTTPStatus.OK
     assert response.json() == {"health": "ok"}
+
+
+def test_metrics(dummy_client):
+    client = dummy_client()
+    response = client.get("/metrics")
+    assert response.status_code == http.HTTPStatus.OK
+    assert "owan_rejected_requests_total" in response.text